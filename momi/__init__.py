@@ -6,6 +6,7 @@ Please refer to examples/tutorial.ipynb for usage & introduction.
 """
 from .compute_sfs import expected_sfs, expected_total_branch_len, expected_sfs_tensor_prod, expected_tmrca, expected_deme_tmrca
 from .likelihood import SfsLikelihoodSurface
+from .telemetry import TelemetrySink
 from .confidence_region import ConfidenceRegion
 from .data.configurations import build_config_list
 from .data.sfs import site_freq_spectrum, Sfs
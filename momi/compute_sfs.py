@@ -1,4 +1,3 @@
-import networkx as nx
 import autograd.numpy as np
 from .data.configurations import ConfigList
 from .math_functions import (hypergeom_quasi_inverse,
@@ -270,8 +269,7 @@ class LikelihoodTensorList(object):
     @classmethod
     def compute_sfs(cls, leaf_states, demo):
         liklist = cls(leaf_states, demo)
-        for event in nx.dfs_postorder_nodes(
-                demo._event_tree):
+        for event in demo._event_postorder:
             liklist._process_event(event)
         assert len(liklist.likelihood_list) == 1
         lik, = liklist.likelihood_list
@@ -279,11 +277,14 @@ class LikelihoodTensorList(object):
 
     def __init__(self, leaf_liks_dict, demo):
         self.likelihood_list = [
-            LikelihoodTensor(l, 0, [p])
+            self._new_tensor(l, 0, [p])
             for p, l in leaf_liks_dict.items()
         ]
         self.demo = demo
 
+    def _new_tensor(self, liks, sfs, pop_labels):
+        return LikelihoodTensor(liks, sfs, pop_labels)
+
     def _get_likelihoods(self, pop):
         for lik in self.likelihood_list:
             if pop in lik.pop_labels:
@@ -324,7 +325,7 @@ class LikelihoodTensorList(object):
         else:
             # ghost population
             batch_size = self.likelihood_list[0].liks.shape[0]
-            self.likelihood_list.append(LikelihoodTensor(
+            self.likelihood_list.append(self._new_tensor(
                 np.ones((batch_size, 1)), 0,
                 [(pop, idx)]
             ))
@@ -534,3 +535,53 @@ class LikelihoodTensor(object):
 
     def mul_trailing(self, to_mult):
         self.liks = self.liks * to_mult
+
+
+def _expected_sfs_bytes_per_row(demography):
+    """
+    Estimated peak memory, in bytes per row of the vecs passed to
+    expected_sfs_tensor_prod(), for computing the expected SFS
+    together with its gradient.
+
+    Every likelihood tensor computed on the forward pass is
+    kept for the backward pass, which additionally needs gradient
+    buffers of the largest tensors.
+
+    demography should not be traced by autograd.
+    """
+    leaf_liks = {pop: np.ones((1, n + 1)) for pop, n in zip(
+        demography.sampled_pops, demography.sampled_n)}
+    liklist = _SizeRecordingTensorList(leaf_liks, demography)
+    for event in demography._event_postorder:
+        liklist._process_event(event)
+    sizes = liklist.sizes
+    itemsize = np.dtype(float).itemsize
+    return itemsize * (sum(sizes) + 2 * max(sizes))
+
+
+class _SizeRecordingTensorList(LikelihoodTensorList):
+    """
+    Records the size (per row) of every likelihood tensor computed,
+    for _expected_sfs_bytes_per_row().
+    """
+    def __init__(self, leaf_liks_dict, demo):
+        self.sizes = []
+        super(_SizeRecordingTensorList, self).__init__(leaf_liks_dict, demo)
+
+    def _new_tensor(self, liks, sfs, pop_labels):
+        return _SizeRecordingTensor(liks, sfs, pop_labels, self.sizes)
+
+
+class _SizeRecordingTensor(LikelihoodTensor):
+    def __init__(self, liks, sfs, pop_labels, sizes):
+        self.sizes = sizes
+        super(_SizeRecordingTensor, self).__init__(liks, sfs, pop_labels)
+
+    @property
+    def liks(self):
+        return self._liks
+
+    @liks.setter
+    def liks(self, value):
+        self._liks = value
+        self.sizes.append(np.size(value))
@@ -1,12 +1,15 @@
+import logging
 from .compute_sfs import expected_sfs
-from .likelihood import _composite_log_likelihood
-from .util import memoize_instance, make_constant, check_psd
+from .likelihood import SfsLikelihoodSurface, _composite_log_likelihood, _demo_func_lock
+from .util import memoize_instance, make_constant, check_psd, hessian_from_hvps
 from .math_functions import inv_psd
 import scipy
 import scipy.stats
 import autograd
 import autograd.numpy as np
 
+logger = logging.getLogger(__name__)
+
 # stuff for confidence intervals
 
 
@@ -172,7 +175,7 @@ class ConfidenceRegion(_ConfidenceRegion):
     using the Limit of Experiments theory.
     """
 
-    def __init__(self, point_estimate, demo_func, data, mut_rate=None, length=1, regime="long", psd_rtol=1e-8, **kwargs):
+    def __init__(self, point_estimate, demo_func, data, mut_rate=None, length=1, regime="long", psd_rtol=1e-8, n_workers=None, batch_size=1000, **kwargs):
         """
         Parameters
         ----------
@@ -192,6 +195,13 @@ class ConfidenceRegion(_ConfidenceRegion):
         psd_rtol: for checking if certain matrices (e.g. covariance matrices) are positive semidefinite
               if psd_rtol = epsilon, then we will consider a matrix positive semidefinite if its most
               negative eigenvalue has magnitude less than epsilon * most positive eigenvalue.
+        n_workers : if > 1, the columns of the hessians are computed concurrently
+              on this many threads. The hessians are built column by column from
+              hessian-vector products, so their memory cost does not grow with
+              the number of parameters. For regime="many", the batches
+              of the per-locus scores are also spread over this many threads.
+        batch_size : for regime="many", the per-locus scores are computed
+              in batches of this many SFS entries, to bound the memory usage.
         **kwargs : additional arguments passed into composite_log_likelihood
         """
         if regime not in ("long", "many"):
@@ -211,30 +221,38 @@ class ConfidenceRegion(_ConfidenceRegion):
         self.regime = regime
         self.kwargs = dict(kwargs)
         self.psd_rtol = psd_rtol
+        self.n_workers = n_workers
 
         self.score = autograd.grad(self.lik_fun)(self.point)
         self.score_cov = _observed_score_covariance(
             self.regime, self.point, self.data,
             self.demo_func, psd_rtol=self.psd_rtol, mut_rate=mut_rate,
-            **self.kwargs)
+            n_workers=self.n_workers, batch_size=batch_size, **self.kwargs)
         self.fisher = _observed_fisher_information(
             self.point, self.data, self.demo_func,
             psd_rtol=self.psd_rtol, assert_psd=False,
-            mut_rate=mut_rate, **self.kwargs)
+            mut_rate=mut_rate, n_workers=self.n_workers, **self.kwargs)
 
     def lik_fun(self, params, vector=False):
         """Returns composite log likelihood from params"""
-        return _composite_log_likelihood(self.data, self.demo_func(*params), vector=vector, **self.kwargs)
+        return _composite_log_likelihood(self.data, _make_demo(self.demo_func, params), vector=vector, **self.kwargs)
+
+
+def _make_demo(demo_func, params):
+    # the hessian columns may be computed on several threads,
+    # and demo_func may not be thread-safe
+    with _demo_func_lock:
+        return demo_func(*params)
 
 
 def _trunc_lik_ratio(null, alt):
     return (1 - np.isclose(alt, null)) * (null - alt)
 
 
-def _observed_fisher_information(params, data, demo_func, psd_rtol, assert_psd=True, **kwargs):
+def _observed_fisher_information(params, data, demo_func, psd_rtol, assert_psd=True, n_workers=None, **kwargs):
     params = np.array(params)
-    f = lambda x: _composite_log_likelihood(data, demo_func(*x), **kwargs)
-    ret = -autograd.hessian(f)(params)
+    f = lambda x: _composite_log_likelihood(data, _make_demo(demo_func, x), **kwargs)
+    ret = -hessian_from_hvps(f, params, n_workers=n_workers)
     if assert_psd:
         try:
             ret = check_psd(ret, tol=psd_rtol)
@@ -244,14 +262,17 @@ def _observed_fisher_information(params, data, demo_func, psd_rtol, assert_psd=T
     return ret
 
 
-def _observed_score_covariance(method, params, seg_sites, demo_func, psd_rtol, **kwargs):
+def _observed_score_covariance(method, params, seg_sites, demo_func, psd_rtol, n_workers=None, batch_size=1000, **kwargs):
     if method == "long":
         if "mut_rate" in kwargs:
             raise NotImplementedError(
                 "'long' godambe method not implemented for Poisson approximation")
-        ret = _long_score_cov(params, seg_sites, demo_func, **kwargs)
+        ret = _long_score_cov(params, seg_sites, demo_func,
+                              n_workers=n_workers, **kwargs)
     elif method == "many":
-        ret = _many_score_cov(params, seg_sites, demo_func, **kwargs)
+        ret = _many_score_cov(params, seg_sites, demo_func,
+                              batch_size=batch_size, n_workers=n_workers,
+                              **kwargs)
     else:
         raise Exception("Unrecognized method")
 
@@ -262,25 +283,18 @@ def _observed_score_covariance(method, params, seg_sites, demo_func, psd_rtol, *
     return ret
 
 
-def _many_score_cov(params, data, demo_func, **kwargs):
-    params = np.array(params)
-
-    def f_vec(x):
-        ret = _composite_log_likelihood(
-            data, demo_func(*x), vector=True, **kwargs)
-        # centralize
-        return ret - np.mean(ret)
+def _many_score_cov(params, data, demo_func, batch_size=1000, truncate_probs=0.0, n_workers=None, **kwargs):
+    # the per-locus scores are computed by streaming over batches
+    # of configs, see SfsLikelihoodSurface._locus_scores(),
+    # with the batches spread over n_workers threads
+    surface = SfsLikelihoodSurface(
+        data, demo_func=demo_func, truncate_probs=truncate_probs,
+        batch_size=batch_size, eval_cache_size=0, n_threads=n_workers,
+        **kwargs)
+    return surface._score_cov(params)
 
-    # g_out = einsum('ij,ik', jacobian(f_vec)(params), jacobian(f_vec)(params))
-    # but computed in a roundabout way because jacobian implementation is slow
-    def _g_out_antihess(x):
-        l = f_vec(x)
-        lc = make_constant(l)
-        return np.sum(0.5 * (l**2 - l * lc - lc * l))
-    return autograd.hessian(_g_out_antihess)(params)
 
-
-def _long_score_cov(params, seg_sites, demo_func, **kwargs):
+def _long_score_cov(params, seg_sites, demo_func, n_workers=None, **kwargs):
     if "mut_rate" in kwargs:
         raise NotImplementedError(
             "Currently only implemented for multinomial composite likelihood")
@@ -293,7 +307,7 @@ def _long_score_cov(params, seg_sites, demo_func, **kwargs):
 
     def snp_log_probs(x):
         ret = np.log(expected_sfs(
-            demo_func(*x), configs, normalized=True, **kwargs))
+            _make_demo(demo_func, x), configs, normalized=True, **kwargs))
         return ret - np.sum(weights * ret)  # subtract off mean
 
     # g_out = sum(autocov(einsum("ij,ik->ikj",jacobian(idx_series), jacobian(idx_series))))
@@ -323,12 +337,11 @@ def _long_score_cov(params, seg_sites, demo_func, **kwargs):
             curr = curr[0] + 2.0 * np.sum(curr[1:int(np.sqrt(L))])
             ret = ret + curr
         return ret
-    g_out = autograd.hessian(g_out_antihess)(params)
-    g_out = 0.5 * (g_out + np.transpose(g_out))
+    g_out = hessian_from_hvps(g_out_antihess, params, n_workers=n_workers)
     return g_out
 
 
-def _project_scores(simulated_scores, fisher_information, polyhedral_cone, psd_rtol, init_vals=None, method="tnc"):
+def _project_scores(simulated_scores, fisher_information, polyhedral_cone, psd_rtol, init_vals=None, method="active_set"):
     """
     Under usual theory, the score is asymptotically
     Gaussian, with covariance == Fisher information.
@@ -361,6 +374,10 @@ def _project_scores(simulated_scores, fisher_information, polyhedral_cone, psd_r
             0: parameter == 0
             1: parameter is >= 0
             -1: parameter is <= 0
+    init_vals: starting values for the location MLEs
+    method: "active_set" to solve for all simulations at once
+        (see _cone_qp), otherwise a method of scipy.optimize.minimize,
+        to solve for each simulation separately
     """
     if init_vals is None:
         init_vals = np.zeros(simulated_scores.shape)
@@ -395,27 +412,133 @@ def _project_scores(simulated_scores, fisher_information, polyhedral_cone, psd_r
                                          np.dot(mles, fisher_information))
             return liks, mles
 
-        bounds = []
-        for c in polyhedral_cone:
-            assert c in (None, -1, 1)
-            if c == -1:
-                bounds += [(None, 0)]
-            elif c == 1:
-                bounds += [(0, None)]
-            else:
-                bounds += [(None, None)]
-
         assert init_vals.shape == simulated_scores.shape
-
-        def obj(x):
-            return -np.dot(z, x) + .5 * np.dot(x, np.dot(fisher_information, x))
-
-        def jac(x):
-            return -z + np.dot(fisher_information, x)
-        sols = []
-        for z, i in zip(simulated_scores, init_vals):
-            sols += [scipy.optimize.minimize(obj, i,
-                                             method=method, jac=jac, bounds=bounds)]
-        liks = np.array([-s.fun for s in sols])
-        mles = np.array([s.x for s in sols])
+        assert all(c in (None, -1, 1) for c in polyhedral_cone)
+
+        if method != "active_set":
+            return _minimize_scores(simulated_scores, fisher_information,
+                                    polyhedral_cone, init_vals, method)
+
+        liks, mles, converged = _cone_qp(
+            simulated_scores, fisher_information, polyhedral_cone, init_vals)
+        if not np.all(converged):
+            logger.warning(
+                "Active set method did not converge for {} of {} simulations, "
+                "using scipy.optimize.minimize for them".format(
+                    np.sum(~converged), len(converged)))
+            liks[~converged], mles[~converged] = _minimize_scores(
+                simulated_scores[~converged], fisher_information,
+                polyhedral_cone, init_vals[~converged], "tnc")
         return liks, mles
+
+
+def _minimize_scores(simulated_scores, fisher_information, polyhedral_cone, init_vals, method):
+    # solves the quadratic program separately for each simulation
+    bounds = []
+    for c in polyhedral_cone:
+        if c == -1:
+            bounds += [(None, 0)]
+        elif c == 1:
+            bounds += [(0, None)]
+        else:
+            bounds += [(None, None)]
+
+    def obj(x):
+        return -np.dot(z, x) + .5 * np.dot(x, np.dot(fisher_information, x))
+
+    def jac(x):
+        return -z + np.dot(fisher_information, x)
+    sols = []
+    for z, i in zip(simulated_scores, init_vals):
+        sols += [scipy.optimize.minimize(obj, i,
+                                         method=method, jac=jac, bounds=bounds)]
+    liks = np.array([-s.fun for s in sols])
+    mles = np.array([s.x for s in sols])
+    return liks, mles
+
+
+def _cone_qp(simulated_scores, fisher_information, polyhedral_cone, init_vals, max_iter=None):
+    """
+    Maximizes z*x - x*Fisher*x / 2 over x on the polyhedral cone
+    (entries of polyhedral_cone are None, 1, -1), for every row z of
+    simulated_scores at once.
+
+    Uses the primal active set method, vectorized over the simulations:
+    at each iteration, the simulations are grouped by their active set
+    (the constrained parameters fixed at 0), and the equality-constrained
+    problem of each group is solved with one pseudoinverse of
+    the Fisher information restricted to its free parameters.
+    So the cost per iteration is a matrix product over all simulations,
+    plus a small linear solve for each distinct active set.
+
+    For positive definite Fisher information, this terminates
+    at the exact solution in a finite number of iterations.
+
+    Returns the maximized values, the maximizers, and a boolean array
+    of which simulations converged within max_iter iterations.
+    """
+    n_sims, n_params = simulated_scores.shape
+    if max_iter is None:
+        max_iter = 10 * n_params + 100
+
+    # flip the sign of the -1 parameters, so the constraints are all y >= 0
+    flip = np.array([-1.0 if c == -1 else 1.0 for c in polyhedral_cone])
+    constrained = np.array([c is not None for c in polyhedral_cone])
+    fisher_information = fisher_information * np.outer(flip, flip)
+    scores = simulated_scores * flip
+
+    # feasible starting point
+    y = init_vals * flip
+    y[:, constrained] = np.maximum(y[:, constrained], 0)
+    active = constrained & (y <= 0)
+    y[active] = 0
+
+    scale = 1.0 + np.max(np.abs(scores), axis=1)
+    converged = np.zeros(n_sims, dtype=bool)
+    for _ in range(max_iter):
+        todo, = np.where(~converged)
+        if len(todo) == 0:
+            break
+        todo_active = active[todo]
+
+        # the minimizer of each subproblem, with the active set fixed at 0
+        target = np.zeros((len(todo), n_params))
+        patterns, group = np.unique(todo_active, axis=0, return_inverse=True)
+        group = np.reshape(group, -1)
+        for k, pattern in enumerate(patterns):
+            rows = group == k
+            free = ~pattern
+            if not np.any(free):
+                continue
+            free_inv = np.linalg.pinv(fisher_information[np.ix_(free, free)])
+            target[np.ix_(rows, free)] = np.dot(
+                scores[todo][np.ix_(rows, free)], free_inv)
+
+        # move towards the subproblem minimizer, until hitting a constraint
+        step = target - y[todo]
+        blocking = constrained & ~todo_active & (step < 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratios = np.where(blocking, -y[todo] / step, np.inf)
+        block_idx = np.argmin(ratios, axis=1)
+        alpha = np.minimum(ratios[np.arange(len(todo)), block_idx], 1.0)
+        y[todo] += alpha[:, None] * step
+
+        # add the blocking constraint to the active set
+        blocked = alpha < 1.0
+        active[todo[blocked], block_idx[blocked]] = True
+        y[todo[blocked], block_idx[blocked]] = 0
+
+        # at the subproblem minimizer: check the Lagrange multipliers,
+        # and release the constraint with the most negative one
+        unblocked = todo[~blocked]
+        grad = np.dot(y[unblocked], fisher_information) - scores[unblocked]
+        multipliers = np.where(active[unblocked], grad, np.inf)
+        release_idx = np.argmin(multipliers, axis=1)
+        min_multiplier = multipliers[np.arange(len(unblocked)), release_idx]
+        optimal = min_multiplier >= -1e-10 * scale[unblocked]
+        converged[unblocked[optimal]] = True
+        active[unblocked[~optimal], release_idx[~optimal]] = False
+
+    liks = np.einsum("ij,ij->i", y, scores)
+    liks = liks - .5 * np.einsum("ij,ij->i", y, np.dot(y, fisher_information))
+    return liks, y * flip, converged
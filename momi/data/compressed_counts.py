@@ -63,6 +63,25 @@ class _CompressedList(object):
         for i in iterator:
             self.append(i)
 
+    @classmethod
+    def from_array(cls, values):
+        """
+        Build from a 1d array of hashable values,
+        without appending the values one at a time.
+        """
+        uniq, first_idxs, inverse = np.unique(
+            values, return_index=True, return_inverse=True)
+        # order unique values by first appearance, as append() does
+        order = np.argsort(first_idxs)
+        rank = np.empty(len(order), dtype=int)
+        rank[order] = np.arange(len(order))
+
+        ret = cls()
+        ret.uniq_values = [v.item() for v in uniq[order]]
+        ret.value2uniq = {v: i for i, v in enumerate(ret.uniq_values)}
+        ret.index2uniq = list(rank[inverse])
+        return ret
+
 
 class _CompressedHashedCounts(object):
     def __init__(self, npops):
@@ -103,6 +122,24 @@ class CompressedAlleleCounts(object):
                    compressed_hashes.index2uniq(),
                    sort=sort)
 
+    @classmethod
+    def from_array(cls, configs, sort=True):
+        """
+        Build from an array of configs with shape
+        [n_snps, n_pops, 2], without hashing each config.
+        """
+        configs = np.asarray(configs, dtype=int)
+        n_snps, npops, _ = configs.shape
+        uniq, first_idxs, inverse = np.unique(
+            np.reshape(configs, (n_snps, npops * 2)), axis=0,
+            return_index=True, return_inverse=True)
+        # order unique configs by first appearance, as from_iter() does
+        order = np.argsort(first_idxs)
+        rank = np.empty(len(order), dtype=int)
+        rank[order] = np.arange(len(order))
+        return cls(np.reshape(uniq[order], (len(order), npops, 2)),
+                   rank[np.ravel(inverse)], sort=sort)
+
     def __init__(self, config_array, index2uniq,
                  sort=True):
         self.config_array = config_array
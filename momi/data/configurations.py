@@ -3,7 +3,7 @@ import autograd.numpy as np
 from scipy.special import comb
 import scipy.stats
 from .compressed_counts import _config2hashable
-from ..util import memoize_instance
+from ..util import memoize_instance, memoize
 
 
 def build_config_list(sampled_pops, counts, sampled_n=None, ascertainment_pop=None):
@@ -44,6 +44,15 @@ def build_full_config_list(sampled_pops, sampled_n, ascertainment_pop=None):
         ascertainment_pop=ascertainment_pop)
 
 
+
+@memoize
+def _binom_table(max_n):
+    # _binom_table(max_n)[k, j] = comb(k, j), for 0 <= j, k <= max_n
+    k = np.arange(max_n + 1)
+    ret = comb(k[:, None], k[None, :])
+    ret.setflags(write=False)
+    return ret
+
 class ConfigList(object):
     """
     Stores a list of configs. Important methods/attributes:
@@ -125,29 +134,43 @@ class ConfigList(object):
         total_counts_dict: dict mapping pop to n_pop
         derived_weights_dict: dict mapping pop to list of floats
            with length n_pop+1, giving the weight for each
-           derived allele count
+           derived allele count. Can also be an array with shape
+           (n_pop+1, n_weights), to count with n_weights different
+           weights at once.
 
         Returns
-        numpy.ndarray of weighted counts for each config
+        numpy.ndarray of weighted counts for each config,
+        with shape (n_configs,), or (n_configs, n_weights) if
+        any of the weights have n_weights columns
         """
         assert (set(derived_weights_dict.keys())
                 <= set(total_counts_dict.keys()))
 
-        ret = np.ones(len(self))
+        derived_weights_dict = {p: np.array(w, dtype=float)
+                                for p, w in derived_weights_dict.items()}
+        weights_shape = np.broadcast(*(
+            [np.empty(())] + [np.empty(w.shape[1:])
+                              for w in derived_weights_dict.values()])).shape
+
+        binom = _binom_table(int(max(
+            [np.max(self.sampled_n)] + list(total_counts_dict.values()))))
+
+        ret = np.ones((len(self),) + weights_shape)
         for p, n in total_counts_dict.items():
             i = self.sampled_pops.index(p)
+            anc, der = self.value[:, i, 0], self.value[:, i, 1]
             if p in derived_weights_dict:
-                curr = np.zeros(len(self))
-                assert len(derived_weights_dict[p]) == n+1
-                for d, w in enumerate(derived_weights_dict[p]):
-                    if w == 0:
-                        continue
-                    a = n - d
-                    curr += w * (comb(self.value[:, i, 0], a)
-                                 * comb(self.value[:, i, 1], d))
-                ret *= curr
+                w = derived_weights_dict[p]
+                assert len(w) == n+1
+                # subsets[c, d] is the number of subsets of config c
+                # with d derived alleles
+                d = np.arange(n+1)
+                subsets = binom[anc[:, None], n - d] * binom[der[:, None], d]
+                curr = np.dot(subsets, w)
             else:
-                ret *= comb(self.value[:, i, :].sum(axis=1), n)
+                curr = binom[anc + der, n]
+            ret = ret * np.reshape(
+                curr, curr.shape + (1,) * (ret.ndim - curr.ndim))
         return ret
 
     def subsample_probs(self, subconfig):
@@ -159,14 +182,17 @@ class ConfigList(object):
         total_counts_dict = {p: n for p, n in zip(self.sampled_pops,
                                                   subconfig.sum(axis=1))
                              if n > 0}
-        derived_counts_dict = {p: [0]*(n+1)
+        # the first column counts the subsets equal to subconfig,
+        # and the second column counts all the subsets
+        derived_counts_dict = {p: np.ones((n+1, 2))
                                for p, n in total_counts_dict.items()}
         for p, d in zip(self.sampled_pops, subconfig[:, 1]):
             if p in derived_counts_dict:
-                derived_counts_dict[p][d] = 1
+                derived_counts_dict[p][:, 0] = 0
+                derived_counts_dict[p][d, 0] = 1
 
-        num = self.count_subsets(derived_counts_dict, total_counts_dict)
-        denom = self.count_subsets({}, total_counts_dict)
+        counts = self.count_subsets(derived_counts_dict, total_counts_dict)
+        num, denom = counts[:, 0], counts[:, 1]
 
         # avoid 0/0
         assert np.all(num[denom == 0] == 0)
@@ -195,26 +221,17 @@ class ConfigList(object):
         augmented_configs = self._augmented_configs(folded)
         augmented_idxs = self._augmented_idxs(folded)
 
-        # construct the vecs
-        vecs = [np.zeros((len(augmented_configs), n + 1))
-                for n in self.sampled_n]
-
-        for i in range(len(vecs)):
-            n = self.sampled_n[i]
-            derived = np.einsum(
-                "i,j->ji", np.ones(len(augmented_configs)), np.arange(n + 1))
-            curr = scipy.stats.hypergeom.pmf(
-                    k=augmented_configs[:, i, 1],
-                    M=n,
-                    n=derived,
-                    N=augmented_configs[:, i].sum(1)
-                )
-            assert not np.any(np.isnan(curr))
-            vecs[i] = np.transpose(curr)
+        vecs = _leaf_vecs(augmented_configs, self.sampled_n)
 
         # copy augmented_idxs to make it safe
         return vecs, dict(augmented_idxs)
 
+    @memoize_instance
+    def _augmented_vecs(self, folded):
+        # the vecs of all augmented configs, shared by
+        # the _ConfigList_Subset views with share_vecs=True
+        return _leaf_vecs(self._augmented_configs(folded), self.sampled_n)
+
     # def _config_str_iter(self):
     #     for c in self.value:
     #         yield _config2hashable(c)
@@ -311,11 +328,43 @@ class ConfigList(object):
         return np.array(augmented_configs, dtype=int), idxs
 
 
+def _leaf_vecs(augmented_configs, sampled_n):
+    # construct the vecs
+    vecs = [np.zeros((len(augmented_configs), n + 1))
+            for n in sampled_n]
+
+    for i in range(len(vecs)):
+        n = sampled_n[i]
+        derived = np.einsum(
+            "i,j->ji", np.ones(len(augmented_configs)), np.arange(n + 1))
+        curr = scipy.stats.hypergeom.pmf(
+                k=augmented_configs[:, i, 1],
+                M=n,
+                n=derived,
+                N=augmented_configs[:, i].sum(1)
+            )
+        assert not np.any(np.isnan(curr))
+        vecs[i] = np.transpose(curr)
+    return vecs
+
+
 class _ConfigList_Subset(ConfigList):
-    # Efficient access to subset of configs
-    def __init__(self, configs, sub_idxs):
-        self.sub_idxs = sub_idxs
+    # Efficient access to subset of configs.
+    # A subset of a subset is a view into the same full ConfigList,
+    # so the augmented configs and index maps of the full ConfigList
+    # are computed once.
+    # If share_vecs, the vecs are also computed once for the full
+    # ConfigList, instead of for each subset
+    # (e.g. for the many minibatches of stochastic optimization).
+    def __init__(self, configs, sub_idxs, share_vecs=None):
+        if isinstance(configs, _ConfigList_Subset):
+            sub_idxs = configs.sub_idxs[sub_idxs]
+            if share_vecs is None:
+                share_vecs = configs.share_vecs
+            configs = configs.full_configs
+        self.sub_idxs = np.asarray(sub_idxs, dtype=int)
         self.full_configs = configs
+        self.share_vecs = bool(share_vecs)
         for a in ("sampled_n", "sampled_pops",
                   "has_missing_data", "ascertainment_pop"):
             setattr(self, a, getattr(self.full_configs, a))
@@ -354,22 +403,34 @@ class _ConfigList_Subset(ConfigList):
     def _augmented_idxs(self, folded):
         return self._build_old_new_idxs(folded)[1]
 
+    def _vecs_and_idxs(self, folded):
+        if not self.share_vecs:
+            return super(_ConfigList_Subset, self)._vecs_and_idxs(folded)
+        old_idxs, idxs = self._build_old_new_idxs(folded)
+        vecs = [v[old_idxs, :]
+                for v in self.full_configs._augmented_vecs(folded)]
+        # copy idxs to make it safe
+        return vecs, dict(idxs)
+
     @memoize_instance
     def _build_old_new_idxs(self, folded):
         idxs = self.full_configs._augmented_idxs(folded)
 
         denom_idx_key = 'denom_idx'
         denom_idx = idxs[denom_idx_key]
-        idxs = {k: v[self.sub_idxs]
-                for k, v in list(idxs.items()) if k != denom_idx_key}
-
-        old_idxs = np.array(
-            list(set(sum(map(list, idxs.values()), [denom_idx]))))
-        old_2_new_idxs = {old_id: new_id for new_id,
-                          old_id in enumerate(old_idxs)}
-
-        idxs = {k: np.array([old_2_new_idxs[old_id]
-                             for old_id in v], dtype=int)
-                for k, v in list(idxs.items())}
-        idxs[denom_idx_key] = old_2_new_idxs[denom_idx]
-        return old_idxs, idxs
+        keys = [k for k in idxs.keys() if k != denom_idx_key]
+
+        # the rows of the full augmented configs used by the subset,
+        # and the positions of each index among them
+        old_idxs, new_idxs = np.unique(
+            np.concatenate([[denom_idx]] + [
+                idxs[k][self.sub_idxs] for k in keys]),
+            return_inverse=True)
+        new_idxs = new_idxs.reshape(-1)
+
+        ret = {denom_idx_key: new_idxs[0]}
+        start = 1
+        for k in keys:
+            ret[k] = new_idxs[start:(start + len(self.sub_idxs))]
+            start += len(self.sub_idxs)
+        return old_idxs, ret
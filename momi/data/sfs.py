@@ -6,6 +6,7 @@ import numpy as raw_np
 from cached_property import cached_property
 import scipy
 import scipy.sparse
+import scipy.sparse.linalg
 import gzip
 import os
 import logging
@@ -241,15 +242,18 @@ class Sfs(object):
     @cached_property
     def avg_pairwise_hets(self):
         # avg number of hets per ind per pop (assuming Hardy-Weinberg)
+        return self.freqs_matrix.T.dot(self._pairwise_het_probs)
+
+    @cached_property
+    def _pairwise_het_probs(self):
+        # probability of a het per ind per pop, for each config
         n_nonmissing = np.sum(self.configs.value, axis=2)
         # for denominator, assume 1 allele is drawn from whole sample, and 1
         # allele is drawn only from nomissing alleles
         denoms = np.maximum(n_nonmissing * (self.sampled_n - 1), 1.0)
-        p_het = 2 * self.configs.value[:, :, 0] * \
+        return 2 * self.configs.value[:, :, 0] * \
             self.configs.value[:, :, 1] / denoms
 
-        return self.freqs_matrix.T.dot(p_het)
-
     def resample(self):
         """Create a new SFS by resampling blocks with replacement.
 
@@ -269,6 +273,72 @@ class Sfs(object):
 
         return self.from_matrix(mat, configs, self.folded, self.length)
 
+    def bootstrap_weights(self, n_reps, rgen=np.random):
+        """Locus weights for bootstrap replicates.
+
+        Each replicate resamples the loci with replacement, \
+        as in :meth:`Sfs.resample`. Use with :meth:`Sfs.replicate_counts` \
+        to evaluate all replicates at once, instead of creating \
+        a new :class:`Sfs` for each one.
+
+        :param int n_reps: Number of bootstrap replicates
+        :param numpy.random.RandomState rgen: Random generator
+        :returns: Sparse matrix with shape ``(n_loci, n_reps)``, \
+        whose ``(i,j)``-th entry is the number of times locus ``i`` \
+        is resampled in replicate ``j``
+        :rtype: :class:`scipy.sparse.csc_matrix`
+        """
+        loci = rgen.randint(self.n_loci, size=(n_reps, self.n_loci))
+        reps = raw_np.repeat(raw_np.arange(n_reps), self.n_loci)
+        # duplicate entries are summed
+        return scipy.sparse.csc_matrix(
+            (raw_np.ones(loci.size), (loci.reshape(-1), reps)),
+            shape=(self.n_loci, n_reps))
+
+    def jackknife_weights(self):
+        """Locus weights for leave-one-out jackknife replicates.
+
+        The weights are all 1 except on the diagonal, so they are \
+        kept implicit rather than stored as a dense matrix.
+
+        :returns: Linear operator with shape ``(n_loci, n_loci)``, \
+        whose ``j``-th column leaves out locus ``j``
+        :rtype: :class:`scipy.sparse.linalg.LinearOperator`
+        """
+        def leave_one_out(v):
+            # v has shape (n_loci,) or (n_loci, k)
+            return v.sum(axis=0, keepdims=True) - v
+        return scipy.sparse.linalg.LinearOperator(
+            (self.n_loci, self.n_loci), matvec=leave_one_out,
+            rmatvec=leave_one_out, matmat=leave_one_out,
+            rmatmat=leave_one_out, dtype=float)
+
+    def replicate_counts(self, locus_weights):
+        """Counts of each config in replicates of the data, \
+        given by weighted sums of the loci.
+
+        :param locus_weights: Matrix with shape ``(n_loci, n_reps)``, \
+        e.g. from :meth:`Sfs.bootstrap_weights` or \
+        :meth:`Sfs.jackknife_weights`
+        :returns: Sparse matrix with shape ``(n_configs, n_reps)``, \
+        whose ``(i,j)``-th entry is the count of the ``i``-th config \
+        in :attr:`Sfs.config_array` in replicate ``j``. \
+        If ``locus_weights`` is a \
+        :class:`scipy.sparse.linalg.LinearOperator`, \
+        the counts are returned as a \
+        :class:`scipy.sparse.linalg.LinearOperator` too, \
+        which only supports products such as ``.dot()``, \
+        not sparse matrix methods like ``.tocsc()`` or slicing. \
+        See also :meth:`SfsLikelihoodSurface.log_lik_replicates`
+        :rtype: :class:`scipy.sparse.csr_matrix` or \
+        :class:`scipy.sparse.linalg.LinearOperator`
+        """
+        if isinstance(locus_weights, scipy.sparse.linalg.LinearOperator):
+            return scipy.sparse.linalg.aslinearoperator(
+                self.freqs_matrix).dot(locus_weights)
+        return scipy.sparse.csr_matrix(
+            self.freqs_matrix.dot(locus_weights))
+
     @property
     def sampled_n(self):
         """Number of samples per population
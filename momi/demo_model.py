@@ -1,7 +1,12 @@
 import json
+import os
+import itertools
+import pickle
+import multiprocessing
+import concurrent.futures
 import autograd as ag
 import autograd.numpy as np
-import scipy, scipy.stats
+import scipy, scipy.stats, scipy.sparse
 import logging
 import collections as co
 import pandas as pd
@@ -11,13 +16,19 @@ import seaborn
 from .sfs_stats import JackknifeGoodnessFitStat
 from .data.configurations import build_config_list
 from .data.sfs import Sfs
-from .demography import Demography
-from .likelihood import SfsLikelihoodSurface
+from .data.configurations import _ConfigList_Subset
+from .demography import Demography, _DemographyTemplate
+from .likelihood import SfsLikelihoodSurface, _load_stochastic_checkpoint
+from .util import load_checkpoint, _CheckpointWriter
 from .compute_sfs import expected_total_branch_len, expected_sfs, expected_heterozygosity
 from .confidence_region import _ConfidenceRegion
 from .events import LeafEvent, SizeEvent, JoinEvent, PulseEvent, GrowthEvent
 from .events import Parameter, ParamsDict
-from .events import _build_demo_graph
+from .events import (
+    IdentityTransform, LogTransform, ExpTransform,
+    LogitTransform, ExpitTransform, TimeBounds,
+    TimeTransform, TimeUntransform, ConstantRgen,
+    UniformRgen, TruncExponRgen, TimeRgen)
 from .demo_plotter import DemographyPlotter
 from .sfs_stats import SfsModelFitStats
 
@@ -40,6 +51,7 @@ class DemographicModel(object):
         self.N_e = N_e
         self.gen_time = gen_time
         self.muts_per_gen = muts_per_gen
+        self.admixture_tol = None
 
         self.parameters = co.OrderedDict()
         self.topology_events = []
@@ -47,10 +59,16 @@ class DemographicModel(object):
         self.leaf_events = []
         self.leafs = []
 
+        # compiled demographies, keyed by the order of events
+        self._demo_templates = co.OrderedDict()
+        self._max_demo_templates = 32
+
         self._set_data(sfs=None, length=None,
                        mem_chunk_size=None,
                        use_pairwise_diffs=None,
-                       non_ascertained_pops=None)
+                       non_ascertained_pops=None,
+                       memory_budget=None,
+                       n_threads=None)
 
     def set_mut_rate(self, muts_per_gen):
         """Set the mutation rate.
@@ -59,9 +77,43 @@ class DemographicModel(object):
         """
         self.muts_per_gen = muts_per_gen
 
+    def set_admixture_tol(self, admixture_tol):
+        """Use a banded approximation to the admixture pulses.
+
+        Each admixture pulse sends a Binomial number of lineages
+        to the donor population. If ``admixture_tol`` is set,
+        lineage counts in the tails of this distribution,
+        with total probability at most ``admixture_tol``, are
+        discarded, which reduces the cost of computing the
+        pulse for large sample sizes.
+        The discarded mass is reported in the debug log,
+        and by :attr:`Demography.admixture_discarded_mass`.
+
+        :param float,None admixture_tol: Probability mass to discard \
+        per pulse. If None (the default), pulses are computed exactly.
+        """
+        if admixture_tol is not None and not 0 <= admixture_tol < 1:
+            raise ValueError("admixture_tol must be in [0, 1)")
+        self.admixture_tol = admixture_tol
+
+    def _model_changed(self):
+        # the likelihood surface caches its evaluations by the
+        # parameter vector, which stays the same when the events change,
+        # so it must be rebuilt
+        self._lik_surface = None
+        self._conf_region = None
+
+    def __setattr__(self, name, value):
+        # the public attributes (N_e, muts_per_gen, ...) can also be
+        # assigned directly, which changes the model as well
+        if not name.startswith("_"):
+            self._model_changed()
+        super(DemographicModel, self).__setattr__(name, value)
+
     def copy(self):
         ret = DemographicModel(self.N_e, self.gen_time,
                                self.muts_per_gen)
+        ret.admixture_tol = self.admixture_tol
         for k, v in self.parameters.items():
             ret.parameters[k] = v.copy()
         ret.topology_events.extend(self.topology_events)
@@ -71,9 +123,28 @@ class DemographicModel(object):
         ret._set_data(sfs=self._fullsfs, length=self._length,
                       mem_chunk_size=self._mem_chunk_size,
                       use_pairwise_diffs=self._use_pairwise_diffs,
-                      non_ascertained_pops=self._non_ascertained_pops)
+                      non_ascertained_pops=self._non_ascertained_pops,
+                      memory_budget=self._memory_budget,
+                      n_threads=self._n_threads)
         return ret
 
+    def __getstate__(self):
+        # compiled demographies and likelihood surfaces are
+        # rebuilt lazily, so don't send them to other processes
+        state = dict(self.__dict__)
+        state["_demo_templates"] = co.OrderedDict()
+        state["_lik_surface"] = None
+        state["_conf_region"] = None
+        state["_subsfs"] = None
+        return state
+
+    def _get_spec(self):
+        """
+        Returns a picklable :class:`_DemographicModelSpec` of the
+        events, parameters, and data settings, without the data itself.
+        """
+        return _DemographicModelSpec(self)
+
     def set_params(self, new_params=None, randomize=False,
                    scaled=False):
         """Set the current parameter values
@@ -148,12 +219,18 @@ class DemographicModel(object):
         ``scale_transform``
         :param float scaled_upper: Upper bound after scaling by \
         ``scale_transform``
+
+        To send the model to worker processes, ``rgen``, \
+        ``scale_transform``, and ``unscale_transform`` must be \
+        picklable, i.e. module-level functions or objects rather \
+        than lambdas or closures; see the built-in transforms \
+        in :mod:`momi.events`.
         """
-        self._conf_region = None
+        self._model_changed()
 
         assert (scale_transform is None) == (unscale_transform is None)
         if scale_transform is None:
-            unscale_transform = scale_transform = lambda x, p: x
+            unscale_transform = scale_transform = IdentityTransform()
 
         curr_params = self.get_params()
         x_lower = scaled_lower
@@ -162,8 +239,7 @@ class DemographicModel(object):
         if rgen is None and start_value is None:
             raise ValueError("At least one of rgen, start_value must be specified")
         elif rgen is None:
-            def rgen(params):
-                return start_value
+            rgen = ConstantRgen(start_value)
         elif start_value is None:
             start_value = rgen(curr_params)
 
@@ -190,20 +266,15 @@ class DemographicModel(object):
         value. If None, a truncated exponential with rate ``1 / N_e``
         """
         if rgen is None:
-            scale = self.N_e
-            truncexpon = scipy.stats.truncexpon(b=(upper-lower)/scale,
-                                                loc=lower, scale=scale)
-            def rgen(params):
-                return truncexpon.rvs()
+            rgen = TruncExponRgen(lower, upper, scale=self.N_e)
 
-        def scale_transform(x, p):
-            return np.log(x)
+        scale_transform = LogTransform()
 
         self.add_parameter(name, N0,
                            scaled_lower=scale_transform(lower, None),
                            scaled_upper=scale_transform(upper, None),
                            scale_transform=scale_transform,
-                           unscale_transform=lambda x, p: np.exp(x),
+                           unscale_transform=ExpTransform(),
                            rgen=rgen)
 
     def add_time_param(self, name, t0=None,
@@ -225,60 +296,16 @@ class DemographicModel(object):
         ``1 / (N_e * gen_time)`` constrained to satisfy the bounds \
         and constraints.
         """
-        def lower_bound(params):
-            constraints = [params[k] for k in lower_constraints]
-            constraints.append(lower)
-            return np.max(np.array(constraints))
-
-        def upper_bound(params):
-            constraints = [params[k] for k in upper_constraints]
-            if upper is not None:
-                constraints.append(upper)
-            return np.min(np.array(constraints))
-
-        has_upper = (len(upper_constraints) > 0) or (upper is not None)
+        bounds = TimeBounds(lower, upper,
+                            lower_constraints, upper_constraints)
+        has_upper = bounds.has_upper
 
-        def scale_transform(t, params):
-            l = lower_bound(params)
-            if t < l:
-                raise ValueError(
-                    "t = {} < {} = max({})".format(
-                        t, l, [lower] + list(lower_constraints)))
-            if has_upper:
-                u = upper_bound(params)
-                if t > u:
-                    raise ValueError(
-                        "t = {} > {} = min({})".format(
-                            t, u, [upper] + list(upper_constraints)))
-
-                x = (t - l) / (u - l)
-                x = np.log(x/(1.-x))
-                return x
-            else:
-                x = t - l
-                return x
-
-        def unscale_transform(x, params):
-            l = lower_bound(params)
-            if has_upper:
-                x = 1./(1.+np.exp(-x))
-                u = upper_bound(params)
-                return (1-x)*l + x*u
-            else:
-                return l + x
+        scale_transform = TimeTransform(bounds)
+        unscale_transform = TimeUntransform(bounds)
 
         if rgen is None:
-            scale = self.N_e * self.gen_time  # average time to coalescence
-
-            def rgen(params):
-                l = lower_bound(params)
-                if has_upper:
-                    u = upper_bound(params)
-                    b = (u-l)/scale
-                else:
-                    b = float("inf")
-                truncexpon = scipy.stats.truncexpon(b=b, loc=l, scale=scale)
-                return truncexpon.rvs()
+            # average time to coalescence
+            rgen = TimeRgen(bounds, scale=self.N_e * self.gen_time)
 
         if has_upper:
             self.add_parameter(
@@ -306,11 +333,9 @@ class DemographicModel(object):
         If None, use a uniform distribution.
         """
         if rgen is None:
-            def rgen(params):
-                return np.random.uniform(lower, upper)
+            rgen = UniformRgen(lower, upper)
 
-        def scale_transform(x, params):
-            return np.log(x/np.array(1-x))
+        scale_transform = LogitTransform()
 
         if lower == 0:
             # avoid log(0)
@@ -328,7 +353,7 @@ class DemographicModel(object):
                            scaled_lower=scaled_lower,
                            scaled_upper=scaled_upper,
                            scale_transform=scale_transform,
-                           unscale_transform=lambda x, params: 1/(1+np.exp(-x)),
+                           unscale_transform=ExpitTransform(),
                            rgen=rgen)
 
     def add_growth_param(self, name, g0=None, lower=-.001, upper=.001,
@@ -344,8 +369,7 @@ class DemographicModel(object):
         If None, use uniform distribution
         """
         if rgen is None:
-            def rgen(params):
-                return np.random.uniform(lower, upper)
+            rgen = UniformRgen(lower, upper)
         self.add_parameter(name, g0, scaled_lower=lower, scaled_upper=upper,
                            rgen=rgen)
 
@@ -369,6 +393,7 @@ class DemographicModel(object):
         :param float,str g: Population growth rate
 
         """
+        self._model_changed()
         self.leafs.append(pop_name)
 
         self.leaf_events.append(LeafEvent(
@@ -398,6 +423,7 @@ class DemographicModel(object):
         :param float,str N: Population size of pop_to
         :param float,str g: Growth rate of pop_to
         """
+        self._model_changed()
         if p == 1:
             self.topology_events.append((JoinEvent(
                 t, pop_from, pop_to, self.N_e, self.gen_time)))
@@ -427,6 +453,7 @@ class DemographicModel(object):
         :param float,str N: Population size
         :param float,str g: Growth rate
         """
+        self._model_changed()
         if N is not None:
             self.size_events.append(SizeEvent(
                 t, N, pop_name, self.N_e, self.gen_time))
@@ -466,7 +493,7 @@ class DemographicModel(object):
 
     def simulate_data(self, length, recoms_per_gen,
                       num_replicates, muts_per_gen=None,
-                      sampled_n_dict=None, **kwargs):
+                      sampled_n_dict=None, n_workers=None, **kwargs):
         """Simulate data, using msprime as backend
 
         :param int length: Length of each locus in bases
@@ -476,6 +503,14 @@ class DemographicModel(object):
         :param dict sampled_n_dict: Number of haploids per population. \
         If None, use sample sizes from the current dataset as set by \
         :meth:`DemographicModel.set_data`
+        :param int,None n_workers: If not None, simulate the loci \
+        in a pool of ``n_workers`` processes. Each locus then gets its \
+        own seed drawn from ``random_seed``, so the result does not \
+        depend on ``n_workers``. Note this gives different data than \
+        ``n_workers=None`` for the same ``random_seed``, which seeds \
+        msprime's stream of replicates directly \
+        (as :meth:`DemographicModel.simulate_vcf` does for a single \
+        chromosome).
 
         :returns: Dataset of SNP allele counts
         :rtype: :class:`SnpAlleleCounts`
@@ -490,26 +525,32 @@ class DemographicModel(object):
             recombination_rate=4*self.N_e*recoms_per_gen,
             mutation_rate=4*self.N_e*muts_per_gen,
             num_replicates=num_replicates,
-            **kwargs)
+            n_workers=n_workers, **kwargs)
 
     def simulate_vcf(
             self, out_prefix,
             recoms_per_gen, length,
             muts_per_gen=None, chrom_name="1",
             ploidy=1, random_seed=None,
-            sampled_n_dict=None, **kwargs):
+            sampled_n_dict=None, n_workers=None, **kwargs):
         """Simulate a chromosome using msprime and write it to VCF
 
         :param str,file outfile: Output VCF file. If a string ending in ".gz", gzip it.
         :param float muts_per_gen: Mutation rate per generation per base
         :param float recoms_per_gen: Recombination rate per generation per base
         :param int length: Length of chromosome in bases
-        :param str chrom_name: Name of chromosome
+        :param str,list chrom_name: Name of chromosome. If a list of \
+        names, simulate an independent chromosome of length ``length`` \
+        for each name, and write them all to the same VCF.
         :param int ploidy: Ploidy
         :param int random_seed: Random seed
         :param dict sampled_n_dict: Number of haploids per population. \
         If None, use sample sizes from the current dataset as set by \
         :meth:`DemographicModel.set_data`
+        :param int,None n_workers: Number of processes for simulating \
+        and writing multiple chromosomes concurrently. Each chromosome \
+        gets its own seed drawn from ``random_seed``, so the output does \
+        not depend on ``n_workers``.
         """
         demo = self._get_demo(sampled_n_dict)
         if muts_per_gen is None:
@@ -522,7 +563,7 @@ class DemographicModel(object):
             recombination_rate=4*self.N_e*recoms_per_gen,
             length=length, chrom_name=chrom_name,
             ploidy=ploidy, random_seed=random_seed,
-            **kwargs)
+            n_workers=n_workers, **kwargs)
 
     # TODO rename to get_multipop_moran?
     def _get_demo(self, sampled_n_dict):
@@ -538,8 +579,21 @@ class DemographicModel(object):
                 events.append(e)
 
         events = sorted(events, key=lambda e: e.t(params_dict))
-        G = _build_demo_graph(events, sampled_n_dict, params_dict, default_N=1.0)
-        demo = Demography(G)
+
+        # the graph structure only depends on the order of events,
+        # so reuse it when only the parameter values have changed
+        key = (tuple(events), tuple(sampled_n_dict.items()),
+               self.admixture_tol)
+        try:
+            template = self._demo_templates[key]
+        except KeyError:
+            template = _DemographyTemplate(
+                events, sampled_n_dict, params_dict, default_N=1.0,
+                admixture_tol=self.admixture_tol)
+            self._demo_templates[key] = template
+            if len(self._demo_templates) > self._max_demo_templates:
+                self._demo_templates.popitem(last=False)
+        demo = template.bind(params_dict)
 
         def printable_params():
             for k, v in params_dict.items():
@@ -609,7 +663,9 @@ class DemographicModel(object):
             self, sfs, length=None,
             mem_chunk_size=1000,
             non_ascertained_pops=None,
-            use_pairwise_diffs=True):
+            use_pairwise_diffs=True,
+            memory_budget=None,
+            n_threads=None):
         """Set dataset for the model.
 
         :param Sfs sfs: Observed SFS
@@ -617,6 +673,8 @@ class DemographicModel(object):
         :param mem_chunk_size: Controls memory usage by computing likelihood in chunks of SNPs. If ``-1`` then no chunking is done.
         :param non_ascertained_pops: Don't ascertain SNPs within these populations. That is, ignore all SNPs that are not polymorphic on the other populations. The SFS is adjusted to represent probabilities conditional on this ascertainment scheme.
         :param use_pairwise_diffs: Only has an effect if :attr:`DemoModel.muts_per_gen` is set. If ``False``, assumes the total number of mutations is Poisson. If True, models the within population nucleotide diversity (i.e. the average number of heterozygotes per population) as independent Poissons. If there is missing data this is required to be ``True``.
+        :param int,str,None memory_budget: If set, overrides ``mem_chunk_size``, choosing the chunk size so the likelihood and gradient of each chunk use roughly this much memory, e.g. ``"4GB"``. The memory per SNP is estimated from the demography on the first evaluation, and the resulting plan is logged at level INFO.
+        :param int,None n_threads: If greater than 1, evaluate the chunks of SNPs concurrently on this many threads, dividing the cores evenly between them.
         """
         if not length:
             length = sfs.length
@@ -625,19 +683,26 @@ class DemographicModel(object):
             sfs=sfs, length=length,
             mem_chunk_size=mem_chunk_size,
             use_pairwise_diffs=use_pairwise_diffs,
-            non_ascertained_pops=non_ascertained_pops)
+            non_ascertained_pops=non_ascertained_pops,
+            memory_budget=memory_budget,
+            n_threads=n_threads)
 
     def _set_data(self, sfs, length,
                   mem_chunk_size, use_pairwise_diffs,
-                  non_ascertained_pops):
+                  non_ascertained_pops, memory_budget=None,
+                  n_threads=None, subsfs=None):
+        # subsfs: sfs already restricted to self.leafs, if known,
+        # so _get_sfs() doesn't need to recompute it
         self._lik_surface = None
         self._conf_region = None
-        self._subsfs = None
+        self._subsfs = subsfs
         self._fullsfs = sfs
         self._length = length
         self._mem_chunk_size = mem_chunk_size
         self._use_pairwise_diffs = use_pairwise_diffs
         self._non_ascertained_pops = non_ascertained_pops
+        self._memory_budget = memory_budget
+        self._n_threads = n_threads
 
     def _get_sfs(self):
         if self._subsfs is None or list(
@@ -792,7 +857,9 @@ class DemographicModel(object):
         self._lik_surface = SfsLikelihoodSurface(
             sfs, demo_fun, mut_rate=mut_rate,
             folded=sfs.folded, batch_size=self._mem_chunk_size,
-            use_pairwise_diffs=use_pairwise_diffs, p_missing=p_miss)
+            use_pairwise_diffs=use_pairwise_diffs, p_missing=p_miss,
+            memory_budget=self._memory_budget,
+            n_threads=self._n_threads)
 
         logging.getLogger(__name__).info("Finished constructing likelihood surface")
 
@@ -863,7 +930,8 @@ class DemographicModel(object):
     def stochastic_optimize(
             self, num_iters, n_minibatches=None, snps_per_minibatch=None,
             rgen=None, printfreq=1, start_from_checkpoint=None,
-            save_to_checkpoint=None,  svrg_epoch=-1, **kwargs):
+            save_to_checkpoint=None,  svrg_epoch=-1, repartition=False,
+            n_workers=None, telemetry=None, **kwargs):
         """Use stochastic optimization (ADAM+SVRG) to search for MLE
 
         Exactly one of of ``n_minibatches`` and ``snps_per_minibatch`` should be set, as one determines the other.
@@ -873,9 +941,18 @@ class DemographicModel(object):
         :param int snps_per_minibatch: Number of SNPs per minibatch
         :param numpy.RandomState rgen: Random generator
         :param int printfreq: How often to log progress
-        :param str start_from_checkpoint: Name of checkpoint file to start from
-        :param str save_to_checkpoint: Name of checkpoint file to save to
+        :param str start_from_checkpoint: Name of checkpoint file to start from. \
+        Given the same ``rgen`` and other arguments, the resumed run \
+        reproduces the uninterrupted run exactly.
+        :param str save_to_checkpoint: Name of checkpoint file to save to. \
+        Checkpoints are written atomically in a background thread, \
+        along with the state of ``rgen``.
         :param int svrg_epoch: How often to compute full likelihood for SVRG. -1=never.
+        :param bool repartition: If True, randomly re-split the SNPs into new minibatches after each epoch (``n_minibatches`` steps).
+        :param int n_workers: If set, each step averages the gradients of ``n_workers`` minibatches, evaluated in parallel on persistent worker threads. The full likelihood for SVRG is evaluated in a single call, not split between the workers; its batches of SNPs run concurrently if ``n_threads`` was passed to :meth:`DemographicModel.set_data`. Results are reproducible for a given ``rgen`` seed and ``n_workers``.
+        :param telemetry: If not None, a :class:`momi.TelemetrySink`, or a \
+        file name or socket address to open one on, to stream \
+        machine-readable events of each iteration to.
         :rtype: :class:`scipy.optimize.OptimizeResult`
         """
         def callback(x):
@@ -899,8 +976,8 @@ class DemographicModel(object):
         kwargs["bounds"] = bounds
 
         if start_from_checkpoint:
-            with open(start_from_checkpoint) as f:
-                kwargs.update(json.load(f))
+            kwargs.update(_load_stochastic_checkpoint(
+                start_from_checkpoint, rgen))
         else:
             kwargs["x0"] = self._get_x()
 
@@ -909,7 +986,8 @@ class DemographicModel(object):
             snps_per_minibatch=snps_per_minibatch,
             rgen=rgen).find_mle(
                 method="adam", num_iters=num_iters,
-                svrg_epoch=svrg_epoch,
+                svrg_epoch=svrg_epoch, repartition=repartition,
+                n_workers=n_workers, telemetry=telemetry,
                 checkpoint_file=save_to_checkpoint, **kwargs)
 
         self._set_x(res.x)
@@ -918,18 +996,32 @@ class DemographicModel(object):
         return res
 
     def optimize(self, method="tnc", jac=True,
-                 hess=False, hessp=False, printfreq=1, **kwargs):
+                 hess=False, hessp=False, printfreq=1,
+                 callback=None, telemetry=None, **kwargs):
         """Search for the maximum likelihood value of the parameters.
 
         This is a wrapper around :func:`scipy.optimize.minimize`, \
         and arguments for that function can be passed in via \
         ``**kwargs``. Note the following arguments are constructed by :mod:`momi` and not be passed in by ``**kwargs``: ``fun``, ``x0``, ``jac``, ``hess``, ``hessp``, ``bounds``.
 
-        :param str method: Optimization method. Default is "tnc". For large models "L-BFGS-B" is recommended. See :func:`scipy.optimize.minimize`.
+        :param str method: Optimization method. Default is "tnc". For large models "L-BFGS-B" is recommended. See :func:`scipy.optimize.minimize`. \
+        ``"trust-krylov"`` uses a bounded trust-region Newton-CG \
+        (:func:`momi.optimizers.trust_krylov`), which typically needs fewer \
+        iterations on ill-conditioned models; its result also has \
+        the numbers of function, gradient, and hessian-vector product \
+        evaluations in each iteration (``evaluations``).
         :param bool jac: Whether or not to provide the gradient (computed via :mod:`autograd`) to the optimizer. If `False`, optimizers requiring gradients will typically approximate it via finite differences.
         :param bool hess: Whether or not to provide the hessian (computed via :mod:`autograd`) to the optimizer.
         :param bool hessp: Whether or not to provide the hessian-vector-product (via :mod:`autograd`) to the optimizer
         :param int printfreq: Log current progress via :func:`logging.info` every `printfreq` iterations
+        :param function callback: If not None, called after each \
+        iteration (after the parameters are updated) as ``callback(x)``, \
+        where ``x`` is the current internal (scaled) parameter vector, \
+        with additional attributes ``x.iteration`` and ``x.fun`` (the \
+        current KL divergence).
+        :param telemetry: If not None, a :class:`momi.TelemetrySink`, or a \
+        file name or socket address to open one on, to stream \
+        machine-readable events of each iteration to.
         :rtype: :class:`scipy.optimize.OptimizeResult`
         """
         bounds = [p.x_bounds
@@ -937,6 +1029,8 @@ class DemographicModel(object):
         if all([b is None for bnd in bounds for b in bnd]):
             bounds = None
 
+        user_callback = callback
+
         def callback(x):
             self._set_x(x)
             if x.iteration % printfreq == 0:
@@ -945,14 +1039,762 @@ class DemographicModel(object):
                 msg = ", ".join(["{}: {}".format(k, v) for k, v in msg])
                 logging.getLogger(__name__).info("{" + msg + "}")
 
+        if user_callback is not None:
+            log_callback = callback
+
+            def callback(x):
+                log_callback(x)
+                user_callback(x)
+
         res = self._get_surface().find_mle(
             self._get_x(), method=method,
             jac=jac, hess=hess, hessp=hessp,
             bounds=bounds, callback=callback,
-            **kwargs)
+            telemetry=telemetry, **kwargs)
 
         self._set_x(res.x)
         res["parameters"] = self.get_params()
         res["kl_divergence"] = res.fun
         res["log_likelihood"] = self.log_likelihood()
         return res
+
+    def optimize_multistart(self, n_starts, n_workers=None,
+                            abandon_margin=None, abandon_after=10,
+                            checkpoint_file=None, **kwargs):
+        """Run :meth:`DemographicModel.optimize` from multiple random \
+        starting points, and set the parameters to the best optimum found.
+
+        The starting points are sampled in the current process \
+        (as with ``set_params(randomize=True)``), so they do not \
+        depend on ``n_workers``. Each worker process receives the \
+        model and data once, and reuses its likelihood surface \
+        across the starts it runs.
+
+        :param int n_starts: Number of random starting points
+        :param int,None n_workers: If not None, run the starts in a \
+        pool of ``n_workers`` processes.
+        :param float,None abandon_margin: If not None, abandon a start \
+        once its KL divergence is more than ``abandon_margin`` above \
+        the best KL divergence of the finished starts.
+        :param int abandon_after: Minimum number of iterations before \
+        a start can be abandoned.
+        :param str,None checkpoint_file: If not None, the starting points \
+        and the result of each finished start are saved to this file \
+        (atomically, in a background thread). If the file already \
+        exists, the run is resumed from it: the same starting points \
+        are used, and the finished starts are not rerun.
+        :param \**kwargs: Additional arguments to \
+        :meth:`DemographicModel.optimize`
+
+        :returns: One row per start, ranked by KL divergence, with its \
+        status (``"converged"``, ``"failed"``, ``"abandoned"``, or \
+        ``"error"``), number of iterations, and parameter values.
+        :rtype: :class:`pandas.DataFrame`
+        """
+        if "callback" in kwargs:
+            raise ValueError("callback is not supported by optimize_multistart")
+
+        results = []
+        if checkpoint_file is not None and os.path.isfile(checkpoint_file):
+            state = load_checkpoint(checkpoint_file)
+            starts = list(state["starts"])
+            if len(starts) != n_starts:
+                raise ValueError(
+                    "Checkpoint {} has {} starts, but n_starts={}".format(
+                        checkpoint_file, len(starts), n_starts))
+            for (i, status, kl, ll, n_iter, params), x in zip(
+                    state["results"], state["results_x"]):
+                results.append((i, status, kl, ll, n_iter, x,
+                                co.OrderedDict(params)))
+            logging.getLogger(__name__).info(
+                "Resuming from {} finished starts in {}".format(
+                    len(results), checkpoint_file))
+        else:
+            prev_x = self._get_x()
+            starts = []
+            for _ in range(n_starts):
+                self.set_params(randomize=True)
+                starts.append(self._get_x())
+            self._set_x(prev_x)
+
+        checkpoint = None
+        if checkpoint_file is not None:
+            checkpoint = _CheckpointWriter(checkpoint_file)
+
+        def add_result(result):
+            results.append(result)
+            if checkpoint is not None:
+                checkpoint.write({
+                    "starts": np.array(starts),
+                    "results": [[i, status, kl, ll, n_iter, list(params.items())]
+                                for i, status, kl, ll, n_iter, _, params in results],
+                    "results_x": np.array([r[5] for r in results]).reshape(
+                        len(results), len(starts[0]))})
+
+        best_kl = multiprocessing.Value("d", min(
+            [r[2] for r in results if r[1] in ("converged", "failed")],
+            default=float("inf")))
+        initargs = (self._get_spec(), self._fullsfs, best_kl)
+        finished_starts = set(r[0] for r in results)
+        task_args = [(i, x0, kwargs, abandon_margin, abandon_after)
+                     for i, x0 in enumerate(starts)
+                     if i not in finished_starts]
+        try:
+            if n_workers is None or n_workers == 1:
+                _init_multistart_worker(*initargs)
+                try:
+                    for a in task_args:
+                        add_result(_multistart_task(*a))
+                finally:
+                    _multistart_state.clear()
+            else:
+                with concurrent.futures.ProcessPoolExecutor(
+                        n_workers, initializer=_init_multistart_worker,
+                        initargs=initargs) as executor:
+                    futures = [executor.submit(_multistart_task, *a)
+                               for a in task_args]
+                    for future in concurrent.futures.as_completed(futures):
+                        add_result(future.result())
+        finally:
+            if checkpoint is not None:
+                checkpoint.close()
+        results.sort(key=lambda r: r[0])
+
+        df = pd.DataFrame(
+            [co.OrderedDict(
+                [("start", i), ("status", status),
+                 ("kl_divergence", kl), ("log_likelihood", ll),
+                 ("n_iter", n_iter)] + list(params.items()))
+             for i, status, kl, ll, n_iter, x, params in results])
+        df = df.sort_values("kl_divergence", kind="mergesort",
+                            na_position="last").reset_index(drop=True)
+
+        finished = [r for r in results if r[1] in ("converged", "failed")]
+        if finished:
+            best = min(finished, key=lambda r: r[2])
+            self._set_x(best[5])
+        return df
+
+    def parametric_bootstrap(self, n_reps, length, recoms_per_gen,
+                             num_loci, muts_per_gen=None,
+                             out_file=None, n_workers=None,
+                             n_blocks=None, random_seed=None,
+                             max_pending=None, **kwargs):
+        """Parametric bootstrap at the current parameter values.
+
+        Each replicate simulates a dataset (as with \
+        :meth:`DemographicModel.simulate_data`) with the same sample \
+        sizes as the current data, extracts its SFS, and refits the \
+        model by :meth:`DemographicModel.optimize`, starting from the \
+        current parameter values.
+
+        Replicates are simulated and fitted in a pool of worker \
+        processes, with at most ``max_pending`` replicates in flight \
+        at once. Finished replicates are appended to ``out_file`` \
+        as they complete (one JSON object per line), and replicates \
+        already in ``out_file`` are skipped, so an interrupted run \
+        can be resumed by calling this again with the same arguments. \
+        Each line also records the simulation arguments, sample sizes \
+        and starting parameters, and resuming from a file written \
+        with different ones (or a different ``random_seed``) raises \
+        a :class:`ValueError`.
+
+        :param int n_reps: Number of bootstrap replicates
+        :param int length: Length of each simulated locus in bases
+        :param float recoms_per_gen: Recombination rate per generation per base
+        :param int num_loci: Number of loci per replicate
+        :param float muts_per_gen: Mutation rate per generation per \
+        base. If None, use :attr:`DemographicModel.muts_per_gen`
+        :param str,None out_file: File to write results to
+        :param int,None n_workers: If not None, number of worker processes
+        :param int,None n_blocks: Number of blocks to split each \
+        replicate SFS into. If None, one block per locus.
+        :param int,None random_seed: Random seed. Each replicate gets \
+        its own seed drawn from this, so the results do not depend \
+        on ``n_workers``.
+        :param int,None max_pending: Maximum number of replicates \
+        submitted to the workers at once. Default is ``2 * n_workers``.
+        :param \**kwargs: Additional arguments to \
+        :meth:`DemographicModel.optimize`
+
+        :returns: One row per replicate, with its status, \
+        KL divergence, log likelihood, and parameter values.
+        :rtype: :class:`pandas.DataFrame`
+        """
+        if "callback" in kwargs:
+            raise ValueError("callback is not supported by parametric_bootstrap")
+
+        seeds = np.random.RandomState(random_seed).randint(
+            1, 2**31 - 1, size=n_reps)
+
+        sim_kwargs = dict(
+            length=length, recoms_per_gen=recoms_per_gen,
+            num_replicates=num_loci, muts_per_gen=muts_per_gen,
+            sampled_n_dict=dict(self._get_sample_sizes(None)))
+        # stored with each replicate, to check that a resumed out_file
+        # comes from the same call
+        call_args = json.loads(json.dumps(co.OrderedDict([
+            ("length", length), ("recoms_per_gen", recoms_per_gen),
+            ("num_loci", num_loci),
+            ("muts_per_gen", muts_per_gen if muts_per_gen is not None
+             else self.muts_per_gen),
+            ("sampled_n", sorted(
+                [str(k), v] for k, v in sim_kwargs["sampled_n_dict"].items())),
+            ("n_blocks", n_blocks), ("folded", self._get_sfs().folded),
+            ("x0", [float(x) for x in self._get_x()])]),
+            default=lambda o: o.item()))
+
+        done = co.OrderedDict()
+        if out_file is not None and os.path.isfile(out_file):
+            with open(out_file) as f:
+                lines = [line for line in f if line.strip()]
+            rewrite = False
+            for i, line in enumerate(lines):
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    if i < len(lines) - 1:
+                        raise
+                    # the last line was truncated by an interrupted run
+                    logging.getLogger(__name__).warning(
+                        "Skipping truncated last line of {}".format(
+                            out_file))
+                    lines.pop()
+                    rewrite = True
+                else:
+                    if row.get("args") != call_args or (
+                            row["rep"] < n_reps and
+                            row["seed"] != seeds[row["rep"]]):
+                        raise ValueError(
+                            "Replicate {} in {} is from a call with different"
+                            " arguments or random_seed".format(
+                                row["rep"], out_file))
+                    done[row["rep"]] = row
+                    rewrite = rewrite or not line.endswith("\n")
+            if rewrite:
+                # so the new rows are appended on lines of their own
+                with open(out_file, "w") as f:
+                    for line in lines:
+                        print(line.rstrip("\n"), file=f)
+            logging.getLogger(__name__).info(
+                "Resuming from {} finished replicates in {}".format(
+                    len(done), out_file))
+
+        initargs = (self._get_spec(), self._get_x(), sim_kwargs,
+                    n_blocks, self._get_sfs().folded, kwargs)
+        todo = [(i, int(seed)) for i, seed in enumerate(seeds)
+                if i not in done]
+
+        out_f = None
+        if out_file is not None:
+            out_f = open(out_file, "a")
+
+        def record(row):
+            row["args"] = call_args
+            done[row["rep"]] = row
+            if out_f is not None:
+                print(json.dumps(row), file=out_f)
+                out_f.flush()
+
+        try:
+            if n_workers is None or n_workers == 1:
+                _init_bootstrap_worker(*initargs)
+                try:
+                    for i, seed in todo:
+                        record(_bootstrap_task(i, seed))
+                finally:
+                    _bootstrap_state.clear()
+            else:
+                if max_pending is None:
+                    max_pending = 2 * n_workers
+                todo = iter(todo)
+                with concurrent.futures.ProcessPoolExecutor(
+                        n_workers, initializer=_init_bootstrap_worker,
+                        initargs=initargs) as executor:
+                    pending = set()
+                    while True:
+                        for i, seed in itertools.islice(
+                                todo, max_pending - len(pending)):
+                            pending.add(executor.submit(
+                                _bootstrap_task, i, seed))
+                        if not pending:
+                            break
+                        finished, pending = concurrent.futures.wait(
+                            pending,
+                            return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in finished:
+                            record(future.result())
+        finally:
+            if out_f is not None:
+                out_f.close()
+
+        rows = [done[i] for i in sorted(done) if i < n_reps]
+        return pd.DataFrame(
+            [co.OrderedDict(
+                [(k, row[k]) for k in ("rep", "seed", "status",
+                                       "kl_divergence", "log_likelihood")]
+                + list(row["params"].items()))
+             for row in rows])
+
+    def jackknife_fit(self, n_workers=None, warm_start=True, **kwargs):
+        """Leave-one-block-out jackknife of the parameter estimates.
+
+        The current parameters should be the MLE \
+        (e.g. from :meth:`DemographicModel.optimize`). \
+        For each block (locus) of the data, the model is refit \
+        without that block. The leave-one-out datasets are built \
+        by subtracting the block's counts from the total counts, \
+        sharing the configs of the full data.
+
+        If ``warm_start=True``, each refit starts from a Newton step \
+        away from the MLE, using the Hessian of the full data \
+        log-likelihood and the gradient of the leave-one-out \
+        log-likelihood at the MLE.
+
+        The jackknife standard error of a parameter is \
+        ``sqrt((n-1)/n * sum((est - mean(est))**2))`` over the \
+        ``n`` leave-one-out estimates.
+
+        Note the blocks are assumed to have equal length in base pairs, \
+        i.e. each leave-one-out dataset has length ``(n-1)/n`` \
+        of the full data, as in :meth:`Sfs.resample`. \
+        This may be a poor assumption if the blocks are not of equal \
+        length and :attr:`DemographicModel.muts_per_gen` is set.
+
+        :param int,None n_workers: If not None, run the refits in a \
+        pool of ``n_workers`` processes.
+        :param bool warm_start: Whether to start the refits from \
+        a Newton step instead of the MLE.
+        :param \**kwargs: Additional arguments to \
+        :meth:`DemographicModel.optimize`
+
+        :returns: One row per left out block, with its status, \
+        KL divergence, log likelihood, and parameter values.
+        :rtype: :class:`pandas.DataFrame`
+        """
+        if "callback" in kwargs:
+            raise ValueError("callback is not supported by jackknife_fit")
+
+        sfs = self._get_sfs()
+        n_loci = sfs.n_loci
+        if n_loci < 2:
+            raise ValueError("Need at least 2 blocks to jackknife")
+
+        x_hat = self._get_x()
+        starts = np.array([x_hat] * n_loci)
+        surface = self._get_surface()
+        if warm_start and np.array_equal(surface.sfs.config_array,
+                                         sfs.config_array):
+            # gradient of each leave-one-out log likelihood at the MLE,
+            # with each block 1/n_loci of the length (see docstring)
+            block_scores = surface._score_replicates(
+                x_hat, sfs.replicate_counts(scipy.sparse.identity(n_loci)),
+                mut_rate_scale=1.0 / n_loci)
+            loo_scores = surface._score(x_hat) - block_scores
+            # hessian of the leave-one-out log likelihoods
+            loo_fisher = surface._fisher(x_hat) * (n_loci - 1) / n_loci
+            try:
+                starts = starts + np.linalg.solve(loo_fisher, loo_scores.T).T
+            except np.linalg.LinAlgError:
+                logging.getLogger(__name__).warning(
+                    "Singular Hessian at MLE, starting jackknife refits"
+                    " from the MLE instead")
+            else:
+                for i, p in enumerate(self.parameters.values()):
+                    lower, upper = p.x_bounds
+                    if lower is not None:
+                        starts[:, i] = np.maximum(starts[:, i], lower)
+                    if upper is not None:
+                        starts[:, i] = np.minimum(starts[:, i], upper)
+
+        initargs = (self._get_spec(), sfs, kwargs)
+        if n_workers is None or n_workers == 1:
+            _init_jackknife_worker(*initargs)
+            try:
+                results = [_jackknife_task(i, x0)
+                           for i, x0 in enumerate(starts)]
+            finally:
+                _jackknife_state.clear()
+        else:
+            with concurrent.futures.ProcessPoolExecutor(
+                    n_workers, initializer=_init_jackknife_worker,
+                    initargs=initargs) as executor:
+                results = list(executor.map(
+                    _jackknife_task, range(n_loci), starts))
+
+        return pd.DataFrame(
+            [co.OrderedDict(
+                [("block", i), ("status", status),
+                 ("kl_divergence", kl), ("log_likelihood", ll)]
+                + list(params.items()))
+             for i, status, kl, ll, params in results])
+
+
+    def profile_likelihood(self, param, grid, n_workers=None,
+                           level=.95, stop_early=True, **kwargs):
+        """Profile likelihood of a parameter.
+
+        The current parameters should be the MLE \
+        (e.g. from :meth:`DemographicModel.optimize`). \
+        For each value in ``grid``, the model is refit by \
+        :meth:`DemographicModel.optimize` with ``param`` fixed at \
+        that value. Unlike Wald-type intervals, \
+        the resulting intervals do not assume the likelihood is \
+        quadratic, so they are better suited for skewed parameters, \
+        or parameters near their bounds.
+
+        The grid is walked outwards from the MLE in both directions, \
+        and each refit starts from the solution at the neighbouring \
+        grid point closer to the MLE. With ``n_workers`` processes, \
+        the next ``n_workers`` grid points (split between the two \
+        directions) are refit at once, all starting from the last \
+        solution in their direction.
+
+        The likelihood ratio statistic at a grid point is \
+        ``2 * (max_log_lik - log_lik)``, and the points with \
+        ``p_value >= 1 - level`` form the profile likelihood \
+        confidence interval of level ``level``. \
+        If ``stop_early=True``, the walk in a direction stops once \
+        the statistic crosses the chi-square threshold of ``level``, \
+        and the remaining grid points in that direction \
+        have status ``"skipped"``.
+
+        Note the parameter is held fixed in the internal (scaled) \
+        representation used during optimization \
+        (see :meth:`DemographicModel.add_parameter`). \
+        If its transform depends on other parameters \
+        (e.g. a time parameter bounded by another time), \
+        the grid values are converted using the other parameters \
+        at the MLE.
+
+        :param str param: Name of the parameter to profile
+        :param list grid: Values of the parameter to refit at
+        :param int,None n_workers: If not None, run the refits in a \
+        pool of ``n_workers`` processes.
+        :param float level: Confidence level for the early stopping
+        :param bool stop_early: Whether to stop in each direction \
+        once the profile crosses the threshold of ``level``.
+        :param \**kwargs: Additional arguments to \
+        :meth:`DemographicModel.optimize`
+
+        :returns: One row per grid point, sorted by ``param``, with \
+        its status, KL divergence, log likelihood, likelihood ratio \
+        statistic, p-value, and the values of the other parameters.
+        :rtype: :class:`pandas.DataFrame`
+        """
+        if "callback" in kwargs:
+            raise ValueError(
+                "callback is not supported by profile_likelihood")
+        if param not in self.parameters:
+            raise ValueError("Unrecognized parameter {}".format(param))
+
+        param_idx = list(self.parameters.keys()).index(param)
+        x_hat = self._get_x()
+        value_hat = self.get_params()[param]
+        log_lik_hat = self.log_likelihood()
+        threshold = scipy.stats.chi2.ppf(level, 1)
+
+        grid = np.unique(np.array(grid, dtype=float))
+        grid_x = []
+        try:
+            for value in grid:
+                self.set_params({param: value})
+                grid_x.append(self._get_x(param))
+        finally:
+            self._set_x(x_hat)
+
+        # grid indices in the order they are visited, in each direction
+        directions = [
+            [i for i in reversed(range(len(grid))) if grid[i] < value_hat],
+            [i for i in range(len(grid)) if grid[i] >= value_hat]]
+        starts = [x_hat, x_hat]
+        results = {}
+
+        initargs = (self._get_spec(), self._fullsfs, kwargs, param_idx)
+        if n_workers is None or n_workers == 1:
+            executor = None
+            _init_profile_worker(*initargs)
+        else:
+            executor = concurrent.futures.ProcessPoolExecutor(
+                n_workers, initializer=_init_profile_worker,
+                initargs=initargs)
+        try:
+            while any(directions):
+                active = [d for d in (0, 1) if directions[d]]
+                n_per_direction = max(1, (n_workers or 1) // len(active))
+                tasks = []
+                for d in active:
+                    for i in directions[d][:n_per_direction]:
+                        x0 = np.array(starts[d])
+                        x0[param_idx] = grid_x[i]
+                        tasks.append((d, i, x0))
+                    directions[d] = directions[d][n_per_direction:]
+
+                task_args = [(i, grid_x[i], x0) for _, i, x0 in tasks]
+                if executor is None:
+                    outputs = [_profile_task(*a) for a in task_args]
+                else:
+                    outputs = list(executor.map(
+                        _profile_task, *zip(*task_args)))
+
+                for (d, i, _), out in zip(tasks, outputs):
+                    results[i] = out
+                    status, _, log_lik, x, _ = out
+                    if status in ("converged", "failed"):
+                        # warm start the next grid points
+                        starts[d] = x
+                    if stop_early and 2 * (log_lik_hat - log_lik) > threshold:
+                        directions[d] = []
+        finally:
+            if executor is None:
+                _profile_state.clear()
+            else:
+                executor.shutdown()
+
+        # in case a refit found a higher likelihood than the "MLE"
+        log_lik_hat = max([log_lik_hat] + [
+            out[2] for out in results.values() if not np.isnan(out[2])])
+
+        rows = []
+        for i, value in enumerate(grid):
+            try:
+                status, kl, log_lik, _, params = results[i]
+            except KeyError:
+                status, kl, log_lik = "skipped", float("nan"), float("nan")
+                params = {}
+            lr = 2 * (log_lik_hat - log_lik)
+            row = [(param, value), ("status", status),
+                   ("kl_divergence", kl), ("log_likelihood", log_lik),
+                   ("lr_statistic", lr),
+                   ("p_value", scipy.stats.chi2.sf(lr, 1))]
+            row += [(k, params.get(k, float("nan")))
+                    for k in self.parameters if k != param]
+            rows.append(co.OrderedDict(row))
+        return pd.DataFrame(rows)
+
+
+class _DemographicModelSpec(object):
+    """
+    Compact, picklable description of a :class:`DemographicModel`:
+    its events, parameters (with their transforms, bounds and random
+    generators), and data settings, but not the data or any cached
+    computations.
+
+    Used to rebuild the model in worker processes,
+    with :meth:`_DemographicModelSpec.build`.
+    """
+    def __init__(self, model):
+        self.N_e = model.N_e
+        self.gen_time = model.gen_time
+        self.muts_per_gen = model.muts_per_gen
+        self.admixture_tol = model.admixture_tol
+        self.parameters = [p.copy() for p in model.parameters.values()]
+        self.leaf_events = list(model.leaf_events)
+        self.size_events = list(model.size_events)
+        self.topology_events = list(model.topology_events)
+        self.leafs = list(model.leafs)
+        self.data_kwargs = dict(
+            length=model._length,
+            mem_chunk_size=model._mem_chunk_size,
+            use_pairwise_diffs=model._use_pairwise_diffs,
+            non_ascertained_pops=model._non_ascertained_pops,
+            memory_budget=model._memory_budget,
+            n_threads=model._n_threads)
+
+        for param in self.parameters:
+            _check_picklable(param, "Parameter {}".format(param.name))
+        for e in self.leaf_events + self.size_events + self.topology_events:
+            _check_picklable(e, "Event {}".format(e))
+
+    def build(self, sfs=None):
+        """
+        Returns a new :class:`DemographicModel` from the spec.
+
+        :param Sfs,None sfs: if not None, the data for the model, \
+        which is set with the same settings as the original model.
+        """
+        ret = DemographicModel(self.N_e, self.gen_time,
+                               self.muts_per_gen)
+        ret.admixture_tol = self.admixture_tol
+        for p in self.parameters:
+            ret.parameters[p.name] = p.copy()
+        ret.leaf_events.extend(self.leaf_events)
+        ret.size_events.extend(self.size_events)
+        ret.topology_events.extend(self.topology_events)
+        ret.leafs.extend(self.leafs)
+        ret._set_data(sfs=sfs, **self.data_kwargs)
+        return ret
+
+
+def _check_picklable(obj, name):
+    try:
+        pickle.dumps(obj)
+    except (pickle.PicklingError, AttributeError, TypeError) as e:
+        raise ValueError(
+            "{} cannot be pickled. Use module-level functions or the "
+            "built-in transforms in momi.events instead of lambdas "
+            "or closures".format(name)) from e
+
+
+class _AbandonedStart(Exception):
+    pass
+
+
+# state of a worker process in DemographicModel.optimize_multistart
+_multistart_state = {}
+
+
+def _init_multistart_worker(spec, sfs, best_kl):
+    _multistart_state["model"] = spec.build(sfs)
+    _multistart_state["best_kl"] = best_kl
+
+
+def _multistart_task(start, x0, optimize_kwargs,
+                     abandon_margin, abandon_after):
+    model = _multistart_state["model"]
+    best_kl = _multistart_state["best_kl"]
+
+    n_iter = [0]
+
+    def callback(x):
+        n_iter[0] = x.iteration + 1
+        if (abandon_margin is not None and x.iteration >= abandon_after
+                and x.fun > best_kl.value + abandon_margin):
+            raise _AbandonedStart()
+
+    status, kl, log_lik = _run_optimize(
+        model, x0, optimize_kwargs, "Start {}".format(start),
+        callback=callback)
+    if status in ("converged", "failed"):
+        with best_kl.get_lock():
+            if kl < best_kl.value:
+                best_kl.value = kl
+
+    return (start, status, kl, log_lik, n_iter[0],
+            model._get_x(), dict(model.get_params()))
+
+
+def _run_optimize(model, x0, optimize_kwargs, description, callback=None):
+    # run model.optimize() from x0, recording failures instead of raising
+    model._set_x(x0)
+    try:
+        res = model.optimize(callback=callback, **optimize_kwargs)
+    except _AbandonedStart:
+        status = "abandoned"
+        kl = model.kl_div()
+        log_lik = model.log_likelihood()
+    except Exception as e:
+        logging.getLogger(__name__).warning(
+            "{} failed with exception: {}".format(description, e))
+        status = "error"
+        kl = log_lik = float("nan")
+        model._set_x(x0)
+    else:
+        status = "converged" if res.success else "failed"
+        kl = res.kl_divergence
+        log_lik = res.log_likelihood
+
+    logging.getLogger(__name__).info(
+        "{}: {}, KLDivergence: {}".format(description, status, kl))
+    return status, float(kl), float(log_lik)
+
+
+# state of a worker process in DemographicModel.parametric_bootstrap
+_bootstrap_state = {}
+
+
+def _init_bootstrap_worker(spec, x0, sim_kwargs, n_blocks, folded,
+                           optimize_kwargs):
+    model = spec.build()
+    model._set_x(x0)
+    _bootstrap_state.update(
+        model=model, spec=spec, x0=x0, sim_kwargs=sim_kwargs,
+        n_blocks=n_blocks, folded=folded,
+        optimize_kwargs=optimize_kwargs)
+
+
+def _bootstrap_task(rep, seed):
+    state = _bootstrap_state
+    model = state["model"]
+    model._set_x(state["x0"])
+
+    data = model.simulate_data(random_seed=seed, **state["sim_kwargs"])
+    sfs = data.extract_sfs(state["n_blocks"])
+    if state["folded"]:
+        sfs = sfs.fold()
+    data_kwargs = dict(state["spec"].data_kwargs)
+    data_kwargs["length"] = sfs.length
+    model._set_data(sfs=sfs, **data_kwargs)
+
+    status, kl, log_lik = _run_optimize(
+        model, state["x0"], state["optimize_kwargs"],
+        "Bootstrap replicate {}".format(rep))
+    return co.OrderedDict([
+        ("rep", rep), ("seed", seed), ("status", status),
+        ("kl_divergence", kl), ("log_likelihood", log_lik),
+        ("x", [float(x) for x in model._get_x()]),
+        ("params", co.OrderedDict(
+            (k, float(v)) for k, v in model.get_params().items()))])
+
+
+# state of a worker process in DemographicModel.jackknife_fit
+_jackknife_state = {}
+
+
+def _init_jackknife_worker(spec, sfs, optimize_kwargs):
+    _jackknife_state.update(
+        model=spec.build(), spec=spec, sfs=sfs,
+        freqs=scipy.sparse.csc_matrix(sfs.freqs_matrix),
+        optimize_kwargs=optimize_kwargs)
+
+
+def _jackknife_task(block, x0):
+    state = _jackknife_state
+    model = state["model"]
+    sfs = state["sfs"]
+
+    # leave-one-out counts, on the configs of the full data
+    counts = sfs._total_freqs - state["freqs"][:, block].toarray()[:, 0]
+    keep, = np.nonzero(counts > 0)
+    loo_sfs = Sfs.from_matrix(
+        counts[keep, None], _ConfigList_Subset(sfs.configs, keep),
+        sfs.folded, None)
+
+    data_kwargs = dict(state["spec"].data_kwargs)
+    if data_kwargs["length"] is not None:
+        data_kwargs["length"] = data_kwargs["length"] * (
+            sfs.n_loci - 1) / sfs.n_loci
+    # loo_sfs is already restricted to the leaf populations
+    model._set_data(sfs=loo_sfs, subsfs=loo_sfs, **data_kwargs)
+
+    status, kl, log_lik = _run_optimize(
+        model, x0, state["optimize_kwargs"],
+        "Jackknife block {}".format(block))
+    return (block, status, kl, log_lik, dict(model.get_params()))
+
+
+# state of a worker process in DemographicModel.profile_likelihood
+_profile_state = {}
+
+
+def _init_profile_worker(spec, sfs, optimize_kwargs, param_idx):
+    _profile_state.update(
+        model=spec.build(sfs), optimize_kwargs=optimize_kwargs,
+        param_idx=param_idx)
+
+
+def _profile_task(grid_idx, param_x, x0):
+    state = _profile_state
+    model = state["model"]
+
+    # fix the profiled parameter, see optimizers._find_minimum()
+    param = list(model.parameters.values())[state["param_idx"]]
+    bounds = param.x_bounds
+    param.x_bounds = [param_x, param_x]
+    try:
+        status, kl, log_lik = _run_optimize(
+            model, x0, state["optimize_kwargs"],
+            "Profile point {}".format(grid_idx))
+    finally:
+        param.x_bounds = bounds
+    return (status, kl, log_lik, model._get_x(), dict(model.get_params()))
@@ -4,10 +4,13 @@ import scipy
 import scipy.special
 from scipy.special import comb
 import scipy.sparse
+import scipy.stats
 import autograd.numpy as np
+from autograd.tracer import getval
 import msprime
 from .compute_sfs import expected_total_branch_len
-from .data.compressed_counts import _CompressedHashedCounts, _CompressedList
+from .events import _build_demo_graph, _rebind_demo_graph
+from .data.compressed_counts import _CompressedList, CompressedAlleleCounts
 from .data.snps import SnpAlleleCounts
 from .util import memoize_instance
 from .math_functions import (
@@ -16,7 +19,9 @@ from .math_functions import (
 
 import pysam
 import os
+import shutil
 import itertools
+import concurrent.futures
 
 import logging
 logger = logging.getLogger(__name__)
@@ -54,13 +59,19 @@ class Demography(object):
     """
     The demographic history relating a sample of individuals.
     """
-    def __init__(self, G, cache=None):
+    def __init__(self, G, cache=None, topology=None):
         """
         For internal use only.
         Use make_demography() to create a Demography.
         """
+        if isinstance(G, _DemographyTopology):
+            # only the graph structure, see _get_graph_structure()
+            G, topology = None, G
+        elif topology is None:
+            topology = _DemographyTopology(G)
         self._G = G
-        self._event_tree = _build_event_tree(self._G)
+        self._topology = topology
+        self._admixture_discarded = {}
 
         if cache is not None:
             self._diff_cache = cache
@@ -78,18 +89,7 @@ class Demography(object):
         # returns just the graph structure, i.e. the "non-differentiable" part of the Demography
         # use this with _get_differentiable_part()
         # to re-organize certain computations during automatic differentiation
-        ret = nx.DiGraph()
-        ret.add_nodes_from(self._G.nodes(data=False))
-        ret.add_edges_from(self._G.edges(data=False))
-
-        for v, d in self._G.nodes(data=True):
-            if 'lineages' in d:
-                ret.node[v]['lineages'] = d['lineages']
-
-        ret.graph['events_as_edges'] = tuple(self._G.graph['events_as_edges'])
-        ret.graph['sampled_pops'] = self.sampled_pops
-
-        return ret
+        return self._topology
 
     #def copy(self, sampled_n=None):
     #    """
@@ -116,20 +116,17 @@ class Demography(object):
         """
         The list of population labels
         """
-        return self._G.graph['sampled_pops']
+        return self._topology.sampled_pops
 
     @property
     def sampled_n(self):
         """
         The list of number of samples per population
         """
-        return np.array(tuple(self._G.node[(l, 0)]['lineages'] for l in self.sampled_pops), dtype=int)
+        return np.array(self._topology.sampled_n, dtype=int)
 
-    @memoize_instance
     def _n_at_node(self, node):
-        return sum(self._G.node[(pop, idx)]['lineages']
-                   for pop, idx in nx.dfs_preorder_nodes(self._G, node)
-                   if idx == 0)
+        return self._topology.n_at_node[node]
 
     @property
     def _root(self):
@@ -138,27 +135,24 @@ class Demography(object):
 
     @property
     def _event_root(self):
-        return self._event_tree.root
+        return self._topology.event_root
+
+    @property
+    def _event_postorder(self):
+        return self._topology.event_postorder
 
     def _event_type(self, event):
-        if len(event) == 1:
-            return 'leaf'
-        elif len(event) == 3:
-            return 'pulse'
-        elif len(self._event_tree[event]) == 2:
-            return 'merge_clusters'
-        else:
-            return 'merge_subpops'
+        return self._topology.event_type[event]
 
     def _sub_pops(self, event):
         '''
         The group of subpopulations corresponding to this event in the junction tree.
         '''
-        return self._event_tree.node[event]['subpops']
+        return self._topology.sub_pops[event]
 
     def _parent_pops(self, event):
         '''The populations arising due to this event, backwards in time.'''
-        return self._event_tree.node[event]['parent_pops']
+        return self._topology.parent_pops[event]
 
     def _child_pops(self, event):
         '''
@@ -167,23 +161,10 @@ class Demography(object):
         which gives populations arising from this event forward in time,
         and the corresponding child events in the junction tree.
         '''
-        return self._event_tree.node[event]['child_pops']
+        return dict(self._topology.child_pops[event])
 
     def _pulse_nodes(self, event):
-        parent_pops = self._parent_pops(event)
-        child_pops_events = self._child_pops(event)
-        assert len(child_pops_events) == 2
-        child_pops, child_events = list(zip(*list(child_pops_events.items())))
-
-        child_in = dict(self._G.in_degree(child_pops))
-        recipient, = [k for k, v in list(child_in.items()) if v == 2]
-        non_recipient, = [k for k, v in list(child_in.items()) if v == 1]
-
-        parent_out = dict(self._G.out_degree(parent_pops))
-        donor, = [k for k, v in list(parent_out.items()) if v == 2]
-        non_donor, = [k for k, v in list(parent_out.items()) if v == 1]
-
-        return recipient, non_recipient, donor, non_donor
+        return self._topology.pulse_nodes[event]
 
     """
     ALL differentiable methods used by compute_sfs
@@ -273,9 +254,7 @@ class Demography(object):
         return self._admixture_prob_helper(admixture_node), self._admixture_prob_idxs(admixture_node)
 
     def _admixture_prob_idxs(self, admixture_node):
-        edge1, edge2 = sorted(self._G.in_edges(
-            [admixture_node], data=True), key=lambda x: str(x[:2]))
-        parent1, parent2 = [e[0] for e in (edge1, edge2)]
+        parent1, parent2 = self._topology.admixture_parents[admixture_node]
         return [admixture_node, parent1, parent2]
 
     @differentiable_method
@@ -287,10 +266,9 @@ class Demography(object):
         n_node = self._n_at_node(admixture_node)
 
         # admixture node must have two parents
-        edge1, edge2 = sorted(self._G.in_edges(
-            [admixture_node], data=True), key=lambda x: str(x[:2]))
-        parent1, parent2 = [e[0] for e in (edge1, edge2)]
-        prob1, prob2 = [e[2]['prob'] for e in (edge1, edge2)]
+        parent1, parent2 = self._topology.admixture_parents[admixture_node]
+        prob1, prob2 = [self._G[parent][admixture_node]['prob']
+                        for parent in (parent1, parent2)]
         assert prob1 + prob2 == 1.0
 
         #n_from_1 = np.arange(n_node + 1)
@@ -300,61 +278,120 @@ class Demography(object):
         #ret = par_einsum(_der_in_admixture_node(n_node), list(range(4)),
         #                 binom_coeffs, [0],
         #                 [1, 2, 3])
-        ret = np.transpose(admixture_operator(n_node, prob1))
+        ret = np.transpose(admixture_operator(
+            n_node, prob1, band=self._admixture_band(admixture_node)))
         assert ret.shape == tuple([n_node + 1] * 3)
 
         assert [admixture_node, parent1,
                 parent2] == self._admixture_prob_idxs(admixture_node)
         return ret
 
-    def simulate_data(self, length, num_replicates=1, **kwargs):
-        treeseq = self.simulate_trees(length=length, num_replicates=num_replicates,
-                                      **kwargs)
-        try:
-            treeseq.variants
-        except:
-            pass
+    @memoize_instance
+    def _admixture_band(self, admixture_node):
+        '''
+        Returns None if the admixture operator is computed exactly.
+        Otherwise returns (lower, upper), the band of lineage counts
+        from parent1 kept by the admixture operator,
+        see the graph attribute 'admixture_tol'.
+        '''
+        tol = self._topology.admixture_tol
+        if not tol:
+            return None
+        n_node = self._n_at_node(admixture_node)
+        parent1, _ = self._topology.admixture_parents[admixture_node]
+        prob1 = float(getval(self._G[parent1][admixture_node]['prob']))
+        lower, upper, discarded = admixture_band(n_node, prob1, tol)
+        logger.debug("Admixture node {}: keeping {} of {} lineage counts, discarding probability mass {}".format(
+            admixture_node, upper - lower, n_node + 1, discarded))
+        self._admixture_discarded[admixture_node] = discarded
+        return lower, upper
+
+    @property
+    def admixture_discarded_mass(self):
+        """
+        Dict mapping each admixture node to the probability mass
+        discarded by the banded admixture operator
+        (0 if the graph attribute 'admixture_tol' is not set).
+        """
+        admixture_nodes = list(self._topology.admixture_parents.keys())
+        for v in admixture_nodes:
+            self._admixture_band(v)
+        return {v: self._admixture_discarded.get(v, 0.0)
+                for v in admixture_nodes}
+
+    def simulate_data(self, length, num_replicates=1, n_workers=None,
+                      **kwargs):
+        if n_workers is None:
+            # random_seed seeds msprime's stream of replicates directly,
+            # as simulate_vcf() does for a single chromosome,
+            # so the loci differ from n_workers=1
+            treeseq = self.simulate_trees(length=length, num_replicates=num_replicates,
+                                          **kwargs)
+            try:
+                treeseq.variants
+            except:
+                pass
+            else:
+                treeseq = [treeseq]
+
+            loci = (_locus_derived_counts(locus, self.sampled_n)
+                    for locus in treeseq)
         else:
-            treeseq = [treeseq]
-
-        mat = np.zeros((len(self.sampled_n), sum(self.sampled_n)), dtype=int)
-        j = 0
-        for i, n in enumerate(self.sampled_n):
-            for _ in range(n):
-                mat[i, j] = 1
-                j += 1
-        mat = scipy.sparse.csr_matrix(mat)
-
-        def get_config(genos):
-            derived_counts = mat.dot(genos)
-            return np.array([
-                self.sampled_n - derived_counts,
-                derived_counts
-            ]).T
-
-        #chrom = []
-        chrom = _CompressedList()
-        pos = []
-        compressed_counts = _CompressedHashedCounts(len(self.sampled_pops))
-
-        for c, locus in enumerate(treeseq):
-            for v in locus.variants():
-                compressed_counts.append(get_config(v.genotypes))
-                chrom.append(c)
-                pos.append(v.position)
+            loci = self._simulate_loci_parallel(
+                length=length, num_replicates=num_replicates,
+                n_workers=n_workers, **kwargs)
+
+        chrom, pos, derived_counts = [], [], []
+        for c, (locus_pos, locus_counts) in enumerate(loci):
+            chrom.append(np.full(len(locus_pos), c, dtype=int))
+            pos.append(locus_pos)
+            derived_counts.append(locus_counts)
+
+        chrom = _CompressedList.from_array(np.concatenate(chrom))
+        pos = np.concatenate(pos)
+        derived_counts = np.concatenate(derived_counts)
+        compressed_counts = CompressedAlleleCounts.from_array(
+            np.stack([self.sampled_n - derived_counts,
+                      derived_counts], axis=2))
 
         return SnpAlleleCounts(
-            chrom, pos, compressed_counts.compressed_allele_counts(),
+            chrom, pos, compressed_counts,
             self.sampled_pops, use_folded_sfs=False,
             non_ascertained_pops=[], length=length*num_replicates,
             n_read_snps=len(compressed_counts), n_excluded_snps=0)
 
+    def _simulate_loci_parallel(self, num_replicates, n_workers,
+                                random_seed=None, **kwargs):
+        # each replicate gets its own seed, so the result
+        # does not depend on n_workers (as long as it is not None)
+        seeds = np.random.RandomState(random_seed).randint(
+            1, 2**31 - 1, size=num_replicates)
+        msprime_kwargs = dict(self._msprime_kwargs(), **kwargs)
+
+        if n_workers == 1:
+            for seed in seeds:
+                yield _simulate_derived_counts(
+                    msprime_kwargs, self.sampled_n, [seed])[0]
+            return
+
+        # several chunks per worker, to balance the load
+        n_chunks = min(num_replicates, 4 * n_workers)
+        with concurrent.futures.ProcessPoolExecutor(n_workers) as executor:
+            for chunk in executor.map(
+                    _simulate_derived_counts,
+                    itertools.repeat(msprime_kwargs),
+                    itertools.repeat(self.sampled_n),
+                    np.array_split(seeds, n_chunks)):
+                for locus in chunk:
+                    yield locus
+
     def simulate_vcf(self, out_prefix, mutation_rate,
                      recombination_rate, length,
                      chrom_name=1, ploidy=1, random_seed=None,
-                     force=False, print_aa=True):
+                     force=False, print_aa=True, n_workers=None,
+                     chunk_size=10000):
         out_prefix = os.path.expanduser(out_prefix)
-        vcf_name = out_prefix + ".vcf"
+        vcf_name = out_prefix + ".vcf.gz"
         bed_name = out_prefix + ".bed"
         for fname in (vcf_name, bed_name):
             if not force and os.path.isfile(fname):
@@ -365,50 +402,80 @@ class Demography(object):
             raise ValueError("Sampled alleles per population must be"
                              " integer multiple of ploidy")
 
+        if isinstance(chrom_name, (list, tuple)):
+            chrom_names = list(chrom_name)
+            # each chromosome gets its own seed, so the result
+            # does not depend on n_workers
+            seeds = np.random.RandomState(random_seed).randint(
+                1, 2**31 - 1, size=len(chrom_names))
+            seeds = [int(seed) for seed in seeds]
+        else:
+            chrom_names = [chrom_name]
+            seeds = [random_seed]
+
         with open(bed_name, "w") as bed_f:
-            print(chrom_name, 0, length, sep="\t", file=bed_f)
-
-        with open(vcf_name, "w") as vcf_f:
-            treeseq = self.simulate_trees(
-                mutation_rate=mutation_rate,
-                recombination_rate=recombination_rate,
-                length=length, num_replicates=1,
-                random_seed=random_seed)
-
-            print("##fileformat=VCFv4.2", file=vcf_f)
-            print('##source="VCF simulated by momi2 using'
-                  ' msprime backend"', file=vcf_f)
-            print("##contig=<ID={chrom_name},length={length}>".format(
-                chrom_name=chrom_name, length=length), file=vcf_f)
-            print('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
-                  file=vcf_f)
-            print('##INFO=<ID=AA,Number=1,Type=String,Description="Ancestral Allele">',
-                  file=vcf_f)
-
-            n_samples = int(np.sum(self.sampled_n) / ploidy)
-            fields = ["#CHROM", "POS", "ID", "REF", "ALT", "QUAL",
-                      "FILTER", "INFO", "FORMAT"]
-            for pop, n in zip(self.sampled_pops, self.sampled_n):
-                for i in range(int(n / ploidy)):
-                    fields.append("{}_{}".format(pop, i))
-            print(*fields, sep="\t", file=vcf_f)
-
-            loc = next(treeseq)
-            if print_aa:
-                info_str = "AA=A"
+            for chrom in chrom_names:
+                print(chrom, 0, int(length), sep="\t", file=bed_f)
+
+        fields = ["#CHROM", "POS", "ID", "REF", "ALT", "QUAL",
+                  "FILTER", "INFO", "FORMAT"]
+        for pop, n in zip(self.sampled_pops, self.sampled_n):
+            for i in range(int(n / ploidy)):
+                fields.append("{}_{}".format(pop, i))
+
+        header = ["##fileformat=VCFv4.2",
+                  '##source="VCF simulated by momi2 using'
+                  ' msprime backend"']
+        for chrom in chrom_names:
+            header.append("##contig=<ID={chrom_name},length={length}>".format(
+                chrom_name=chrom, length=int(length)))
+        header.append('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">')
+        header.append('##INFO=<ID=AA,Number=1,Type=String,Description="Ancestral Allele">')
+        header.append("\t".join(fields))
+
+        if print_aa:
+            info_str = "AA=A"
+        else:
+            info_str = "."
+
+        msprime_kwargs = dict(
+            self._msprime_kwargs(), mutation_rate=mutation_rate,
+            recombination_rate=recombination_rate, length=length,
+            num_replicates=1)
+        # each chromosome is written to its own BGZF file,
+        # which are then concatenated in order
+        part_names = ["{}.part{}.vcf.gz".format(out_prefix, i)
+                      for i in range(len(chrom_names))]
+        write_args = [(part, msprime_kwargs, chrom, seed, ploidy,
+                       info_str, chunk_size)
+                      for part, chrom, seed in zip(
+                              part_names, chrom_names, seeds)]
+        try:
+            if n_workers is None or n_workers == 1 or len(chrom_names) == 1:
+                for args in write_args:
+                    _write_vcf_records(*args)
             else:
-                info_str = "."
-
-            for v in loc.variants():
-                gt = np.reshape(v.genotypes, (n_samples, ploidy))
-                print(chrom_name, int(np.floor(v.position)),
-                      ".", "A", "T", ".", ".", info_str, "GT",
-                      *["|".join(map(str, sample)) for sample in gt],
-                      sep="\t", file=vcf_f)
-
-        pysam.tabix_index(vcf_name, preset="vcf", force=force)
+                with concurrent.futures.ProcessPoolExecutor(
+                        n_workers) as executor:
+                    list(executor.map(_write_vcf_records, *zip(*write_args)))
+
+            with pysam.BGZFile(vcf_name, "wb") as vcf_f:
+                vcf_f.write(("\n".join(header) + "\n").encode())
+            with open(vcf_name, "ab") as vcf_f:
+                for part in part_names:
+                    with open(part, "rb") as part_f:
+                        shutil.copyfileobj(part_f, vcf_f)
+        finally:
+            for part in part_names:
+                if os.path.isfile(part):
+                    os.remove(part)
+
+        pysam.tabix_index(vcf_name, preset="vcf", force=True)
 
     def simulate_trees(self, **kwargs):
+        return msprime.simulate(**self._msprime_kwargs(), **kwargs)
+
+    def _msprime_kwargs(self):
         sampled_t = self.sampled_t
         if sampled_t is None:
             sampled_t = 0.0
@@ -422,7 +489,7 @@ class Demography(object):
             if e is not None:
                 demographic_events.append(e)
 
-        return msprime.simulate(
+        return dict(
             population_configurations=[
                 msprime.PopulationConfiguration()
                 for _ in range(len(pops))],
@@ -433,8 +500,145 @@ class Demography(object):
                 for p, t, n in zip(
                         self.sampled_pops, self.sampled_t,
                         self.sampled_n)
-                for _ in range(n)],
-            **kwargs)
+                for _ in range(n)])
+
+
+def _simulate_derived_counts(msprime_kwargs, sampled_n, seeds):
+    # simulates one locus per seed; module level so it can run in a process pool
+    return [_locus_derived_counts(
+        msprime.simulate(random_seed=int(seed), **msprime_kwargs),
+        sampled_n) for seed in seeds]
+
+
+def _locus_derived_counts(locus, sampled_n, chunk_size=10000):
+    """
+    Returns the positions of the variants in a tree sequence,
+    and an array with shape [n_variants, n_pops] of
+    their derived allele counts per population.
+
+    Genotypes are reduced to counts in chunks of variants,
+    to bound memory usage.
+    """
+    sampled_n = np.array(sampled_n, dtype=int)
+    # [n_samples, n_pops] indicator of the population of each sample
+    pop_mat = np.zeros((np.sum(sampled_n), len(sampled_n)), dtype=int)
+    pop_mat[np.arange(np.sum(sampled_n)),
+            np.repeat(np.arange(len(sampled_n)), sampled_n)] = 1
+
+    positions, counts = [np.zeros(0)], [np.zeros((0, len(sampled_n)), dtype=int)]
+    for chunk_pos, chunk_genos in _variant_chunks(
+            locus, np.sum(sampled_n), chunk_size):
+        positions.append(chunk_pos)
+        counts.append(chunk_genos.dot(pop_mat))
+
+    return np.concatenate(positions), np.concatenate(counts)
+
+
+def _variant_chunks(locus, n_samples, chunk_size):
+    # yields (positions, genotypes) of chunks of variants in a tree sequence,
+    # genotypes has shape [n_variants_in_chunk, n_samples].
+    # each chunk is decoded from its own range of sites,
+    # into a buffer that is reused between chunks
+    positions = locus.sites_position
+    genos = np.zeros((chunk_size, n_samples), dtype=np.int8)
+    for start in range(0, len(positions), chunk_size):
+        end = min(start + chunk_size, len(positions))
+        if end < len(positions):
+            right = positions[end]
+        else:
+            right = locus.sequence_length
+        for i, v in enumerate(locus.variants(
+                left=positions[start], right=right, copy=False)):
+            genos[i, :] = v.genotypes
+        assert i == end - start - 1
+        yield positions[start:end], genos[:end - start, :].astype(int)
+
+
+def _write_vcf_records(out_name, msprime_kwargs, chrom_name, random_seed,
+                       ploidy, info_str, chunk_size):
+    # simulates a chromosome and writes its VCF records to a BGZF file;
+    # module level so it can run in a process pool
+    locus = next(msprime.simulate(random_seed=random_seed, **msprime_kwargs))
+    n_samples = len(msprime_kwargs["samples"])
+    with pysam.BGZFile(out_name, "wb") as vcf_f:
+        for positions, genos in _variant_chunks(locus, n_samples, chunk_size):
+            vcf_f.write(_format_vcf_records(
+                chrom_name, np.floor(positions).astype(int), genos,
+                ploidy, info_str))
+
+
+def _format_vcf_records(chrom_name, positions, genotypes, ploidy, info_str):
+    """
+    Returns the VCF records for a chunk of variants as bytes.
+
+    The whole chunk is formatted at once, by filling a single
+    byte buffer with numpy, instead of formatting each variant.
+
+    positions is an integer array of length n_variants, and
+    genotypes is a 0/1 array with shape [n_variants, n_samples*ploidy].
+    """
+    n_variants, n_alleles = genotypes.shape
+    if n_variants == 0:
+        return b""
+
+    # the GT columns: alleles of a sample separated by "|",
+    # samples separated by tabs, with newline at the end
+    gt = np.zeros((n_variants, n_alleles, 2), dtype=np.uint8)
+    gt[:, :, 0] = genotypes + ord("0")
+    gt[:, :, 1] = ord("|")
+    gt[:, (ploidy-1)::ploidy, 1] = ord("\t")
+    gt[:, -1, 1] = ord("\n")
+    gt = np.reshape(gt, (n_variants, 2 * n_alleles))
+
+    head = np.frombuffer("{}\t".format(chrom_name).encode(), dtype=np.uint8)
+    tail = np.frombuffer("\t.\tA\tT\t.\t.\t{}\tGT\t".format(
+        info_str).encode(), dtype=np.uint8)
+
+    # digits of positions, as null-padded byte strings
+    max_digits = len(str(np.max(positions)))
+    digits = np.reshape(
+        np.array(positions).astype("S{}".format(max_digits)).view(np.uint8),
+        (n_variants, max_digits))
+    n_digits = np.sum(digits != 0, axis=1)
+
+    line_len = len(head) + n_digits + len(tail) + gt.shape[1]
+    line_start = np.cumsum(line_len) - line_len
+    buf = np.zeros(np.sum(line_len), dtype=np.uint8)
+
+    buf[line_start[:, None] + np.arange(len(head))] = head
+    digit_idxs = line_start[:, None] + len(head) + np.arange(max_digits)
+    is_digit = np.arange(max_digits) < n_digits[:, None]
+    buf[digit_idxs[is_digit]] = digits[is_digit]
+    tail_start = line_start + len(head) + n_digits
+    buf[tail_start[:, None] + np.arange(len(tail))] = tail
+    gt_start = tail_start + len(tail)
+    buf[gt_start[:, None] + np.arange(gt.shape[1])] = gt
+
+    return buf.tobytes()
+
+
+class _DemographyTemplate(object):
+    """
+    The graph and topology of a Demography,
+    compiled for a fixed time ordering of the events.
+
+    The graph structure only depends on the order of the events,
+    so bind() only recomputes the size histories and pulse
+    probabilities for new parameter values, and reuses the
+    compiled _DemographyTopology.
+    """
+    def __init__(self, events, sample_sizes, params_dict, default_N,
+                 admixture_tol=None):
+        self.events = tuple(events)
+        self.sample_sizes = sample_sizes
+        self._G = _build_demo_graph(self.events, sample_sizes, params_dict,
+                                    default_N, admixture_tol)
+        self._topology = _DemographyTopology(self._G)
+
+    def bind(self, params_dict):
+        G = _rebind_demo_graph(self._G, self.events, self.sample_sizes,
+                               params_dict)
+        return Demography(G, topology=self._topology)
 
 
 def rescale_events(events, factor):
@@ -458,38 +662,27 @@ def rescale_events(events, factor):
     return rescaled_events
 
 
-def admixture_operator(n_node, p):
-    # axis0=n_from_parent, axis1=der_from_parent, axis2=der_in_parent
-    der_in_parent = np.tile(np.arange(n_node + 1), (n_node + 1, n_node + 1, 1))
-    n_from_parent = np.transpose(der_in_parent, [2, 0, 1])
-    der_from_parent = np.transpose(der_in_parent, [0, 2, 1])
-
-    anc_in_parent = n_node - der_in_parent
-    anc_from_parent = n_from_parent - der_from_parent
+def admixture_operator(n_node, p, band=None):
+    """
+    Returns array with axis0=der_in_parent1, axis1=der_in_parent2,
+    axis2=der_in_child.
 
-    x = comb(der_in_parent, der_from_parent) * comb(
-        anc_in_parent, anc_from_parent) / comb(n_node, n_from_parent)
-    # rearrange so axis0=1, axis1=der_in_parent, axis2=der_from_parent, axis3=n_from_parent
-    x = np.transpose(x)
-    x = np.reshape(x, [1] + list(x.shape))
+    If band=(lower, upper), only the lineage counts
+    lower <= n_from_parent1 < upper are built and summed over;
+    the improbable lineage counts outside the band are
+    approximated with 0 (see admixture_band()).
+    """
+    if band is None:
+        lower, upper = 0, n_node + 1
+    else:
+        lower, upper = band
 
-    n = np.arange(n_node+1)
+    n = np.arange(lower, upper)
     B = comb(n_node, n)
 
     # the two arrays to convolve_sum_axes
-    x1 = (x * B * ((1-p)**n) * (p**(n[::-1])))
-    x2 = x[:, :, :, ::-1]
-
-    # reduce array size; approximate low probability events with 0
-    mu = n_node * (1-p)
-    sigma = np.sqrt(n_node * p * (1-p))
-    n_sd = 4
-    lower = np.max((0, np.floor(mu - n_sd*sigma)))
-    upper = np.min((n_node, np.ceil(mu + n_sd*sigma))) + 1
-    lower, upper = int(lower), int(upper)
-
-    ##x1 = x1[:,:,:upper,lower:upper]
-    ##x2 = x2[:,:,:(n_node-lower+1),lower:upper]
+    x1 = _admixture_x(n_node, n, upper) * B * ((1-p)**n) * (p**(n_node-n))
+    x2 = _admixture_x(n_node, n_node - n, n_node - lower + 1)
 
     ret = convolve_sum_axes(x1, x2)
     # axis0=der_in_parent1, axis1=der_in_parent2, axis2=der_in_child
@@ -499,6 +692,52 @@ def admixture_operator(n_node, p):
     return ret[:, :, :(n_node+1)]
 
 
+def _admixture_x(n_node, n_from_parent, max_der_from_parent):
+    """
+    Returns array with axis0=1, axis1=der_in_parent, axis2=der_from_parent,
+    axis3=n_from_parent, giving the hypergeometric probability of
+    der_from_parent derived lineages among the n_from_parent
+    lineages drawn from the parent.
+
+    Only der_from_parent < max_der_from_parent is stored,
+    as larger values have probability 0 when
+    max(n_from_parent) < max_der_from_parent.
+    """
+    der_in_parent, der_from_parent, n_from_parent = np.meshgrid(
+        np.arange(n_node + 1), np.arange(max_der_from_parent),
+        n_from_parent, indexing="ij")
+
+    anc_in_parent = n_node - der_in_parent
+    anc_from_parent = n_from_parent - der_from_parent
+
+    x = comb(der_in_parent, der_from_parent) * comb(
+        anc_in_parent, anc_from_parent) / comb(n_node, n_from_parent)
+    return np.reshape(x, [1] + list(x.shape))
+
+
+def admixture_band(n_node, p, tol):
+    """
+    Returns (lower, upper, discarded_mass), where [lower, upper)
+    is the smallest interval of n_from_parent1 ~ Binomial(n_node, 1-p)
+    whose tails each have probability at most tol/2,
+    and discarded_mass is the probability outside the interval.
+    """
+    if tol <= 0:
+        return 0, n_node + 1, 0.0
+    q = 1.0 - p
+    lower = int(scipy.stats.binom.ppf(tol / 2.0, n_node, q))
+    upper = int(scipy.stats.binom.isf(tol / 2.0, n_node, q)) + 1
+    lower, upper = max(lower, 0), min(upper, n_node + 1)
+    lower = min(lower, upper - 1)
+
+    discarded = 0.0
+    if lower > 0:
+        discarded += scipy.stats.binom.cdf(lower - 1, n_node, q)
+    if upper <= n_node:
+        discarded += scipy.stats.binom.sf(upper - 1, n_node, q)
+    return lower, upper, float(discarded)
+
+
 #@memoize
 #def _der_in_admixture_node(n_node):
 #    '''
@@ -562,6 +801,72 @@ def _build_event_tree(G):
 
     return ret
 
+class _DemographyTopology(object):
+    """
+    The graph structure of a Demography, i.e. its "non-differentiable" part.
+
+    Immutable, and stores the lookups used by compute_sfs
+    (event tree, lineage counts, pulse nodes) as tuples and dicts,
+    so that networkx is only needed to construct it.
+    """
+    def __init__(self, G):
+        event_tree = _build_event_tree(G)
+
+        self.sampled_pops = tuple(G.graph['sampled_pops'])
+        self.admixture_tol = G.graph.get('admixture_tol')
+
+        lineages = {v: d['lineages'] for v, d in G.nodes(data=True)
+                    if 'lineages' in d}
+        self.sampled_n = tuple(lineages[(pop, 0)]
+                               for pop in self.sampled_pops)
+        self.n_at_node = {
+            v: sum(lineages[(pop, idx)]
+                   for pop, idx in itertools.chain([v], nx.descendants(G, v))
+                   if idx == 0)
+            for v in G}
+
+        # sorted by edge, so parents have a fixed order
+        self.admixture_parents = {
+            v: tuple(sorted(G.predecessors(v), key=lambda u: str((u, v))))
+            for v, d in G.in_degree() if d == 2}
+
+        self.event_root = event_tree.root
+        self.event_postorder = tuple(nx.dfs_postorder_nodes(event_tree))
+        self.sub_pops = {}
+        self.parent_pops = {}
+        self.child_pops = {}
+        self.event_type = {}
+        self.pulse_nodes = {}
+        for e, d in event_tree.nodes(data=True):
+            self.sub_pops[e] = d['subpops']
+            self.parent_pops[e] = d['parent_pops']
+            self.child_pops[e] = tuple(d['child_pops'].items())
+            if len(e) == 1:
+                self.event_type[e] = 'leaf'
+            elif len(e) == 3:
+                self.event_type[e] = 'pulse'
+                self.pulse_nodes[e] = _get_pulse_nodes(
+                    G, d['parent_pops'], d['child_pops'])
+            elif len(event_tree[e]) == 2:
+                self.event_type[e] = 'merge_clusters'
+            else:
+                self.event_type[e] = 'merge_subpops'
+
+
+def _get_pulse_nodes(G, parent_pops, child_pops_events):
+    assert len(child_pops_events) == 2
+    child_pops, child_events = list(zip(*list(child_pops_events.items())))
+
+    child_in = dict(G.in_degree(child_pops))
+    recipient, = [k for k, v in list(child_in.items()) if v == 2]
+    non_recipient, = [k for k, v in list(child_in.items()) if v == 1]
+
+    parent_out = dict(G.out_degree(parent_pops))
+    donor, = [k for k, v in list(parent_out.items()) if v == 2]
+    non_donor, = [k for k, v in list(parent_out.items()) if v == 1]
+
+    return recipient, non_recipient, donor, non_donor
+
 # methods for constructing demography from string
 
 
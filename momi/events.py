@@ -2,16 +2,41 @@ import collections as co
 import autograd.numpy as np
 import networkx as nx
 import msprime
+import scipy.stats
 from .math_functions import hypergeom_quasi_inverse, binom_coeffs, _apply_error_matrices, convolve_trailing_axes, sum_trailing_antidiagonals
 from .size_history import ConstantHistory, ExponentialHistory, PiecewiseHistory
 
 
 # FIXME: we always assume default_N=1.0 for now
 # NOTE sample_sizes should be an OrderedDict?
-def _build_demo_graph(events, sample_sizes, params_dict, default_N):
-    _G = nx.DiGraph()
+def _build_demo_graph(events, sample_sizes, params_dict, default_N,
+                      admixture_tol=None):
+    return _add_events_to_graph(nx.DiGraph(), events, sample_sizes,
+                                params_dict, default_N, admixture_tol)
+
+
+def _rebind_demo_graph(G, events, sample_sizes, params_dict):
+    """
+    Returns G (a graph returned by _build_demo_graph)
+    with the size histories and pulse probabilities recomputed
+    for new parameter values.
+
+    The graph structure only depends on the order of the events,
+    so events must be in the same order as when G was built.
+    G is not copied, the new values are overlaid on it (see _BoundGraph).
+    """
+    H = _add_events_to_graph(_NumericGraph(), events, sample_sizes,
+                             params_dict, G.graph['default_N'],
+                             G.graph['admixture_tol'])
+    assert len(H.node) == len(G) and len(H.edges) == G.number_of_edges()
+    return _BoundGraph(G, H)
+
+
+def _add_events_to_graph(_G, events, sample_sizes, params_dict, default_N,
+                         admixture_tol):
     #_G.graph['event_cmds'] = tuple(events)
     _G.graph['default_N'] = default_N
+    _G.graph['admixture_tol'] = admixture_tol
     _G.graph['events_as_edges'] = []
     # the nodes currently at the root of the graph, as we build it up from the
     # leafs
@@ -35,6 +60,74 @@ def _build_demo_graph(events, sample_sizes, params_dict, default_N):
     _G.graph["params"] = co.OrderedDict(params_dict)
     return _G
 
+
+class _NumericGraph(object):
+    """
+    Minimal stand-in for networkx.DiGraph, implementing only
+    what is used by the add_to_graph() methods of the events.
+
+    Used by _rebind_demo_graph() to recompute the numeric
+    values of a demography, without building a new networkx graph.
+    """
+    def __init__(self):
+        self.graph = {}
+        self.node = {}
+        self.edges = {}
+
+    def nodes(self):
+        return self.node.keys()
+
+    def add_node(self, v, **attr):
+        self.node.setdefault(v, {}).update(attr)
+
+    def add_edge(self, v, w, **attr):
+        self.edges.setdefault((v, w), {}).update(attr)
+
+    def add_edges_from(self, edges):
+        for v, w in edges:
+            self.add_edge(v, w)
+
+
+class _BoundGraph(object):
+    """
+    Read-only view of a networkx.DiGraph G, with the node and edge
+    attributes of a _NumericGraph H taking precedence over those of G.
+
+    Returned by _rebind_demo_graph(), so that G (the graph structure
+    and the attributes that don't depend on the parameters)
+    is shared between demographies instead of copied.
+    Attributes other than node, graph and the adjacency G[v]
+    are looked up on G, so they only reflect its structure
+    and its parameter-independent attributes.
+    """
+    def __init__(self, G, H):
+        self._G = G
+        self._H = H
+        self.graph = dict(G.graph, params=H.graph['params'])
+        self.node = {v: co.ChainMap(H.node[v], d)
+                     for v, d in G.node.items()}
+
+    def __iter__(self):
+        return iter(self._G)
+
+    def __len__(self):
+        return len(self._G)
+
+    def __contains__(self, v):
+        return v in self._G
+
+    def __getitem__(self, v):
+        return {w: co.ChainMap(self._H.edges.get((v, w), {}), d)
+                for w, d in self._G[v].items()}
+
+    def __getattr__(self, name):
+        # the structural queries (e.g. out_degree(), predecessors())
+        # are the same as for G
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._G, name)
+
+
 class ParamsDict(co.OrderedDict):
     def __getattr__(self, name):
         try:
@@ -85,6 +178,190 @@ class Parameter(object):
             x, params_dict)
 
 
+## built-in parameter transforms and random generators.
+## unlike lambdas or closures, these can be pickled and sent
+## to worker processes along with the DemographicModel
+
+class IdentityTransform(object):
+    def __call__(self, x, params):
+        return x
+
+    def __repr__(self):
+        return "IdentityTransform()"
+
+
+class LogTransform(object):
+    def __call__(self, x, params):
+        return np.log(x)
+
+    def __repr__(self):
+        return "LogTransform()"
+
+
+class ExpTransform(object):
+    def __call__(self, x, params):
+        return np.exp(x)
+
+    def __repr__(self):
+        return "ExpTransform()"
+
+
+class LogitTransform(object):
+    def __call__(self, x, params):
+        return np.log(x/np.array(1-x))
+
+    def __repr__(self):
+        return "LogitTransform()"
+
+
+class ExpitTransform(object):
+    def __call__(self, x, params):
+        return 1/(1+np.exp(-x))
+
+    def __repr__(self):
+        return "ExpitTransform()"
+
+
+class TimeBounds(object):
+    """
+    Bounds on a time parameter, given by constants and
+    by the values of other (time) parameters.
+    """
+    def __init__(self, lower, upper, lower_constraints, upper_constraints):
+        self.lower = lower
+        self.upper = upper
+        self.lower_constraints = list(lower_constraints)
+        self.upper_constraints = list(upper_constraints)
+
+    @property
+    def has_upper(self):
+        return (len(self.upper_constraints) > 0) or (self.upper is not None)
+
+    def lower_bound(self, params):
+        constraints = [params[k] for k in self.lower_constraints]
+        constraints.append(self.lower)
+        return np.max(np.array(constraints))
+
+    def upper_bound(self, params):
+        constraints = [params[k] for k in self.upper_constraints]
+        if self.upper is not None:
+            constraints.append(self.upper)
+        return np.min(np.array(constraints))
+
+    def __repr__(self):
+        return "TimeBounds(lower={}, upper={}, lower_constraints={}, upper_constraints={})".format(
+            self.lower, self.upper, self.lower_constraints,
+            self.upper_constraints)
+
+
+class TimeTransform(object):
+    def __init__(self, bounds):
+        self.bounds = bounds
+
+    def __call__(self, t, params):
+        bounds = self.bounds
+        l = bounds.lower_bound(params)
+        if t < l:
+            raise ValueError(
+                "t = {} < {} = max({})".format(
+                    t, l, [bounds.lower] + bounds.lower_constraints))
+        if bounds.has_upper:
+            u = bounds.upper_bound(params)
+            if t > u:
+                raise ValueError(
+                    "t = {} > {} = min({})".format(
+                        t, u, [bounds.upper] + bounds.upper_constraints))
+
+            x = (t - l) / (u - l)
+            x = np.log(x/(1.-x))
+            return x
+        else:
+            x = t - l
+            return x
+
+    def __repr__(self):
+        return "TimeTransform({})".format(self.bounds)
+
+
+class TimeUntransform(object):
+    def __init__(self, bounds):
+        self.bounds = bounds
+
+    def __call__(self, x, params):
+        l = self.bounds.lower_bound(params)
+        if self.bounds.has_upper:
+            x = 1./(1.+np.exp(-x))
+            u = self.bounds.upper_bound(params)
+            return (1-x)*l + x*u
+        else:
+            return l + x
+
+    def __repr__(self):
+        return "TimeUntransform({})".format(self.bounds)
+
+
+class ConstantRgen(object):
+    def __init__(self, value):
+        self.value = value
+
+    def __call__(self, params):
+        return self.value
+
+    def __repr__(self):
+        return "ConstantRgen({})".format(self.value)
+
+
+class UniformRgen(object):
+    def __init__(self, lower, upper):
+        self.lower = lower
+        self.upper = upper
+
+    def __call__(self, params):
+        return np.random.uniform(self.lower, self.upper)
+
+    def __repr__(self):
+        return "UniformRgen({}, {})".format(self.lower, self.upper)
+
+
+class TruncExponRgen(object):
+    def __init__(self, lower, upper, scale):
+        self.lower = lower
+        self.upper = upper
+        self.scale = scale
+
+    def __call__(self, params):
+        return scipy.stats.truncexpon(
+            b=(self.upper-self.lower)/self.scale,
+            loc=self.lower, scale=self.scale).rvs()
+
+    def __repr__(self):
+        return "TruncExponRgen({}, {}, {})".format(
+            self.lower, self.upper, self.scale)
+
+
+class TimeRgen(object):
+    """
+    Truncated exponential, constrained to satisfy
+    the bounds of a time parameter.
+    """
+    def __init__(self, bounds, scale):
+        self.bounds = bounds
+        self.scale = scale
+
+    def __call__(self, params):
+        l = self.bounds.lower_bound(params)
+        if self.bounds.has_upper:
+            u = self.bounds.upper_bound(params)
+            b = (u-l)/self.scale
+        else:
+            b = float("inf")
+        truncexpon = scipy.stats.truncexpon(b=b, loc=l, scale=self.scale)
+        return truncexpon.rvs()
+
+    def __repr__(self):
+        return "TimeRgen({}, {})".format(self.bounds, self.scale)
+
+
 def get_event_from_old(oldstyle_event):
     flag, t = oldstyle_event[:2]
     rest = oldstyle_event[2:]
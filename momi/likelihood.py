@@ -1,22 +1,35 @@
-import json
+import contextlib
+import copy
 import functools
+import itertools
+import collections as co
+import concurrent.futures
 import logging
+import os
+import threading
 import time
 import autograd.numpy as np
 import scipy
+import scipy.sparse
+import scipy.sparse.linalg
 import autograd as ag
 from autograd.extend import primitive, defvjp
-from .optimizers import _find_minimum, stochastic_opts, LoggingCallback
-from .compute_sfs import expected_sfs, expected_total_branch_len, expected_heterozygosity
+from autograd.tracer import isbox, getval
+from .optimizers import _find_minimum, stochastic_opts, LoggingCallback, trust_krylov, _grad_and_hvp
+from .compute_sfs import expected_sfs, expected_total_branch_len, expected_heterozygosity, _expected_sfs_bytes_per_row
 from .demography import Demography
 from .data.configurations import _ConfigList_Subset
 from .data.sfs import Sfs
+from .telemetry import TelemetrySink, _get_sink, _IterationTelemetry
+from .util import parse_memory_size, hessian_from_hvps, load_checkpoint, _thread_local_traces, _set_omp_num_threads
 
 logger = logging.getLogger(__name__)
 
+_demo_func_lock = threading.RLock()
+
 
 class SfsLikelihoodSurface(object):
-    def __init__(self, data, demo_func=None, mut_rate=None, length=1, log_prior=None, folded=False, error_matrices=None, truncate_probs=1e-100, batch_size=1000, p_missing=0.0, use_pairwise_diffs=False):
+    def __init__(self, data, demo_func=None, mut_rate=None, length=1, log_prior=None, folded=False, error_matrices=None, truncate_probs=1e-100, batch_size=1000, p_missing=0.0, use_pairwise_diffs=False, memory_budget=None, n_threads=None, threads_per_worker=None, eval_cache_size=64, telemetry=None):
         """
         Object for computing composite likelihoods, and searching for the maximum composite likelihood.
 
@@ -44,6 +57,40 @@ class SfsLikelihoodSurface(object):
             controls the memory usage. the SFS will be computed in batches of batch_size.
             Decrease batch_size to decrease memory usage (but add running time overhead).
             set batch_size=-1 to compute all SNPs in a single batch. This is required if you wish to compute hessians or higher-order derivatives with autograd.
+        memory_budget: int or str or None
+            if not None, overrides batch_size, choosing the batch size
+            so that computing the likelihood and its gradient for a batch
+            takes roughly this many bytes of memory (e.g. "4GB").
+            The memory per SFS entry is estimated from the tensor shapes
+            of the demography on the first evaluation,
+            and the resulting plan is logged and stored in self.batch_plan.
+        n_threads: int or None
+            if > 1, the batches are evaluated concurrently
+            on a pool of n_threads threads.
+            The values and gradients of the batches are summed in
+            a fixed order, so the result does not depend on the
+            thread scheduling.
+            Vector-valued likelihoods (vector=True) are always
+            evaluated serially.
+            Hessians (e.g. find_mle(hess=True)) are computed
+            one column at a time, and the columns are spread
+            over the n_threads threads instead.
+        threads_per_worker: int or None
+            the number of OpenMP threads used by the compiled kernels
+            within each of the n_threads threads.
+            Default is to divide the available cores evenly between them.
+        eval_cache_size: int
+            the number of recent evaluations
+            (log-likelihoods, gradients, hessians and hessian-vector products in find_mle)
+            to remember, keyed by the exact parameter vector,
+            so that revisiting a point does not recompute it.
+            Set to 0 to disable. See eval_cache_info().
+        telemetry: momi.TelemetrySink or str or None
+            where find_mle() and stochastic_find_mle() stream
+            the events of each fit by default.
+            If a TelemetrySink, the surface also writes its own
+            events (e.g. "batch_plan") to it.
+            If a str, a TelemetrySink is opened on it for each fit.
         processes:
             the number of cores to use.
             if <= 0 (the default), do not use any parallelization.
@@ -80,10 +127,27 @@ class SfsLikelihoodSurface(object):
         self.log_prior = log_prior
         self.batch_size = batch_size
 
-        if batch_size <= 0:
-            self.sfs_batches = None
+        if memory_budget is not None:
+            memory_budget = parse_memory_size(memory_budget)
+        self.memory_budget = memory_budget
+        self._init_batches()
+
+        self.n_threads = n_threads
+        if threads_per_worker is None and n_threads:
+            threads_per_worker = max(1, (os.cpu_count() or 1) // n_threads)
+        self.threads_per_worker = threads_per_worker
+        self._batch_executor = None
+
+        self._eval_cache = _EvalCache(eval_cache_size)
+        self._fit_ids = itertools.count()
+        self._eval_counts = co.Counter()
+        self._eval_counts_lock = threading.Lock()
+
+        self.telemetry = telemetry
+        if isinstance(telemetry, TelemetrySink):
+            self._telemetry_sink = telemetry
         else:
-            self.sfs_batches = _build_sfs_batches(self.sfs, batch_size)
+            self._telemetry_sink = None
 
         self.p_missing = p_missing
 
@@ -93,32 +157,177 @@ class SfsLikelihoodSurface(object):
             raise ValueError(
                 "Expected total branch length not implemented for missing data; set use_pairwise_diffs=True to scale total mutations by the pairwise differences instead.")
 
+    def _init_batches(self):
+        self.batch_plan = None
+        if self.memory_budget is not None:
+            # batches are planned on the first evaluation,
+            # see _plan_batches()
+            self.sfs_batches = None
+        elif self.batch_size <= 0:
+            self.sfs_batches = None
+        else:
+            self.sfs_batches = _build_sfs_batches(self.sfs, self.batch_size)
+
     def log_lik(self, x, vector=False):
         """
         Returns the composite log-likelihood of the data at the point x.
         """
-        ret = self._log_lik(x, vector=vector)
+        if vector or not self._use_eval_cache(x):
+            ret = self._log_lik(x, vector=vector)
+        elif isbox(x):
+            ret = _cached_log_lik(x, self)
+        else:
+            key = _eval_key("log_lik", x)
+            ret = self._eval_cache.get(key)
+            if ret is None:
+                ret = self._log_lik(x, False)
+                self._eval_cache.put(key, ret)
         logger.debug("log-likelihood = {0}".format(ret))
         return ret
 
+    def eval_cache_info(self):
+        """
+        Statistics of the evaluation cache, as a namedtuple
+        (hits, misses, maxsize, currsize), like functools.lru_cache.
+        hits and misses are dicts keyed by the kind of evaluation
+        ("log_lik", "grad", "hess", or "hessp").
+        """
+        return self._eval_cache.info()
+
+    def _use_eval_cache(self, x):
+        # the cache is keyed by concrete parameter vectors,
+        # so skip it for higher-order derivatives and Demography objects
+        return (self._eval_cache.maxsize > 0 and self.demo_func is not None
+                and not (isbox(x) and isbox(x._value)))
+
+    def _log_lik_and_grad(self, x, count=True):
+        key = _eval_key("grad", x)
+        ret = self._eval_cache.get(key, count=count)
+        if ret is None:
+            ret = ag.value_and_grad(self._log_lik)(x, False)
+            self._eval_cache.put(key, ret)
+            self._eval_cache.put(_eval_key("log_lik", x), ret[0])
+        return ret
+
     def _score(self, x):
         return ag.grad(self.log_lik)(x)
 
     def _fisher(self, x):
-        return -ag.hessian(self.log_lik)(x)
+        return -self._hessian(self.log_lik, x)
+
+    def _hessian(self, fun, x):
+        return hessian_from_hvps(fun, x, n_workers=self.n_threads,
+                                 threads_per_worker=self.threads_per_worker)
 
     def _score_cov(self, params):
-        params = np.array(params)
+        j = self._locus_scores(np.array(params))
+        # centralize
+        j = j - np.mean(j, axis=0)
+        return np.einsum('ij, ik', j, j)
+
+    def _locus_scores(self, x):
+        """
+        Gradients of log_lik(x, vector=True), as an array with
+        shape (n_loci, len(x)).
+
+        The loci are the columns of sfs.freqs_matrix, so this is the
+        jacobian of log_lik_replicates() with counts=sfs.freqs_matrix.
+        It is computed one batch of configs at a time, contracting
+        the batch's rows of freqs_matrix with the jacobian of the
+        batch's log-probabilities (see rearrange_dict_jacobian()),
+        so the memory is bounded by the batch size rather than
+        growing with the number of configs.
+        """
+        counts = self.sfs.freqs_matrix
+        n_loci = counts.shape[1]
 
-        def f_vec(x):
-            ret = self._log_lik(x, vector=True)
-            # centralize
-            return ret - np.mean(ret)
+        def locus_log_liks(x):
+            ret = self._raw_log_lik_replicates(x, counts, 1.0)
+            return ret + self._log_prior(x) / n_loci
+        return ag.jacobian(locus_log_liks)(x)
 
-        j = ag.jacobian(f_vec)(params)
-        return np.einsum('ij, ik', j, j)
+    def log_lik_replicates(self, x, counts, mut_rate_scale=1.0):
+        """
+        Returns the composite log-likelihoods of many replicates
+        of the data (e.g. bootstrap or jackknife replicates)
+        at the point x.
+
+        The replicates share the configs of self.sfs, so the expected SFS
+        is only computed once, and the log-likelihoods of all replicates
+        are then a single sparse matrix-vector product.
+
+        Each replicate is treated as a single locus, like the full
+        data after Sfs.combine_loci().
+
+        Parameters
+        ==========
+        x: point to evaluate the log-likelihoods at
+        counts: sparse matrix or LinearOperator of shape (n_configs, n_reps)
+            counts[i,j] is the count of the i-th config of self.sfs
+            in replicate j. See Sfs.replicate_counts()
+        mut_rate_scale: float or array of length n_reps
+            The mutation rate (i.e. the length) of each replicate,
+            relative to the full data.
+            Only used if mut_rate is not None.
+        """
+        return self._log_lik_replicates(x, counts, mut_rate_scale)
+
+    def _score_replicates(self, x, counts, mut_rate_scale=1.0):
+        """
+        Gradients of log_lik_replicates(), as an array with
+        shape (n_reps, len(x)).
+
+        The expected SFS and the jacobian of its log are computed
+        once per batch, and then contracted with the batch's counts,
+        so the cost does not grow with the number of replicates.
+        """
+        return ag.jacobian(self._log_lik_replicates)(
+            x, counts, mut_rate_scale)
+
+    def _log_lik_replicates(self, x, counts, mut_rate_scale):
+        if self.mut_rate is not None and self.sfs.n_loci > 1:
+            raise ValueError(
+                "Replicate log-likelihoods treat the data as a single locus,"
+                " use Sfs.combine_loci() to construct the surface")
+        return (self._raw_log_lik_replicates(x, counts, mut_rate_scale)
+                + self._log_prior(x))
+
+    def _raw_log_lik_replicates(self, x, counts, mut_rate_scale):
+        # the log-likelihoods of the replicates, without the log-prior
+        if counts.shape[0] != len(self.sfs.configs):
+            raise ValueError(
+                "counts should have one row per config of the SFS")
+        if not isinstance(counts, scipy.sparse.linalg.LinearOperator):
+            counts = scipy.sparse.csr_matrix(counts)
+
+        demo = self._get_multipop_moran(x)
+        self._plan_batches(demo)
+        if self.sfs_batches:
+            batches = self.sfs_batches
+        else:
+            batches = [self.sfs]
+        G = demo._get_graph_structure()
+        cache = demo._get_differentiable_part()
+
+        ret = 0.0
+        start = 0
+        for batch in batches:
+            end = start + len(batch.configs)
+            ret = ret + _raw_replicate_log_lik(
+                cache, G, batch, _counts_rows(counts, start, end),
+                self.truncate_probs, self.folded,
+                self.error_matrices, jacobian=isbox(x))
+            start = end
+        assert start == counts.shape[0]
+
+        if self.mut_rate is not None:
+            ret = ret + _mut_factor_replicates(
+                self.sfs, demo, self.mut_rate * mut_rate_scale, counts,
+                self.p_missing, self.use_pairwise_diffs)
+        return ret
 
     def _log_lik(self, x, vector):
+        self._count_eval(x)
         demo = self._get_multipop_moran(x)
         ret = self._get_multinom_loglik(demo, vector=vector) + self._mut_factor(demo, vector=vector)
         if vector:
@@ -127,17 +336,84 @@ class SfsLikelihoodSurface(object):
             ret = ret + self._log_prior(x)
         return ret
 
+    def _count_eval(self, x, prefix=""):
+        # counts the evaluations by order of derivative, for the telemetry
+        if not isbox(x):
+            kind = "log_lik"
+        elif isbox(x._value):
+            kind = "hess"
+        else:
+            kind = "grad"
+        with self._eval_counts_lock:
+            self._eval_counts[prefix + kind] += 1
+
     def _get_multipop_moran(self, x):
         if self.demo_func:
             logger.debug(
                 "Computing log-likelihood at x = {0}".format(str(x).replace('\n', '')))
-            demo = self.demo_func(*x)
+            # demo_func may not be thread-safe, e.g.
+            # DemographicModel._demo_fun() temporarily sets the parameters
+            with _demo_func_lock:
+                demo = self.demo_func(*x)
         else:
             demo = x
         return demo
 
+    def _plan_batches(self, demo):
+        if self.memory_budget is None or self.batch_plan is not None:
+            return
+
+        # the memory only depends on the shapes, so use the
+        # plain values of the demography to avoid autograd tracing
+        plain_demo = Demography(
+            demo._get_graph_structure(),
+            cache={k: getval(v) for k, v in
+                   demo._get_differentiable_part().items()})
+        bytes_per_row = _expected_sfs_bytes_per_row(plain_demo)
+
+        # each config may need several rows in expected_sfs_tensor_prod()
+        n_configs = len(self.sfs.configs)
+        n_rows = len(self.sfs.configs._augmented_configs(self.folded))
+        bytes_per_config = bytes_per_row * n_rows / float(n_configs)
+
+        batch_size = int(self.memory_budget // bytes_per_config)
+        if batch_size < 1:
+            logger.warning(
+                "memory_budget={} bytes is less than the {} bytes estimated"
+                " for a single SFS entry".format(
+                    self.memory_budget, int(bytes_per_config)))
+            batch_size = 1
+        batch_size = min(batch_size, n_configs)
+        self.sfs_batches = _build_sfs_batches(self.sfs, batch_size)
+
+        self.batch_plan = co.OrderedDict([
+            ("memory_budget", self.memory_budget),
+            ("bytes_per_config", bytes_per_config),
+            ("n_configs", n_configs),
+            ("batch_size", batch_size),
+            ("n_batches", len(self.sfs_batches)),
+            ("peak_bytes", int(bytes_per_config * batch_size))])
+        self._emit("batch_plan", **self.batch_plan)
+        logger.info("Batch plan: {}".format(dict(self.batch_plan)))
+
+    def _get_batch_executor(self):
+        if self._batch_executor is None:
+            self._batch_executor = concurrent.futures.ThreadPoolExecutor(
+                self.n_threads, initializer=_set_omp_num_threads,
+                initargs=(self.threads_per_worker,))
+        return self._batch_executor
+
     def _get_multinom_loglik(self, demo, vector):
-        if self.sfs_batches:
+        self._plan_batches(demo)
+        if (self.sfs_batches and not vector and self.n_threads
+                and self.n_threads > 1 and len(self.sfs_batches) > 1):
+            G = demo._get_graph_structure()
+            cache = demo._get_differentiable_part()
+            ret = _threaded_raw_log_lik(
+                cache, G, self.sfs_batches,
+                self.truncate_probs, self.folded,
+                self.error_matrices, self._get_batch_executor())
+        elif self.sfs_batches:
             G = demo._get_graph_structure()
             cache = demo._get_differentiable_part()
             ret = 0.0
@@ -172,7 +448,9 @@ class SfsLikelihoodSurface(object):
         """
         Returns KL-Divergence(Empirical || Theoretical(x)).
         """
-        log_lik = self.log_lik(x)
+        return self._kl_div_from_log_lik(self.log_lik(x))
+
+    def _kl_div_from_log_lik(self, log_lik):
         #ret = -log_lik + self.sfs.n_snps() * self.sfs._entropy + _entropy_mut_term(self.mut_rate, self.sfs, self.p_missing, self.use_pairwise_diffs)
         ret = -log_lik + self.sfs.n_snps() * self.sfs._entropy
         if self.mut_rate:
@@ -184,7 +462,7 @@ class SfsLikelihoodSurface(object):
                 str(ret), str(log_lik), str(self.sfs.n_snps()))
         return ret
 
-    def find_mle(self, x0, method="tnc", jac=True, hess=False, hessp=False, bounds=None, callback=None, **kwargs):
+    def find_mle(self, x0, method="tnc", jac=True, hess=False, hessp=False, bounds=None, callback=None, telemetry=None, **kwargs):
         """
         Search for the maximum of the likelihood surface
         (i.e., the minimum of the KL-divergence).
@@ -196,12 +474,23 @@ class SfsLikelihoodSurface(object):
         method : str
                  Can be any method from scipy.optimize.minimize()
                  (e.g. "tnc","L-BFGS-B",etc.)
+                 "trust-krylov" uses momi's own trust-region Newton-CG
+                 (see momi.optimizers.trust_krylov), which respects the bounds,
+                 and computes the hessian-vector products of each iteration
+                 through its traced gradient (jac, hess, hessp are ignored).
+                 Its result also has the numbers of
+                 function/gradient/hessian-vector product evaluations
+                 in each iteration (evaluations).
         jac : bool
               If True, compute gradient automatically, and pass into the optimization method.
               If False, don't pass in gradient to the optimization method.
         hess, hessp: bool
               Pass hessian/hessian-vector-product into the optimization method.
-              Only implemented for some scipy optimizers, and may have high memory cost.
+              Only implemented for some scipy optimizers.
+              The hessian is built column by column from
+              hessian-vector products, so its memory cost does not
+              grow with the number of parameters, but it costs
+              one hessian-vector product per parameter.
         bounds : list of pairs [(lower0,higher0),...]
               As in scipy.optimize.minimize.
               If None, then do unbounded optimization.
@@ -216,6 +505,10 @@ class SfsLikelihoodSurface(object):
               attributes, x.iteration and x.fun, that allow the callback
               function to access the current iteration number and the current
               objective function value.
+        telemetry: momi.TelemetrySink or str or None
+              where to stream the events of this fit (see momi.TelemetrySink);
+              if a str, a TelemetrySink for the fit is opened on this target.
+              Default is self.telemetry.
         **kwargs : additional arguments to pass to scipy.optimize.minimize()
 
         Notes
@@ -227,19 +520,28 @@ class SfsLikelihoodSurface(object):
         print_progress = LoggingCallback(user_callback=callback).callback
         hist = lambda: None
         hist.itr = 0
+        hist.telemetry = None
         hist.recent_vals = []
         starttime = time.time()
 
         def callback(x):
-            for y, fx in reversed(hist.recent_vals):
-                if np.allclose(y, x):
-                    break
-            assert np.allclose(y, x)
-            try:
-                fx = fx.value
-            except AttributeError:
-                pass
+            fx = None
+            if self._use_eval_cache(x):
+                log_lik = self._eval_cache.get(
+                    _eval_key("log_lik", x), count=False)
+                if log_lik is not None:
+                    fx = self._kl_div_from_log_lik(log_lik)
+            if fx is None:
+                for y, fx in reversed(hist.recent_vals):
+                    if np.allclose(y, x):
+                        break
+                assert np.allclose(y, x)
+            # fx may be boxed more than once, e.g. by trust-krylov,
+            # whose trial points are traced for hessian-vector products
+            fx = getval(fx)
             print_progress(x, fx, hist.itr)
+            if hist.telemetry is not None:
+                hist.telemetry.iteration(hist.itr, x, fx)
             hist.itr += 1
             hist.recent_vals = [(x, fx)]
 
@@ -253,10 +555,15 @@ class SfsLikelihoodSurface(object):
             replacefun = None
 
         gradmakers = {}
+        # x may be restricted to the non-fixed parameters,
+        # so key the cached derivatives by this particular fit
+        fit_id = next(self._fit_ids)
         if hess:
-            gradmakers['hess'] = ag.hessian
+            gradmakers['hess'] = lambda f: self._eval_cache.memoize(
+                functools.partial(self._hessian, f), "hess", fit_id)
         if hessp:
-            gradmakers['hessp'] = ag.hessian_vector_product
+            gradmakers['hessp'] = lambda f: self._eval_cache.memoize(
+                ag.hessian_vector_product(f), "hessp", fit_id)
 
         @functools.wraps(self.kl_div)
         def fun(x):
@@ -264,9 +571,50 @@ class SfsLikelihoodSurface(object):
             hist.recent_vals += [(x, ret)]
             return ret
 
-        return _find_minimum(fun, x0, scipy.optimize.minimize,
-                             bounds=bounds, callback=callback,
-                             opt_kwargs=opt_kwargs, gradmakers=gradmakers, replacefun=replacefun)
+        optimizer = scipy.optimize.minimize
+        if method == "trust-krylov":
+            optimizer = trust_krylov
+            opt_kwargs = dict(kwargs)
+            gradmakers = {"grad_and_hvp": _grad_and_hvp}
+            replacefun = None
+
+        with self._telemetry_fit(telemetry, method=str(method),
+                                 x0=x0) as hist.telemetry:
+            try:
+                res = _find_minimum(fun, x0, optimizer,
+                                    bounds=bounds, callback=callback,
+                                    opt_kwargs=opt_kwargs, gradmakers=gradmakers, replacefun=replacefun)
+            except Exception as e:
+                if hist.telemetry is not None:
+                    hist.telemetry.end(error=e)
+                raise
+            if hist.telemetry is not None:
+                hist.telemetry.end(res)
+        return res
+
+    @contextlib.contextmanager
+    def _telemetry_fit(self, telemetry, **fit_fields):
+        # yields the _IterationTelemetry of a fit (or None),
+        # and sends the surface's own events to the same sink meanwhile
+        if telemetry is None:
+            telemetry = self.telemetry
+        sink, close_sink = _get_sink(telemetry)
+        if sink is None:
+            yield None
+            return
+        prev_sink, self._telemetry_sink = self._telemetry_sink, sink
+        try:
+            yield _IterationTelemetry(
+                sink, self, n_snps=self.sfs.n_snps(),
+                n_configs=len(self.sfs.configs), **fit_fields)
+        finally:
+            self._telemetry_sink = prev_sink
+            if close_sink:
+                sink.close()
+
+    def _emit(self, event, **fields):
+        if self._telemetry_sink is not None:
+            self._telemetry_sink.emit(event, **fields)
 
 
     def stochastic_find_mle(
@@ -274,7 +622,7 @@ class SfsLikelihoodSurface(object):
             bounds=None, callback=None,
             checkpoint_file=None, checkpoint_iter=10,
             svrg_epoch=-1, b1=0.9, b2=0.999, eps=10**-8,
-            rgen=np.random):
+            rgen=np.random, telemetry=None):
         """
         Search for maximum likelihood using ADAM-style
         stochastic gradient descent.
@@ -284,7 +632,9 @@ class SfsLikelihoodSurface(object):
         x0: numpy.array or str
             The starting point for the optimization.
             If a string, a path to the checkpoint file of
-            a previous run.
+            a previous run, which is then continued exactly as if
+            it had not been interrupted (given the same rgen,
+            snps_per_minibatch and other arguments).
         snps_per_minibatch: int
             The number of SNPs per minibatch
         stepsize: float
@@ -294,7 +644,10 @@ class SfsLikelihoodSurface(object):
         callback: function
             function to call at every step
         checkpoint_file: None or str
-            File to save intermediate progress
+            File to save intermediate progress.
+            Checkpoints are written in the background, and atomically
+            replace the previous checkpoint, so the file is never
+            left half-written.
         checkpoint_iter: int
             Number of iterations between saving intermediate progress
         logging_freq: int
@@ -313,6 +666,8 @@ class SfsLikelihoodSurface(object):
 
             Alternatively, use numpy.random.RandomState to create
             a separate random generator and pass it in here.
+        telemetry: momi.TelemetrySink or str or None
+            where to stream the events of this fit, see find_mle()
         """
         kwargs = {}
         kwargs["stepsize"] = stepsize
@@ -325,10 +680,10 @@ class SfsLikelihoodSurface(object):
         kwargs["checkpoint_iter"] = checkpoint_iter
         kwargs["callback"] = callback
         kwargs["bounds"] = bounds
+        kwargs["telemetry"] = telemetry
 
         if isinstance(x0, str):
-            with open(x0) as f:
-                kwargs.update(json.load(f))
+            kwargs.update(_load_stochastic_checkpoint(x0, rgen))
         else:
             kwargs["x0"] = x0
 
@@ -337,17 +692,24 @@ class SfsLikelihoodSurface(object):
             rgen=rgen).find_mle(**kwargs)
 
     def _get_stochastic_pieces(self, pieces, rgen):
-        sfs_pieces = _subsfs_list(self.sfs, pieces, rgen)
-        if self.mut_rate is None:
-            mut_rate = None
-        else:
-            mut_rate = self.mut_rate * np.ones(self.sfs.n_loci)
-            mut_rate = np.sum(mut_rate) / float(pieces)
-
-        return [SfsLikelihoodSurface(sfs, demo_func=self.demo_func, mut_rate=None,
-                                     folded=self.folded, error_matrices=self.error_matrices,
-                                     truncate_probs=self.truncate_probs, batch_size=self.batch_size)
-                for sfs in sfs_pieces]
+        if self.n_threads and self.n_threads > 1:
+            # start the thread pool, so the minibatches share it
+            self._get_batch_executor()
+        return [self._minibatch_surface(sfs)
+                for sfs in _subsfs_list(self.sfs, pieces, rgen)]
+
+    def _minibatch_surface(self, sfs):
+        # surface for a minibatch of self.sfs, with the same settings.
+        # sfs is a view into self.sfs (see _subsfs_list()),
+        # so it is already folded, and shares its precomputed configs
+        ret = copy.copy(self)
+        ret.data = ret.sfs = sfs
+        ret.mut_rate = None
+        ret.log_prior = None
+        ret._eval_cache = _EvalCache(self._eval_cache.maxsize)
+        ret._eval_counts = co.Counter()
+        ret._init_batches()
+        return ret
 
     def _stochastic_surfaces(self, n_minibatches=None, snps_per_minibatch=None, rgen=np.random):
         """
@@ -375,6 +737,8 @@ class StochasticSfsLikelihoodSurface(object):
         except (TypeError, AssertionError):
             raise ValueError("pieces should be a positive integer")
 
+        # saved in checkpoints, to recreate the minibatches on resuming
+        self._partition_rng_state = rgen.get_state()
         self.pieces = full_surface._get_stochastic_pieces(pieces, rgen)
         self.total_snp_counts = full_surface.sfs._total_freqs
         logger.info("Created {n_batches} minibatches, with an average of {n_snps} SNPs and {n_sfs} unique SFS entries per batch".format(n_batches=len(
@@ -383,6 +747,16 @@ class StochasticSfsLikelihoodSurface(object):
         self.rgen = rgen
         self.full_surface = full_surface
 
+    def repartition(self, rgen=None):
+        """
+        Randomly re-split the SNPs into the same number of minibatches.
+        """
+        if not rgen:
+            rgen = self.rgen
+        self._partition_rng_state = rgen.get_state()
+        self.pieces = self.full_surface._get_stochastic_pieces(
+            self.n_minibatches, rgen)
+
     def get_minibatch(self, i): return self.pieces[i].sfs
 
     @property
@@ -391,26 +765,85 @@ class StochasticSfsLikelihoodSurface(object):
     def avg_neg_log_lik(self, x, i):
         if i is None:
             return -self.full_surface.log_lik(x) / self.full_surface.sfs.n_snps()
+        self.full_surface._count_eval(x, prefix="minibatch_")
         demo = self.full_surface._get_multipop_moran(x)
         ret = -self.pieces[i]._get_multinom_loglik(demo, False) * self.n_minibatches
         ret = ret - self.full_surface._mut_factor(demo, False) - self.full_surface._log_prior(x)
         return ret / self.full_surface.sfs.n_snps()
 
-    def find_mle(self, x0, method="adam", bounds=None, rgen=None, callback=None, **kwargs):
+    def find_mle(self, x0, method="adam", bounds=None, rgen=None, callback=None, repartition=False, telemetry=None, **kwargs):
+        """
+        If repartition is True, the SNPs are re-split into
+        new random minibatches after every epoch
+        (i.e. every n_minibatches iterations).
+
+        telemetry is as in SfsLikelihoodSurface.find_mle(),
+        and defaults to the telemetry of the full surface.
+        """
+        with self.full_surface._telemetry_fit(
+                telemetry, method=method,
+                n_minibatches=self.n_minibatches) as telemetry:
+            try:
+                res = self._find_mle(x0, method, bounds, rgen, callback,
+                                     repartition, telemetry, **kwargs)
+            except Exception as e:
+                if telemetry is not None:
+                    telemetry.end(error=e)
+                raise
+            if telemetry is not None:
+                telemetry.end(res)
+        return res
+
+    def _find_mle(self, x0, method, bounds, rgen, callback, repartition,
+                  telemetry, **kwargs):
         if not rgen:
             rgen = self.rgen
         callback = LoggingCallback(user_callback=callback).callback
 
+        if telemetry is not None:
+            log_callback = callback
+
+            def callback(x, fx, i):
+                log_callback(x, fx, i)
+                telemetry.iteration(i, x, fx)
+
+        if repartition:
+            log_callback = callback
+
+            def callback(x, fx, i):
+                log_callback(x, fx, i)
+                if (i + 1) % self.n_minibatches == 0:
+                    self.repartition(rgen)
+
         full_surface = self.full_surface
 
         opt_kwargs = dict(kwargs)
+        # the minibatches of a checkpoint are recreated before this surface,
+        # see _load_stochastic_checkpoint()
+        opt_kwargs.pop('partition_rng_state', None)
         opt_kwargs.update({'pieces': self.n_minibatches, 'rgen': rgen})
+        if opt_kwargs.get('checkpoint_file') is not None:
+            opt_kwargs['checkpoint_extra'] = lambda: {
+                'partition_rng_state': self._partition_rng_state}
 
         return _find_minimum(self.avg_neg_log_lik, x0, optimizer=stochastic_opts[method],
                              bounds=bounds, callback=callback, opt_kwargs=opt_kwargs,
                              gradmakers={'fun_and_jac': ag.value_and_grad})
 
 
+def _load_stochastic_checkpoint(checkpoint_file, rgen):
+    """
+    Returns the optimizer state saved in checkpoint_file, after
+    setting rgen to its state when the current minibatches were drawn,
+    so that the minibatches are recreated exactly.
+    """
+    state = load_checkpoint(checkpoint_file)
+    partition_rng_state = state.pop("partition_rng_state", None)
+    if partition_rng_state is not None:
+        rgen.set_state(partition_rng_state)
+    return state
+
+
 def _composite_log_likelihood(data, demo, mut_rate=None, truncate_probs=0.0, vector=False, p_missing=None, use_pairwise_diffs=False, **kwargs):
     try:
         sfs = data.sfs
@@ -441,6 +874,38 @@ def _mut_factor(sfs, demo, mut_rate, vector, p_missing, use_pairwise_diffs):
 
 def _mut_factor_het(sfs, demo, mut_rate, vector, p_missing):
     mut_rate = mut_rate * np.ones(sfs.n_loci)
+    ret = _poisson_het_log_lik(sfs, demo, mut_rate, sfs.avg_pairwise_hets,
+                               p_missing)
+    if not vector:
+        ret = np.sum(ret)
+    else:
+        ret = np.sum(ret, axis=1)
+    return ret
+
+
+def _mut_factor_total(sfs, demo, mut_rate, vector):
+    mut_rate = mut_rate * np.ones(sfs.n_loci)
+    ret = _poisson_total_log_lik(sfs, demo, mut_rate,
+                                 sfs.n_snps(vector=True))
+    if not vector:
+        ret = np.sum(ret)
+    return ret
+
+
+def _mut_factor_replicates(sfs, demo, mut_rate, counts,
+                           p_missing, use_pairwise_diffs):
+    # counts is the (n_configs, n_reps) matrix of replicate counts
+    mut_rate = mut_rate * np.ones(counts.shape[1])
+    if use_pairwise_diffs:
+        hets = counts.T.dot(sfs._pairwise_het_probs)
+        return np.sum(_poisson_het_log_lik(sfs, demo, mut_rate, hets,
+                                           p_missing), axis=1)
+    else:
+        n_snps = counts.T.dot(np.ones(counts.shape[0]))
+        return _poisson_total_log_lik(sfs, demo, mut_rate, n_snps)
+
+
+def _poisson_het_log_lik(sfs, demo, mut_rate, avg_pairwise_hets, p_missing):
     E_het = expected_heterozygosity(
         demo,
         restrict_to_pops=np.array(
@@ -450,32 +915,20 @@ def _mut_factor_het(sfs, demo, mut_rate, vector, p_missing):
     p_missing = p_missing[sfs.ascertainment_pop]
     lambd = np.einsum("i,j->ij", mut_rate, E_het * (1.0 - p_missing))
 
-    counts = sfs.avg_pairwise_hets[:, sfs.ascertainment_pop]
+    counts = avg_pairwise_hets[:, sfs.ascertainment_pop]
     ret = -lambd + counts * np.log(lambd) - scipy.special.gammaln(counts + 1)
-    ret = ret * sfs.sampled_n[sfs.ascertainment_pop] / float(
+    return ret * sfs.sampled_n[sfs.ascertainment_pop] / float(
         np.sum(sfs.sampled_n[sfs.ascertainment_pop]))
-    if not vector:
-        ret = np.sum(ret)
-    else:
-        ret = np.sum(ret, axis=1)
-    return ret
-
 
-def _mut_factor_total(sfs, demo, mut_rate, vector):
-    mut_rate = mut_rate * np.ones(sfs.n_loci)
 
+def _poisson_total_log_lik(sfs, demo, mut_rate, n_snps):
     if sfs.configs.has_missing_data:
         raise ValueError(
             "Expected total branch length not implemented for missing data; set use_pairwise_diffs=True to scale total mutations by the pairwise differences instead.")
     E_total = expected_total_branch_len(
         demo, sampled_pops=sfs.sampled_pops, sampled_n=sfs.sampled_n, ascertainment_pop=sfs.ascertainment_pop)
     lambd = mut_rate * E_total
-
-    counts = sfs.n_snps(vector=True)
-    ret = -lambd + counts * np.log(lambd) - scipy.special.gammaln(counts + 1)
-    if not vector:
-        ret = np.sum(ret)
-    return ret
+    return -lambd + n_snps * np.log(lambd) - scipy.special.gammaln(n_snps + 1)
 
 def rearrange_dict_grad(fun):
     """
@@ -494,7 +947,13 @@ def rearrange_dict_grad(fun):
     def wrapped_fun_helper_grad(ans, xdict, dummy):
         def grad(g):
             #print("foo")
-            return {k:g*v for k,v in dummy.cache.items()}
+            if isbox(xdict):
+                # taking a higher-order derivative, so the gradient
+                # must be recomputed as a function of xdict
+                cache = ag.checkpoint(ag.grad(fun))(xdict)
+            else:
+                cache = dummy.cache
+            return {k:g*v for k,v in cache.items()}
         return grad
     defvjp(wrapped_fun_helper, wrapped_fun_helper_grad, None)
 
@@ -516,6 +975,228 @@ def _raw_log_lik(cache, G, data, truncate_probs, folded, error_matrices, vector=
         return rearrange_dict_grad(wrapped_fun)(cache)
 
 
+EvalCacheInfo = co.namedtuple(
+    "EvalCacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+
+class _EvalCache(object):
+    """
+    Least-recently-used cache of evaluations of a likelihood surface.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize or 0
+        self._entries = co.OrderedDict()
+        self._hits = co.Counter()
+        self._misses = co.Counter()
+        self._lock = threading.Lock()
+
+    def get(self, key, count=True):
+        with self._lock:
+            try:
+                ret = self._entries[key]
+            except KeyError:
+                if count:
+                    self._misses[key[0]] += 1
+                return None
+            self._entries.move_to_end(key)
+            if count:
+                self._hits[key[0]] += 1
+            return ret
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def memoize(self, fun, kind, tag=None):
+        if self.maxsize <= 0:
+            return fun
+
+        @functools.wraps(fun)
+        def cached_fun(x, *args):
+            key = _eval_key(kind, x, *args) + (tag,)
+            ret = self.get(key)
+            if ret is None:
+                ret = fun(x, *args)
+                self.put(key, ret)
+            return ret
+        return cached_fun
+
+    def info(self):
+        return EvalCacheInfo(dict(self._hits), dict(self._misses),
+                             self.maxsize, len(self._entries))
+
+
+def _eval_key(kind, *arrays):
+    arrays = [np.asarray(getval(a), dtype=float) for a in arrays]
+    return (kind,) + tuple((a.shape, a.tobytes()) for a in arrays)
+
+
+@primitive
+def _cached_log_lik(x, surface):
+    # the gradient is computed alongside the value,
+    # so it can be reused by the backward pass and by later calls
+    return surface._log_lik_and_grad(x)[0]
+
+
+def _cached_log_lik_vjp(ans, x, surface):
+    grad = surface._log_lik_and_grad(x, count=False)[1]
+    return lambda g: g * grad
+defvjp(_cached_log_lik, _cached_log_lik_vjp)
+
+
+def _threaded_raw_log_lik(cache, G, batches, truncate_probs, folded,
+                          error_matrices, executor):
+    def batch_fun(data):
+        def fun(cache):
+            demo = Demography(G, cache=cache)
+            return _composite_log_likelihood(
+                data, demo, truncate_probs=truncate_probs, folded=folded,
+                error_matrices=error_matrices)
+        return fun
+    return rearrange_dict_grad_sum(
+        [batch_fun(data) for data in batches], executor)(cache)
+
+
+def rearrange_dict_grad_sum(funs, executor):
+    """
+    Like rearrange_dict_grad(), for the sum of funs.
+    The value and gradient of each term is computed
+    on a thread of executor, and the terms are added up in order,
+    so the result does not depend on the order the threads finish in.
+    """
+    def total(xdict):
+        ret = 0.0
+        for f in funs:
+            ret = ret + f(xdict)
+        return ret
+
+    @primitive
+    def wrapped_fun_helper(xdict, dummy):
+        with _thread_local_traces():
+            results = list(executor.map(
+                lambda f: ag.value_and_grad(f)(xdict), funs))
+        val = 0.0
+        grad = {k: 0.0 for k in xdict}
+        for f_val, f_grad in results:
+            assert len(f_val.shape) == 0
+            val = val + f_val
+            for k in grad:
+                grad[k] = grad[k] + f_grad[k]
+        dummy.cache = grad
+        return val
+
+    def wrapped_fun_helper_grad(ans, xdict, dummy):
+        def grad(g):
+            if isbox(xdict):
+                # higher-order derivative, recompute the gradient
+                # serially as a function of xdict
+                cache = ag.checkpoint(ag.grad(total))(xdict)
+            else:
+                cache = dummy.cache
+            return {k: g*v for k, v in cache.items()}
+        return grad
+    defvjp(wrapped_fun_helper, wrapped_fun_helper_grad, None)
+
+    @functools.wraps(total)
+    def wrapped_fun(xdict):
+        return wrapped_fun_helper(ag.dict(xdict), lambda: None)
+    return wrapped_fun
+
+
+def rearrange_dict_jacobian(fun, mat):
+    """
+    Like rearrange_dict_grad(), but for the vector mat.T.dot(fun(xdict)),
+    where fun returns a vector and mat may have many columns
+    (e.g. the counts of many replicates).
+
+    The jacobian of fun is computed on the forward pass and contracted
+    with mat. It is computed with one jacobian-vector product
+    per entry of xdict, or with one backward pass per column of mat
+    if there are fewer of those.
+    """
+    @primitive
+    def wrapped_fun_helper(xdict, dummy):
+        flat_x, unflatten = _flatten_dict(xdict)
+        vjp, val = ag.make_vjp(lambda y: fun(unflatten(y)))(flat_x)
+        assert len(val.shape) == 1
+        n_cols = mat.shape[1]
+        if n_cols <= len(flat_x):
+            jac = np.array([vjp(mat.dot(e)) for e in np.eye(n_cols)])
+        else:
+            # the vjp is linear, so its vjp is the jvp
+            jvp, _ = ag.make_vjp(vjp)(np.zeros(len(val)))
+            jac = mat.T.dot(
+                np.array([jvp(e) for e in np.eye(len(flat_x))]).T)
+        dummy.cache = (jac, unflatten)
+        return mat.T.dot(val)
+
+    def wrapped_fun_helper_grad(ans, xdict, dummy):
+        def grad(g):
+            if isbox(xdict):
+                # higher-order derivative, see rearrange_dict_grad()
+                vjp, _ = ag.make_vjp(
+                    lambda xd: _sparse_tdot(mat, fun(xd)))(xdict)
+                return vjp(g)
+            jac, unflatten = dummy.cache
+            return unflatten(np.dot(g, jac))
+        return grad
+    defvjp(wrapped_fun_helper, wrapped_fun_helper_grad, None)
+
+    @functools.wraps(fun)
+    def wrapped_fun(xdict):
+        return wrapped_fun_helper(ag.dict(xdict), lambda:None)
+    return wrapped_fun
+
+
+def _flatten_dict(xdict):
+    # autograd.misc.flatten sorts the keys, which needn't be comparable
+    keys = list(xdict.keys())
+    shapes = [np.shape(xdict[k]) for k in keys]
+    ends = np.cumsum([int(np.prod(shp)) for shp in shapes])
+
+    def unflatten(flat_x):
+        pieces = np.split(flat_x, ends[:-1])
+        return {k: np.reshape(v, shp)
+                for k, v, shp in zip(keys, pieces, shapes)}
+    flat_x = np.concatenate([np.ravel(xdict[k]) for k in keys])
+    return flat_x, unflatten
+
+
+@primitive
+def _sparse_tdot(mat, v):
+    return mat.T.dot(v)
+defvjp(_sparse_tdot, None, lambda ans, mat, v: lambda g: mat.dot(g))
+
+
+def _counts_rows(counts, start, end):
+    # rows start:end of a sparse matrix or LinearOperator of counts
+    if isinstance(counts, scipy.sparse.linalg.LinearOperator):
+        rows = scipy.sparse.identity(counts.shape[0], format="csr")
+        return scipy.sparse.linalg.aslinearoperator(
+            rows[start:end, :]).dot(counts)
+    return counts[start:end, :]
+
+
+def _raw_replicate_log_lik(cache, G, sfs, counts, truncate_probs, folded,
+                           error_matrices, jacobian):
+    def log_probs(cache):
+        demo = Demography(G, cache=cache)
+        sfs_probs = np.maximum(
+            expected_sfs(demo, sfs.configs, normalized=True,
+                         folded=folded, error_matrices=error_matrices),
+            truncate_probs)
+        return np.log(sfs_probs)
+    if jacobian:
+        return rearrange_dict_jacobian(log_probs, counts)(cache)
+    else:
+        return _sparse_tdot(counts, log_probs(cache))
+
+
 #def _build_sfs_batches(sfs, batch_size):
 #    counts = sfs._total_freqs
 #    sfs_len = len(counts)
@@ -552,27 +1233,69 @@ def _build_sfs_batches(sfs, batch_size):
 
 
 def _subsfs_list(sfs, n_chunks, rnd):
+    """
+    Randomly partitions the SNPs of sfs into n_chunks minibatches,
+    with sizes differing by at most 1.
+
+    The counts of each chunk are drawn directly from the per-config
+    counts that remain, with sequential multivariate hypergeometric
+    draws, so the cost is O(n_configs * n_chunks),
+    independent of the number of SNPs.
+    """
     n_snps = int(sfs.n_snps())
     logger.debug("Splitting {} SNPs into {} minibatches".format(n_snps, n_chunks))
 
-    logger.debug("Building list of length {}".format(n_snps))
-    idxs = np.zeros(n_snps, dtype=int)
-    total_counts = np.array(sfs._total_freqs, dtype=int)
-    curr = 0
-    for i, cnt in enumerate(total_counts):
-        idxs[curr:(curr+cnt)] = i
-        curr += cnt
-
-    logger.debug("Permuting list of {} SNPs".format(n_snps))
-    idxs = rnd.permutation(idxs)
+    remaining = np.array(sfs._total_freqs, dtype=np.int64)
+    chunk_sizes = [len(range(chunk, n_snps, n_chunks))
+                   for chunk in range(n_chunks)]
 
-    logger.debug("Splitting permuted SNPs into {} minibatches".format(n_chunks))
     ret = []
-    for chunk in range(n_chunks):
-        chunk_idxs, chunk_cnts = np.unique(idxs[chunk::n_chunks],
-                                           return_counts=True)
-        sub_configs = _ConfigList_Subset(sfs.configs, chunk_idxs)
+    for chunk, size in enumerate(chunk_sizes):
+        if chunk == n_chunks - 1:
+            chunk_cnts = remaining
+        else:
+            chunk_cnts = _multivariate_hypergeometric(remaining, size, rnd)
+            remaining = remaining - chunk_cnts
+        chunk_idxs, = np.nonzero(chunk_cnts)
+        sub_configs = _ConfigList_Subset(sfs.configs, chunk_idxs,
+                                         share_vecs=True)
         ret.append(Sfs.from_matrix(
-            np.array([chunk_cnts]).T, sub_configs,
+            np.array([chunk_cnts[chunk_idxs]]).T, sub_configs,
             folded=sfs.folded, length=None))
     return ret
+
+
+def _multivariate_hypergeometric(colors, nsample, rnd):
+    """
+    Counts of each color, when drawing nsample items without
+    replacement from an urn with colors[i] items of color i.
+
+    The colors are split in halves recursively,
+    drawing the number of items in the left half with a univariate
+    hypergeometric, and each level of the recursion is vectorized.
+    """
+    colors = np.asarray(colors, dtype=np.int64)
+    cum_colors = np.concatenate([[0], np.cumsum(colors)])
+    ret = np.zeros(len(colors), dtype=np.int64)
+
+    starts = np.array([0])
+    ends = np.array([len(colors)])
+    samples = np.array([nsample], dtype=np.int64)
+    while len(starts):
+        # nothing to split for empty samples or single colors
+        done = (samples == 0) | (ends - starts == 1)
+        ret[starts[done]] = samples[done]
+        starts, ends, samples = starts[~done], ends[~done], samples[~done]
+
+        mids = (starts + ends) // 2
+        left = cum_colors[mids] - cum_colors[starts]
+        right = cum_colors[ends] - cum_colors[mids]
+        if len(samples):
+            left_samples = rnd.hypergeometric(left, right, samples)
+        else:
+            left_samples = samples
+
+        starts = np.concatenate([starts, mids])
+        ends = np.concatenate([mids, ends])
+        samples = np.concatenate([left_samples, samples - left_samples])
+    return ret
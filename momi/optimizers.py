@@ -1,12 +1,15 @@
-import json
 import autograd
 import autograd.numpy as np
+from autograd.tracer import getval
 from functools import wraps, partial
 from .util import count_calls, closeleq, closegeq
+from .util import _thread_local_traces, _set_omp_num_threads, _CheckpointWriter
 import scipy
 import scipy.optimize
+import concurrent.futures
 import itertools
 import logging
+import os
 
 logger = logging.getLogger(__name__)
 
@@ -110,8 +113,67 @@ def is_stoch_opt(fun):
     return fun
 
 
+class _MinibatchEvaluator(object):
+    """
+    Evaluates fun_and_jac on random minibatches for the stochastic optimizers.
+
+    If n_workers is set, each step draws n_workers minibatches,
+    which are evaluated on a pool of persistent worker threads,
+    and their values and gradients are averaged.
+    The full objective (e.g. at SVRG pivots) is evaluated in a single
+    call on the calling thread, since it is already batched internally.
+    The results are added up in a fixed order, so the optimization
+    is reproducible for a given random seed and n_workers.
+    """
+    def __init__(self, fun_and_jac, pieces, n_workers=None):
+        self.fun_and_jac = fun_and_jac
+        self.pieces = pieces
+        self.n_workers = n_workers
+        if n_workers:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                n_workers, initializer=_set_omp_num_threads,
+                initargs=(max(1, (os.cpu_count() or 1) // n_workers),))
+        else:
+            self.executor = None
+
+    def sample(self, rgen):
+        if self.n_workers:
+            return rgen.randint(self.pieces, size=self.n_workers)
+        else:
+            return rgen.randint(self.pieces)
+
+    def __call__(self, x, i):
+        if self.executor is None:
+            return self.fun_and_jac(x, i)
+        else:
+            return self._average(x, i)
+
+    def full(self, x):
+        return self.fun_and_jac(x, None)
+
+    def _average(self, x, idxs):
+        with _thread_local_traces():
+            results = list(self.executor.map(
+                lambda i: self.fun_and_jac(x, i), idxs))
+        f, g = 0.0, 0.0
+        for f_i, g_i in results:
+            f = f + f_i
+            g = g + g_i
+        return f / len(results), g / len(results)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+def _checkpoint_writer(checkpoint_file):
+    if checkpoint_file is None:
+        return None
+    return _CheckpointWriter(checkpoint_file)
+
+
 @is_stoch_opt
-def sgd(fun, x0, fun_and_jac, pieces, stepsize, num_iters, bounds=None, callback=None, iter_per_output=10, rgen=np.random):
+def sgd(fun, x0, fun_and_jac, pieces, stepsize, num_iters, bounds=None, callback=None, iter_per_output=10, rgen=np.random, n_workers=None):
     x0 = np.array(x0)
 
     if callback is None:
@@ -128,20 +190,31 @@ def sgd(fun, x0, fun_and_jac, pieces, stepsize, num_iters, bounds=None, callback
     def truncate(x):
         return np.maximum(np.minimum(x, upper), lower)
 
-    x = x0
-    for nit in range(num_iters):
-        i = rgen.randint(pieces)
-        f_x, g_x = fun_and_jac(x, i)
-        x = truncate(x - stepsize * g_x)
-        if nit % iter_per_output == 0:
-            callback(x, f_x, nit)
+    minibatch = _MinibatchEvaluator(fun_and_jac, pieces, n_workers)
+    try:
+        x = x0
+        for nit in range(num_iters):
+            i = minibatch.sample(rgen)
+            f_x, g_x = minibatch(x, i)
+            x = truncate(x - stepsize * g_x)
+            if nit % iter_per_output == 0:
+                callback(x, f_x, nit)
+    finally:
+        minibatch.close()
 
     return scipy.optimize.OptimizeResult({'x': x, 'fun': f_x, 'jac': g_x})
 
 
 @is_stoch_opt
-def adam(fun, x0, fun_and_jac, pieces, num_iters, stepsize=.1, b1=0.9, b2=0.999, eps=10**-8, svrg_epoch=-1, bounds=None, callback=None, rgen=np.random, xtol=1e-6, w=None, fbar=None, gbar=None, checkpoint_file=None, checkpoint_iter=10, start_iter=0, m=None, v=None):
+def adam(fun, x0, fun_and_jac, pieces, num_iters, stepsize=.1, b1=0.9, b2=0.999, eps=10**-8, svrg_epoch=-1, bounds=None, callback=None, rgen=np.random, xtol=1e-6, w=None, fbar=None, gbar=None, checkpoint_file=None, checkpoint_iter=10, start_iter=0, m=None, v=None, n_workers=None, prev_close=False, rng_state=None, checkpoint_extra=None):
+    # every checkpoint_iter steps, the state of the optimizer
+    # (including rng_state, the state of rgen) is saved to checkpoint_file,
+    # along with the dict returned by checkpoint_extra().
+    # Passing the saved state back in as keyword arguments
+    # continues exactly as if the run had not been interrupted.
     x0 = np.array(x0)
+    if rng_state is not None:
+        rgen.set_state(rng_state)
 
     if callback is None:
         callback = lambda *a, **kw: None
@@ -172,61 +245,64 @@ def adam(fun, x0, fun_and_jac, pieces, num_iters, stepsize=.1, b1=0.9, b2=0.999,
     if gbar is not None:
         gbar = np.array(gbar)
 
-    prev_close = False
+    minibatch = _MinibatchEvaluator(fun_and_jac, pieces, n_workers)
+    checkpoint = _checkpoint_writer(checkpoint_file)
     success = False
-    for nit in range(start_iter, num_iters):
-        i = rgen.randint(pieces)
-        f_x, g_x = fun_and_jac(x, i)
+    # the last iteration run, if resuming from the end of a run
+    nit = start_iter - 1
+    f_x, g_x = None, None
+    try:
+        for nit in range(start_iter, num_iters):
+            i = minibatch.sample(rgen)
+            f_x, g_x = minibatch(x, i)
+
+            if svrg_epoch > 0 and nit // svrg_epoch and nit % svrg_epoch == 0:
+                w = x
+                fbar, gbar = minibatch.full(w)
+                #logger.info("SVRG pivot, {0}".format(
+                #    {"w": list(w), "fbar": fbar, "gbar": list(gbar)}))
+            if w is not None:
+                f_w, g_w = minibatch(w, i)
+                f_x = f_x - f_w + fbar
+                g_x = g_x - g_w + gbar
 
-        if svrg_epoch > 0 and nit // svrg_epoch and nit % svrg_epoch == 0:
-            w = x
-            fbar, gbar = fun_and_jac(w, None)
-            #logger.info("SVRG pivot, {0}".format(
-            #    {"w": list(w), "fbar": fbar, "gbar": list(gbar)}))
-        if w is not None:
-            f_w, g_w = fun_and_jac(w, i)
-            f_x = f_x - f_w + fbar
-            g_x = g_x - g_w + gbar
-
-        callback(x, f_x, nit)
-
-        m = (1 - b1) * g_x + b1 * m  # First  moment estimate.
-        v = (1 - b2) * (g_x**2) + b2 * v  # Second moment estimate.
-
-        mhat = m / (1 - b1**(nit + 1))    # Bias correction.
-        vhat = v / (1 - b2**(nit + 1))
-
-        prev_x = x
-        x = truncate(x - stepsize * mhat / (np.sqrt(vhat) + eps))
-        #logger.info("Adam moment estimates, {0}".format(
-        #    {"x": list(x), "m": list(m), "v": list(v)}))
-
-        # require x to not change for 2 steps in a row before stopping
-        if xtol < 0 or not np.allclose(x, prev_x, xtol, xtol):
-            prev_close = False
-        elif prev_close:
-            success = True
-            break
-        else:
-            prev_close = True
+            callback(x, f_x, nit)
 
-        if checkpoint_file is not None and nit % checkpoint_iter == 0:
-            def to_list(y):
-                if y is None:
-                    return None
-                else:
-                    return list(y)
+            m = (1 - b1) * g_x + b1 * m  # First  moment estimate.
+            v = (1 - b2) * (g_x**2) + b2 * v  # Second moment estimate.
+
+            mhat = m / (1 - b1**(nit + 1))    # Bias correction.
+            vhat = v / (1 - b2**(nit + 1))
 
-            with open(checkpoint_file, "w") as f:
-                json.dump({
-                    "start_iter": nit+1,
-                    "fbar": fbar,
-                    "gbar": to_list(gbar),
-                    "w": to_list(w),
-                    "m": to_list(m),
-                    "v": to_list(v),
-                    "x0": to_list(x)}, f)
+            prev_x = x
+            x = truncate(x - stepsize * mhat / (np.sqrt(vhat) + eps))
+            #logger.info("Adam moment estimates, {0}".format(
+            #    {"x": list(x), "m": list(m), "v": list(v)}))
 
+            # require x to not change for 2 steps in a row before stopping
+            if xtol < 0 or not np.allclose(x, prev_x, xtol, xtol):
+                prev_close = False
+            elif prev_close:
+                success = True
+                break
+            else:
+                prev_close = True
+
+            if checkpoint is not None and nit % checkpoint_iter == 0:
+                state = {"start_iter": nit + 1, "fbar": fbar, "gbar": gbar,
+                         "w": w, "m": m, "v": v, "x0": x,
+                         "prev_close": prev_close,
+                         "rng_state": rgen.get_state()}
+                if checkpoint_extra is not None:
+                    state.update(checkpoint_extra())
+                checkpoint.write(state)
+        if f_x is None:
+            # no iterations were left to run
+            f_x, g_x = minibatch.full(x)
+    finally:
+        minibatch.close()
+        if checkpoint is not None:
+            checkpoint.close()
 
     if success:
         message = "|x[k]-x[k-1]|~=0"
@@ -238,8 +314,12 @@ def adam(fun, x0, fun_and_jac, pieces, num_iters, stepsize=.1, b1=0.9, b2=0.999,
 
 
 @is_stoch_opt
-def svrg(fun, x0, fun_and_jac, pieces, stepsize, iter_per_epoch, max_epochs=100, bounds=None, callback=None, rgen=np.random, quasinewton=True, init_epoch_svrg=False, xtol=1e-6):
+def svrg(fun, x0, fun_and_jac, pieces, stepsize, iter_per_epoch, max_epochs=100, bounds=None, callback=None, rgen=np.random, quasinewton=True, init_epoch_svrg=False, xtol=1e-6, n_workers=None, checkpoint_file=None, start_epoch=0, start_iter=0, w=None, fbar=None, gbar=None, H=None, history=None, rng_state=None, checkpoint_extra=None):
+    # at the end of every epoch, the state of the optimizer is saved
+    # to checkpoint_file, as in adam()
     x0 = np.array(x0)
+    if rng_state is not None:
+        rgen.set_state(rng_state)
 
     if quasinewton is not True and quasinewton is not False:
         init_H = quasinewton
@@ -282,91 +362,117 @@ def svrg(fun, x0, fun_and_jac, pieces, stepsize, iter_per_epoch, max_epochs=100,
 
     I = np.eye(len(x0))
 
-    finished = False
+    minibatch = _MinibatchEvaluator(fun_and_jac, pieces, n_workers)
+    checkpoint = _checkpoint_writer(checkpoint_file)
     x = x0
-    nit = 0
-    history = {k: [] for k in ('x', 'f', 'jac')}
-    for epoch in itertools.count():
-        if epoch > 0:
-            prev_w = w
-            prev_gbar = gbar
-        else:
-            prev_w, prev_gbar = None, None
-
-        w = x
-        if epoch > 0 or init_epoch_svrg is True:
-            fbar, gbar = fun_and_jac(w, None)
-            logger.info("SVRG pivot, {0}".format(
-                {"w": list(w), "fbar": fbar, "gbar": list(gbar)}))
-            #callback(w, fbar, epoch)
-            for k, v in (('x', w), ('f', fbar), ('jac', gbar)):
-                history[k].append(v)
-        elif init_epoch_svrg is False:
-            gbar = None
-        else:
-            fbar, gbar = init_epoch_svrg
-
-        if quasinewton:
-            if prev_gbar is not None:
-                H = update_Hess(H, w, prev_w, gbar, prev_gbar)
+    nit = start_iter
+    if history is None:
+        history = {k: [] for k in ('x', 'f', 'jac')}
+    else:
+        history = {k: list(history[k]) for k in ('x', 'f', 'jac')}
+    if w is not None:
+        w = np.array(w)
+    if gbar is not None:
+        gbar = np.array(gbar)
+    if H is not None:
+        H = np.array(H)
+    try:
+        for epoch in itertools.count(start_epoch):
+            if epoch > 0:
+                prev_w = w
+                prev_gbar = gbar
             else:
-                assert epoch == 0 or (epoch == 1 and not init_epoch_svrg)
-                if init_H is not None:
-                    H = init_H
-                else:
-                    f_w, g_w = fun_and_jac(w, 0)
-                    if epoch == 0:
-                        u = truncate(w - g_w)
-                    else:
-                        u = prev_w
-                    f_u, g_u = fun_and_jac(u, 0)
-                    s, y = (u - w), (g_u - g_w)
-                    H = np.abs(np.dot(s, y) / np.dot(y, y)) * I
-
-            H_eigvals, H_eigvecs = scipy.linalg.eigh(H)
-            Habs = np.einsum("k,ik,jk->ij",
-                             np.abs(H_eigvals),
-                             H_eigvecs, H_eigvecs)
-            Babs = scipy.linalg.pinvh(Habs)
-
-        if epoch > 0 and xtol >= 0 and np.allclose(w, prev_w, xtol, xtol):
-            success = True
-            message = "|x[k]-x[k-1]|~=0"
-            break
-        if epoch >= max_epochs:
-            success = False
-            message = "Maximum number of iterations reached"
-            break
-
-        for k in range(iter_per_epoch):
-            i = rgen.randint(pieces)
-
-            f_x, g_x = fun_and_jac(x, i)
+                prev_w, prev_gbar = None, None
 
-            if gbar is not None:
-                f_w, g_w = fun_and_jac(w, i)
-                g = (g_x - g_w) + gbar
-                f = (f_x - f_w) + fbar
+            w = x
+            if epoch > 0 or init_epoch_svrg is True:
+                fbar, gbar = minibatch.full(w)
+                logger.info("SVRG pivot, {0}".format(
+                    {"w": list(w), "fbar": fbar, "gbar": list(gbar)}))
+                #callback(w, fbar, epoch)
+                for k, v in (('x', w), ('f', fbar), ('jac', gbar)):
+                    history[k].append(v)
+            elif init_epoch_svrg is False:
+                gbar = None
             else:
-                assert epoch == 0 and init_epoch_svrg is False
-                g = g_x
-                f = f_x
-            callback(x, f, nit)
+                fbar, gbar = init_epoch_svrg
 
-            if not quasinewton:
-                xnext = truncate(x - stepsize * g)
-            else:
-                xnext = x - stepsize * np.dot(Habs, g)
-                if not np.allclose(xnext, truncate(xnext)):
-                    model_fun = lambda y: np.dot(
-                        g, y - x) + .5 / stepsize * np.dot(y - x, np.dot(Babs, y - x))
-                    model_grad = autograd.grad(model_fun)
-                    xnext = scipy.optimize.minimize(
-                        model_fun, x, jac=model_grad, bounds=bounds).x
-                xnext = truncate(xnext)
-            x = xnext
-            nit += 1
+            if quasinewton:
+                if prev_gbar is not None:
+                    H = update_Hess(H, w, prev_w, gbar, prev_gbar)
+                else:
+                    assert epoch == 0 or (epoch == 1 and not init_epoch_svrg)
+                    if init_H is not None:
+                        H = init_H
+                    else:
+                        f_w, g_w = fun_and_jac(w, 0)
+                        if epoch == 0:
+                            u = truncate(w - g_w)
+                        else:
+                            u = prev_w
+                        f_u, g_u = fun_and_jac(u, 0)
+                        s, y = (u - w), (g_u - g_w)
+                        H = np.abs(np.dot(s, y) / np.dot(y, y)) * I
+
+                H_eigvals, H_eigvecs = scipy.linalg.eigh(H)
+                Habs = np.einsum("k,ik,jk->ij",
+                                 np.abs(H_eigvals),
+                                 H_eigvecs, H_eigvecs)
+                Babs = scipy.linalg.pinvh(Habs)
+
+            if epoch > 0 and xtol >= 0 and np.allclose(w, prev_w, xtol, xtol):
+                success = True
+                message = "|x[k]-x[k-1]|~=0"
+                break
+            if epoch >= max_epochs:
+                success = False
+                message = "Maximum number of iterations reached"
+                break
+
+            for k in range(iter_per_epoch):
+                i = minibatch.sample(rgen)
+
+                f_x, g_x = minibatch(x, i)
+
+                if gbar is not None:
+                    f_w, g_w = minibatch(w, i)
+                    g = (g_x - g_w) + gbar
+                    f = (f_x - f_w) + fbar
+                else:
+                    assert epoch == 0 and init_epoch_svrg is False
+                    g = g_x
+                    f = f_x
+                callback(x, f, nit)
 
+                if not quasinewton:
+                    xnext = truncate(x - stepsize * g)
+                else:
+                    xnext = x - stepsize * np.dot(Habs, g)
+                    if not np.allclose(xnext, truncate(xnext)):
+                        model_fun = lambda y: np.dot(
+                            g, y - x) + .5 / stepsize * np.dot(y - x, np.dot(Babs, y - x))
+                        model_grad = autograd.grad(model_fun)
+                        xnext = scipy.optimize.minimize(
+                            model_fun, x, jac=model_grad, bounds=bounds).x
+                    xnext = truncate(xnext)
+                x = xnext
+                nit += 1
+
+            if checkpoint is not None:
+                state = {"start_epoch": epoch + 1, "start_iter": nit,
+                         "x0": x, "w": w, "fbar": fbar, "gbar": gbar,
+                         "history": {k: [np.asarray(v).tolist() for v in vals]
+                                     for k, vals in history.items()},
+                         "rng_state": rgen.get_state()}
+                if quasinewton:
+                    state["H"] = H
+                if checkpoint_extra is not None:
+                    state.update(checkpoint_extra())
+                checkpoint.write(state)
+    finally:
+        minibatch.close()
+        if checkpoint is not None:
+            checkpoint.close()
     history = {k: np.array(v) for k, v in history.items()}
     res = scipy.optimize.OptimizeResult({'success': success, 'message': message,
                                          'nit': nit, 'nepoch': epoch, 'history': history,
@@ -375,3 +481,171 @@ def svrg(fun, x0, fun_and_jac, pieces, stepsize, iter_per_epoch, max_epochs=100,
         res['hess_inv'] = H
 
     return res
+
+
+def _grad_and_hvp(fun):
+    """
+    Returns a function of x that computes fun(x) and its gradient,
+    along with a function computing hessian-vector products at x.
+
+    The hessian-vector products are backward passes through the
+    traced gradient, so the demography is not rebuilt for each vector.
+    However, for surfaces with several batches of configs, each
+    hessian-vector product recomputes the batches' gradients
+    (see likelihood.rearrange_dict_grad()), so it costs about
+    as much as a gradient.
+    """
+    def grad_and_hvp(x):
+        values = []
+
+        def grad_fun(y):
+            fy, g = autograd.value_and_grad(fun)(y)
+            values.append(fy)
+            return g
+        vjp, g = autograd.make_vjp(grad_fun)(x)
+        return getval(values[0]), g, vjp
+    return grad_and_hvp
+
+
+def trust_krylov(fun, x0, grad_and_hvp, bounds=None, callback=None,
+                 initial_trust_radius=1.0, max_trust_radius=1000.0,
+                 eta=0.15, gtol=1e-5, maxiter=1000, max_cg_iter=None,
+                 options=None):
+    """
+    Trust-region Newton-CG, with bounds enforced by projection.
+
+    Each iteration computes the gradient once, then approximately
+    solves the trust-region subproblem with truncated conjugate
+    gradients (Steihaug-Toint), using hessian-vector products
+    through the traced gradient (see _grad_and_hvp()).
+    Trial points are evaluated with grad_and_hvp(), so an accepted
+    step reuses that evaluation for the next iteration instead of
+    evaluating the function again. Parameters at a bound with the gradient
+    pointing out of the feasible region are held fixed for the
+    iteration, and the step is projected back onto the bounds.
+
+    The result has the total numbers of function, gradient and
+    hessian-vector product evaluations (nfev, njev, nhev),
+    as well as their numbers in each iteration (evaluations).
+    """
+    if options:
+        kwargs = dict(initial_trust_radius=initial_trust_radius,
+                      max_trust_radius=max_trust_radius, eta=eta,
+                      gtol=gtol, maxiter=maxiter, max_cg_iter=max_cg_iter)
+        unknown = set(options) - set(kwargs)
+        if unknown:
+            raise ValueError("Unrecognized options {}".format(sorted(unknown)))
+        kwargs.update(options)
+        return trust_krylov(fun, x0, grad_and_hvp, bounds=bounds,
+                            callback=callback, **kwargs)
+
+    x = np.array(x0, dtype=float)
+    if bounds is None:
+        bounds = [(None, None) for _ in x]
+    lower, upper = zip(*bounds)
+    lower = np.array([-float('inf') if l is None else l for l in lower])
+    upper = np.array([float('inf') if u is None else u for u in upper])
+    x = np.maximum(np.minimum(x, upper), lower)
+    if max_cg_iter is None:
+        max_cg_iter = 2 * len(x)
+
+    counts = {"nfev": 0, "njev": 0, "nhev": 0}
+
+    def hvp(v):
+        counts["nhev"] += 1
+        return hess_fun(v)
+
+    radius = initial_trust_radius
+    evaluations = []
+    success, message = False, "Maximum number of iterations reached"
+    fx, g, hess_fun = grad_and_hvp(x)
+    counts["njev"] += 1
+    nit = 0
+    while True:
+        prev_counts = dict(counts)
+
+        proj_g = x - np.maximum(np.minimum(x - g, upper), lower)
+        if np.max(np.abs(proj_g)) <= gtol:
+            success, message = True, "Projected gradient below gtol"
+            break
+        if nit >= maxiter:
+            break
+
+        free = ~(((x <= lower) & (g > 0)) | ((x >= upper) & (g < 0)))
+        g_free = np.where(free, g, 0.0)
+        g_norm = np.linalg.norm(g_free)
+        p, hits_boundary = _steihaug_cg(
+            g_free, lambda v: np.where(free, hvp(np.where(free, v, 0.0)), 0.0),
+            radius, min(0.5, np.sqrt(g_norm)) * g_norm, max_cg_iter)
+
+        x_new = np.maximum(np.minimum(x + p, upper), lower)
+        s = x_new - x
+        predicted = -(np.dot(g, s) + 0.5 * np.dot(s, hvp(s)))
+        if predicted > 0:
+            trial = grad_and_hvp(x_new)
+            counts["njev"] += 1
+            rho = (fx - trial[0]) / predicted
+        else:
+            rho = -float('inf')
+        if not np.isfinite(rho):
+            rho = -float('inf')
+
+        if rho < 0.25:
+            radius = 0.25 * radius
+        elif rho > 0.75 and hits_boundary:
+            radius = min(2.0 * radius, max_trust_radius)
+
+        if rho > eta:
+            x = x_new
+            fx, g, hess_fun = trial
+
+        nit += 1
+        evaluations.append({k: counts[k] - prev_counts[k] for k in counts})
+        logger.debug("trust-krylov iteration {0}".format(
+            dict(evaluations[-1], fun=fx, trust_radius=radius)))
+        if rho > eta and callback:
+            callback(x)
+
+        if radius < 1e-12 * (1.0 + np.linalg.norm(x)):
+            message = "Trust radius below tolerance"
+            break
+
+    return scipy.optimize.OptimizeResult(
+        {'success': success, 'message': message, 'x': x, 'fun': fx,
+         'jac': g, 'nit': nit, 'evaluations': evaluations, **counts})
+
+
+def _steihaug_cg(g, hvp, radius, tol, maxiter):
+    # approximately minimize g.p + p.H.p/2 subject to |p| <= radius;
+    # returns the step, and whether it reached the trust region boundary
+    p = np.zeros(len(g))
+    r = g
+    d = -r
+    rr = np.dot(r, r)
+    if np.sqrt(rr) < tol:
+        return p, False
+    for _ in range(maxiter):
+        Hd = hvp(d)
+        dHd = np.dot(d, Hd)
+        if dHd <= 0:
+            return p + _to_boundary(p, d, radius) * d, True
+        alpha = rr / dHd
+        p_next = p + alpha * d
+        if np.linalg.norm(p_next) >= radius:
+            return p + _to_boundary(p, d, radius) * d, True
+        r = r + alpha * Hd
+        rr_next = np.dot(r, r)
+        p = p_next
+        if np.sqrt(rr_next) < tol:
+            break
+        d = -r + (rr_next / rr) * d
+        rr = rr_next
+    return p, False
+
+
+def _to_boundary(p, d, radius):
+    # the tau >= 0 with |p + tau * d| = radius
+    a = np.dot(d, d)
+    b = 2 * np.dot(p, d)
+    c = np.dot(p, p) - radius**2
+    return (-b + np.sqrt(b**2 - 4 * a * c)) / (2 * a)
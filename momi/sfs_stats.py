@@ -15,6 +15,10 @@ class SfsStats(object):
                                if n > 0}
 
     def tensor_prod(self, derived_weights_dict):
+        return self.tensor_prods([derived_weights_dict])[0]
+
+    def tensor_prods(self, derived_weights_dicts):
+        # the tensor_prod() of each dict in a list
         raise NotImplementedError
 
     def log(self, x):
@@ -24,6 +28,22 @@ class SfsStats(object):
     def denom(self):
         return self.tensor_prod({})
 
+    def _compute_many(self, stats):
+        # Computes a list of statistics, given as tuples
+        # (method_name, *args), e.g. ("f4", A, B, C, D).
+        #
+        # The statistics are first computed with placeholder
+        # tensor products, to record the weights they need.
+        # The tensor products of all the weights are then computed at once
+        # by tensor_prods(), and finally the statistics are recomputed
+        # from them.
+        recorder = _RecordedTensorProds(self)
+        for name, *args in stats:
+            getattr(recorder, name)(*args)
+        replayer = _ReplayedTensorProds(
+            self, self.tensor_prods(recorder.weights))
+        return [getattr(replayer, name)(*args) for name, *args in stats]
+
     def ordered_prob(self, subsample_dict,
                      fold=False):
         # The ordered probability for the subsample given by
@@ -104,6 +124,13 @@ class SfsStats(object):
 
         return (pi_between - pi_within) / pi_between
 
+    def _ibs(self, pop1, pop2):
+        # probability that a pair of alleles are identical by state
+        if pop1 == pop2:
+            return self.ordered_prob({pop1: [0, 0]}, fold=True)
+        else:
+            return self.ordered_prob({pop1: [0], pop2: [0]}, fold=True)
+
 
     def f4(self, A, B, C, D=None):
         """
@@ -238,13 +265,17 @@ class SfsModelFitStats(SfsStats):
 
         :rtype: :class:`JackknifeGoodnessFitStat`
         """
-        exp = self.expected.tensor_prod(derived_weights_dict)
-        emp = self.empirical.tensor_prod(derived_weights_dict)
-
-        exp = exp / self.expected.denom
-        emp = emp / self.empirical.denom
-
-        return JackknifeGoodnessFitStat(exp, emp.est, emp.jackknife)
+        return super(SfsModelFitStats, self).tensor_prod(derived_weights_dict)
+
+    def tensor_prods(self, derived_weights_dicts):
+        ret = []
+        for exp, emp in zip(
+                self.expected.tensor_prods(derived_weights_dicts),
+                self.empirical.tensor_prods(derived_weights_dicts)):
+            exp = exp / self.expected.denom
+            emp = emp / self.empirical.denom
+            ret.append(JackknifeGoodnessFitStat(exp, emp.est, emp.jackknife))
+        return ret
 
     def log(self, x):
         return x.apply(np.log)
@@ -261,42 +292,70 @@ class SfsModelFitStats(SfsStats):
         """
         pops = list(self.sampled_n_dict.keys())
 
-        df = []
+        pairs = []
         for pop1 in pops:
             for pop2 in pops:
                 if pop1 > pop2:
                     continue
-                elif pop1 == pop2:
-                    if self.sampled_n_dict[pop1] == 1:
-                        continue
-                    prob = self.ordered_prob({
-                        pop1: [0, 0]}, fold=True)
-                else:
-                    prob = self.ordered_prob({
-                        pop1: [0], pop2: [0]}, fold=True)
-
-                line = [pop1, pop2, prob.expected,
-                        prob.observed, prob.z_score]
-                df.append(line)
+                elif pop1 == pop2 and self.sampled_n_dict[pop1] == 1:
+                    continue
+                pairs.append((pop1, pop2))
 
+        probs = self._compute_many([("_ibs", pop1, pop2)
+                                    for pop1, pop2 in pairs])
+        df = [[pop1, pop2, prob.expected, prob.observed, prob.z_score]
+              for (pop1, pop2), prob in zip(pairs, probs)]
         return self._pairwise_zscores(df, fig)
 
     def all_f2(self, fig=True):
         pops = [k for k, v in self.sampled_n_dict.items() if v > 1]
+        pairs = [(pop1, pop2) for pop1 in pops for pop2 in pops
+                 if pop1 < pop2]
 
-        df = []
-        for pop1 in pops:
-            for pop2 in pops:
-                if pop1 >= pop2:
-                    continue
-                else:
-                    prob = self.f2(pop1, pop2)
+        probs = self._compute_many([("f2", pop1, pop2)
+                                    for pop1, pop2 in pairs])
+        df = [[pop1, pop2, prob.expected, prob.observed, prob.z_score]
+              for (pop1, pop2), prob in zip(pairs, probs)]
+        return self._pairwise_zscores(df, fig)
 
-                line = [pop1, pop2, prob.expected,
-                        prob.observed, prob.z_score]
-                df.append(line)
+    def stats_table(self, stats):
+        """Compute many statistics at once.
 
-        return self._pairwise_zscores(df, fig)
+        The SFS tensor products needed by all the statistics \
+        are computed together: the expected values in a single \
+        traversal of the demography, and the observed values \
+        (and their jackknife replicates) in a single pass over the data. \
+        This is much faster than computing the statistics one at a time, \
+        e.g. for all the f4 statistics of many populations.
+
+        Example::
+
+            fit_stats.stats_table([("f2", "A", "B"), ("f3", "A", "B", "C"),
+                                   ("f4", "A", "B", "C", "D"),
+                                   ("pattersons_d", "A", "B", "C", "D")])
+
+        :param list stats: List of tuples ``(name, pop1, pop2, ...)``, \
+        where ``name`` is a method of this class returning a \
+        :class:`JackknifeGoodnessFitStat` (e.g. ``"f2"``, ``"f3"``, \
+        ``"f4"``, ``"pattersons_d"``, ``"f_st"``), and the \
+        populations are its arguments.
+
+        :returns: One row per statistic (in the order of ``stats``), \
+        with its name, populations, expected and observed values, \
+        jackknife standard deviation, and z-score.
+        :rtype: :class:`pandas.DataFrame`
+        """
+        stats = [tuple(stat) for stat in stats]
+        n_pops = max([len(stat) - 1 for stat in stats] + [0])
+        rows = []
+        for (name, *pops), stat in zip(stats, self._compute_many(stats)):
+            pops = pops + [None] * (n_pops - len(pops))
+            rows.append([name] + pops + [
+                stat.expected, stat.observed, stat.sd, stat.z_score])
+        return pd.DataFrame(
+            rows, columns=(["Statistic"]
+                           + ["Pop{}".format(i+1) for i in range(n_pops)]
+                           + ["Expected", "Observed", "SD", "Z"]))
 
     def _pairwise_zscores(self, df, fig):
         ret = pd.DataFrame(sorted(df, key=lambda x: abs(x[-1]),
@@ -331,35 +390,40 @@ class ObservedSfsStats(SfsStats):
         self.sfs = sfs
         super(ObservedSfsStats, self).__init__(sampled_n_dict)
 
-    def tensor_prod(self, derived_weights_dict):
-        weighted_counts = self.sfs.configs.count_subsets(derived_weights_dict,
-                                                         self.sampled_n_dict)
-
-        # subtract out weights of monomorphic
-        mono_anc = {}
-        mono_der = {}
-        for pop, asc in zip(self.sfs.sampled_pops, self.sfs.ascertainment_pop):
-            try:
-                v = derived_weights_dict[pop]
-            except KeyError:
+    def tensor_prods(self, derived_weights_dicts):
+        is_ascertained = dict(zip(self.sfs.sampled_pops,
+                                  self.sfs.ascertainment_pop))
+
+        # 3 columns of weights per derived_weights_dict:
+        # the weights, and the weights of the monomorphic configs
+        # (all ancestral, all derived) to subtract out,
+        # so all the counts are done in a single call to count_subsets()
+        weights = {}
+        for pop, n in self.sampled_n_dict.items():
+            columns = []
+            for derived_weights_dict in derived_weights_dicts:
+                assert (set(derived_weights_dict.keys())
+                        <= set(self.sampled_n_dict.keys()))
                 try:
-                    v = [1] * (self.sampled_n_dict[pop]+1)
+                    v = np.array(derived_weights_dict[pop], dtype=float)
                 except KeyError:
-                    continue
-            if asc:
-                mono_anc[pop] = [v[0]] + [0]*(len(v)-1)
-                mono_der[pop] = [0]*(len(v)-1) + [v[-1]]
-            else:
-                mono_anc[pop] = v
-                mono_der[pop] = v
-        mono_anc = self.sfs.configs.count_subsets(
-            mono_anc, self.sampled_n_dict)
-        mono_der = self.sfs.configs.count_subsets(
-            mono_der, self.sampled_n_dict)
+                    v = np.ones(n+1)
+                if is_ascertained[pop]:
+                    mono_anc = np.zeros(n+1)
+                    mono_anc[0] = v[0]
+                    mono_der = np.zeros(n+1)
+                    mono_der[-1] = v[-1]
+                else:
+                    mono_anc = mono_der = v
+                columns.extend([v, mono_anc, mono_der])
+            weights[pop] = np.transpose(columns)
 
-        return JackknifeStat.from_chunks(
-            self.sfs.freqs_matrix.T.dot(
-                weighted_counts - mono_anc - mono_der))
+        counts = self.sfs.configs.count_subsets(weights, self.sampled_n_dict)
+        counts = counts[:, 0::3] - counts[:, 1::3] - counts[:, 2::3]
+
+        # one pass over the loci for all the weights
+        locus_counts = self.sfs.freqs_matrix.T.dot(counts)
+        return [JackknifeStat.from_chunks(c) for c in locus_counts.T]
 
     def log(self, x):
         return x.apply(np.log)
@@ -380,36 +444,80 @@ class ExpectedSfsStats(SfsStats):
         super(ExpectedSfsStats, self).__init__(dict(zip(demo.sampled_pops,
                                                         demo.sampled_n)))
 
-    def tensor_prod(self, derived_weights_dict):
+    def tensor_prods(self, derived_weights_dicts):
         #sampled_pops, sampled_n = zip(*sorted(self.sampled_n_dict.items()))
         #demo = self.demo._get_multipop_moran(sampled_pops, sampled_n)
         demo = self.demo
 
+        # 3 rows per derived_weights_dict, so that all of them
+        # are computed in a single traversal of the demography
         vecs = []
         for p, n in zip(demo.sampled_pops, demo.sampled_n):
             v = []
-            try:
-                row = derived_weights_dict[p]
-            except KeyError:
-                row = np.ones(n+1)
-            assert len(row) == n+1
-
-            if p in self.ascertainment_pops:
-                v.append([row[0]] + [0.0] * n)  # all ancestral state
-                v.append([0.0] * n + [row[-1]])  # all derived state
-            else:
-                for _ in range(2):
-                    v.append(row)
-            v.append(row)
+            for derived_weights_dict in derived_weights_dicts:
+                try:
+                    row = derived_weights_dict[p]
+                except KeyError:
+                    row = np.ones(n+1)
+                assert len(row) == n+1
+
+                if p in self.ascertainment_pops:
+                    v.append([row[0]] + [0.0] * n)  # all ancestral state
+                    v.append([0.0] * n + [row[-1]])  # all derived state
+                else:
+                    for _ in range(2):
+                        v.append(row)
+                v.append(row)
 
-            vecs.append(np.array(v))
+            vecs.append(np.array(v, dtype=float))
 
         res = _expected_sfs_tensor_prod(vecs, demo)
-        return res[2] - res[0] - res[1]
+        res = np.reshape(res, (len(derived_weights_dicts), 3))
+        return list(res[:, 2] - res[:, 0] - res[:, 1])
+
+    def log(self, x):
+        return np.log(x)
+
+
+class _RecordedTensorProds(SfsStats):
+    # Records the derived_weights_dicts of the tensor products
+    # used by the statistics of stats, returning placeholder values.
+    # The placeholders are distinct, so that statistics like
+    # f4 = baba - abba do not become 0
+    def __init__(self, stats):
+        super(_RecordedTensorProds, self).__init__(stats.sampled_n_dict)
+        self.weights = []
+
+    def tensor_prod(self, derived_weights_dict):
+        self.weights.append(derived_weights_dict)
+        return np.float64(len(self.weights))
 
     def log(self, x):
         return np.log(x)
 
+    @property
+    def denom(self):
+        return np.float64(1.0)
+
+
+class _ReplayedTensorProds(SfsStats):
+    # Returns the precomputed values of the tensor products,
+    # in the order recorded by _RecordedTensorProds
+    def __init__(self, stats, values):
+        super(_ReplayedTensorProds, self).__init__(stats.sampled_n_dict)
+        self.stats = stats
+        self.values = iter(values)
+
+    def tensor_prod(self, derived_weights_dict):
+        return next(self.values)
+
+    def log(self, x):
+        return self.stats.log(x)
+
+    @property
+    def denom(self):
+        return self.stats.denom
+
 
 class JackknifeGoodnessFitStat(object):
     """
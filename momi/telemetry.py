@@ -0,0 +1,188 @@
+import json
+import logging
+import queue
+import socket
+import sys
+import threading
+import time
+import uuid
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+
+class TelemetrySink(object):
+    """Streams structured events, one JSON object per line \
+    (`JSON Lines <http://jsonlines.org>`_), to a file or a local socket.
+
+    Pass a :class:`TelemetrySink` (or just its ``target``) as the \
+    ``telemetry`` argument of :meth:`DemographicModel.optimize`, \
+    :meth:`DemographicModel.stochastic_optimize`, or \
+    :class:`momi.SfsLikelihoodSurface` to record a fit.
+
+    Every event has the fields ``"event"`` (its kind), ``"run"`` \
+    (the ``run_id`` of the sink), and ``"time"`` (seconds since the epoch). \
+    The fits write ``"fit_start"``, ``"iteration"``, and ``"fit_end"`` \
+    events; each ``"iteration"`` has the objective value, parameters, \
+    time taken, number of likelihood/gradient/hessian evaluations, \
+    evaluation cache hits and misses, and peak memory of the process. \
+    If a fit raises an exception, its ``"fit_end"`` event has \
+    ``"success": false`` and the exception in ``"error"``.
+
+    The events are serialized and written on a background thread, \
+    so that emitting an event costs little more than putting it on a queue.
+
+    :param target: a file name (events are appended to it), \
+    ``"tcp://host:port"``, or ``"unix:///path/to/socket"``
+    :param str,None run_id: label for the events of this sink. \
+    By default a random unique id.
+    """
+
+    def __init__(self, target, run_id=None):
+        if run_id is None:
+            run_id = uuid.uuid4().hex
+        self.target = target
+        self.run_id = run_id
+        self._stream = _open_stream(target)
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._write_events,
+                                        daemon=True)
+        self._thread.start()
+
+    def emit(self, event, **fields):
+        """Write an event of kind ``event`` with additional ``fields``.
+        """
+        fields["event"] = event
+        fields["run"] = self.run_id
+        fields["time"] = time.time()
+        self._queue.put(fields)
+
+    def close(self):
+        """Write the remaining events, and close the file or socket.
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+            self._stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _write_events(self):
+        failed = False
+        while True:
+            fields = self._queue.get()
+            if fields is None:
+                break
+            if failed:
+                continue
+            try:
+                self._stream.write(
+                    json.dumps(fields, default=_to_json) + "\n")
+                if self._queue.empty():
+                    self._stream.flush()
+            except (OSError, ValueError, TypeError) as e:
+                # losing the telemetry should not stop the fit
+                logger.warning("Unable to write telemetry to {}: {}".format(
+                    self.target, e))
+                failed = True
+
+
+def _open_stream(target):
+    if target.startswith("tcp://"):
+        host, port = target[len("tcp://"):].rsplit(":", 1)
+        sock = socket.create_connection((host, int(port)))
+        return sock.makefile("w", encoding="utf-8")
+    elif target.startswith("unix://"):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(target[len("unix://"):])
+        return sock.makefile("w", encoding="utf-8")
+    else:
+        return open(target, "a")
+
+
+def _to_json(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    elif isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError("{} is not JSON serializable".format(type(obj)))
+
+
+def _get_sink(telemetry):
+    # returns the sink, and whether it was created here
+    # (and so should be closed by the caller)
+    if telemetry is None or isinstance(telemetry, TelemetrySink):
+        return telemetry, False
+    return TelemetrySink(telemetry), True
+
+
+def _max_rss_bytes():
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # already bytes on macOS
+        return max_rss
+    # kilobytes on Linux
+    return max_rss * 1024
+
+
+class _IterationTelemetry(object):
+    """
+    Emits the events of one fit of a likelihood surface,
+    with the evaluations and cache statistics since the previous iteration.
+    """
+    def __init__(self, sink, surface, **fit_fields):
+        self.sink = sink
+        self.surface = surface
+        self.start_time = self.prev_time = time.time()
+        self.start_counts = self.prev_counts = self._counts()
+        sink.emit("fit_start", **fit_fields)
+
+    def _counts(self):
+        info = self.surface.eval_cache_info()
+        return (dict(self.surface._eval_counts),
+                dict(info.hits), dict(info.misses))
+
+    def _counts_since(self, prev_counts):
+        counts = self._counts()
+        return counts, [
+            {k: curr[k] - prev.get(k, 0)
+             for k in curr if curr[k] != prev.get(k, 0)}
+            for curr, prev in zip(counts, prev_counts)]
+
+    def iteration(self, i, x, fun, **fields):
+        now = time.time()
+        counts, (evals, hits, misses) = self._counts_since(self.prev_counts)
+        self.sink.emit(
+            "iteration", iteration=i, fun=fun, x=np.array(x),
+            seconds=now - self.prev_time, elapsed=now - self.start_time,
+            evaluations=evals, cache_hits=hits, cache_misses=misses,
+            max_rss_bytes=_max_rss_bytes(), **fields)
+        self.prev_time = now
+        self.prev_counts = counts
+
+    def end(self, res=None, error=None):
+        # error is the exception that stopped the fit, if any
+        _, (evals, hits, misses) = self._counts_since(self.start_counts)
+        if error is not None:
+            fields = {"success": False,
+                      "error": "{}: {}".format(type(error).__name__, error)}
+        else:
+            fields = {k: res[k]
+                      for k in ("success", "message", "nit", "fun", "x")
+                      if k in res}
+        self.sink.emit(
+            "fit_end", elapsed=time.time() - self.start_time,
+            total_evaluations=evals, total_cache_hits=hits,
+            total_cache_misses=misses, max_rss_bytes=_max_rss_bytes(),
+            **fields)
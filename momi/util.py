@@ -1,5 +1,15 @@
 
+import concurrent.futures
+import contextlib
+import ctypes
+import json
+import logging
+import os
+import tempfile
+import threading
+import autograd
 import autograd.numpy as np
+import autograd.tracer
 from functools import partial, wraps
 #from autograd.core import primitive, Node
 from autograd.extend import primitive, defvjp
@@ -21,6 +31,133 @@ def count_calls(fun):
     return new_fun
 
 
+_MEMORY_UNITS = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+
+
+def parse_memory_size(size):
+    """
+    Number of bytes in size, which is either a number,
+    or a string like "500MB", "4GB", "4G" or "4GiB".
+    Units are powers of 1024.
+    """
+    if not isinstance(size, str):
+        return int(size)
+    s = size.strip().upper()
+    for suffix in ("IB", "B"):
+        if s.endswith(suffix):
+            s = s[:-len(suffix)]
+            break
+    unit = s[-1:] if s[-1:] in _MEMORY_UNITS else ""
+    try:
+        return int(float(s[:len(s) - len(unit)]) * _MEMORY_UNITS[unit])
+    except ValueError:
+        raise ValueError("Unrecognized memory size {}".format(size))
+
+
+class _ThreadLocalTraceStack(threading.local):
+    # autograd numbers its traces with a global counter,
+    # which concurrent threads would corrupt;
+    # each thread only sees its own boxes,
+    # so it is enough to count the traces per thread
+    top = -1
+    new_trace = autograd.tracer.TraceStack.new_trace
+
+
+# the autograd trace stack replaced by _thread_local_traces(),
+# and the number of its active users
+_trace_stack_state = {"saved": None, "users": 0}
+_trace_stack_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _thread_local_traces():
+    # while active, autograd counts its traces per thread,
+    # so that worker threads can differentiate concurrently.
+    # autograd.tracer.trace_stack is global to the process,
+    # so it is only replaced while some thread pool is in use,
+    # and the original is restored when the last one is done
+    state = _trace_stack_state
+    with _trace_stack_lock:
+        if state["users"] == 0:
+            old_stack = autograd.tracer.trace_stack
+            new_stack = _ThreadLocalTraceStack()
+            # in case we are inside a trace, keep counting from it,
+            # so that new traces are nested above it
+            new_stack.top = old_stack.top
+            autograd.tracer.trace_stack = new_stack
+            state["saved"] = old_stack
+        state["users"] += 1
+    try:
+        yield
+    finally:
+        with _trace_stack_lock:
+            state["users"] -= 1
+            if state["users"] == 0:
+                autograd.tracer.trace_stack = state["saved"]
+                state["saved"] = None
+
+
+def _set_omp_num_threads(n_threads):
+    # omp_set_num_threads() only applies to the calling thread,
+    # so this gives each worker thread its own budget
+    if n_threads is None:
+        return
+    try:
+        from . import convolution
+        ctypes.CDLL(convolution.__file__).omp_set_num_threads(
+            ctypes.c_int(int(n_threads)))
+    except (ImportError, OSError, AttributeError):
+        logging.getLogger(__name__).debug(
+            "Unable to set the number of OpenMP threads")
+
+
+def hessian_from_hvps(fun, x, n_workers=None, threads_per_worker=None):
+    """
+    The hessian of the scalar function fun at x,
+    built one column at a time from the hessian-vector products
+    along the coordinate directions.
+
+    autograd.hessian() keeps the whole forward-over-reverse tape of fun
+    alive until every column is done. Here each column is an
+    independent hessian-vector product, whose tape is freed before
+    the next one starts, so the peak memory is that of n_workers
+    hessian-vector products, regardless of the number of parameters.
+    (For SfsLikelihoodSurface.log_lik, each hessian-vector product
+    in turn recomputes the SFS batches one at a time, see
+    rearrange_dict_grad()).
+
+    :param fun: scalar function, differentiable by autograd
+    :param x: the point to compute the hessian at
+    :param n_workers: if > 1, compute the columns concurrently
+        on this many threads
+    :param threads_per_worker: the number of OpenMP threads for each worker;
+        default is to divide the available cores evenly between them
+    :returns: array with shape x.shape + x.shape
+    """
+    x = np.array(x, dtype=float)
+    hvp = autograd.hessian_vector_product(fun)
+
+    def column(j):
+        direction = np.zeros(x.size)
+        direction[j] = 1.0
+        return np.reshape(hvp(x, np.reshape(direction, x.shape)), -1)
+
+    if n_workers and n_workers > 1 and x.size > 1:
+        if threads_per_worker is None:
+            threads_per_worker = max(1, (os.cpu_count() or 1) // n_workers)
+        with _thread_local_traces(), concurrent.futures.ThreadPoolExecutor(
+                n_workers, initializer=_set_omp_num_threads,
+                initargs=(threads_per_worker,)) as executor:
+            columns = list(executor.map(column, range(x.size)))
+    else:
+        columns = [column(j) for j in range(x.size)]
+
+    ret = np.array(columns)
+    # the columns are only symmetric up to rounding error
+    ret = 0.5 * (ret + np.transpose(ret))
+    return np.reshape(ret, x.shape + x.shape)
+
+
 def check_symmetric(X):
     Xt = np.transpose(X)
     assert np.allclose(X, Xt)
@@ -145,3 +282,100 @@ class memoize_instance(object):
         except KeyError:
             res = cache[key] = self.func(*args, **kw)
         return res
+
+
+def save_checkpoint(path, state):
+    """
+    Atomically save the dict state to path.
+
+    Arrays are stored in binary (as a .npz archive), and
+    numpy.random states (from RandomState.get_state()) are stored exactly,
+    the other values must be JSON serializable.
+    The file is written to a temporary file in the same directory,
+    which then replaces path, so path always holds a complete checkpoint,
+    even if the process is killed while writing.
+    """
+    arrays = {}
+    meta = {}
+    rng_states = {}
+    for k, v in state.items():
+        if isinstance(v, tuple) and len(v) == 5 and v[0] == "MT19937":
+            name, keys, pos, has_gauss, cached_gaussian = v
+            arrays[k] = np.asarray(keys)
+            rng_states[k] = [name, int(pos), int(has_gauss),
+                             float(cached_gaussian)]
+        elif isinstance(v, np.ndarray):
+            arrays[k] = v
+        else:
+            meta[k] = v
+    arrays["__meta__"] = np.array(json.dumps(
+        {"values": meta, "rng_states": rng_states}))
+
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(
+        dir=dirname, prefix=".{}.".format(os.path.basename(path)),
+        suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def load_checkpoint(path):
+    """
+    Load a dict saved by save_checkpoint().
+
+    Also reads the older JSON checkpoints.
+    """
+    with open(path, "rb") as f:
+        is_npz = f.read(2) == b"PK"
+    if not is_npz:
+        with open(path) as f:
+            return json.load(f)
+
+    with np.load(path, allow_pickle=False) as npz:
+        meta = json.loads(str(npz["__meta__"]))
+        state = {k: npz[k] for k in npz.files if k != "__meta__"}
+    state.update(meta["values"])
+    for k, (name, pos, has_gauss, cached_gaussian) in meta["rng_states"].items():
+        state[k] = (name, state[k], pos, has_gauss, cached_gaussian)
+    return state
+
+
+class _CheckpointWriter(object):
+    """
+    Saves checkpoints with save_checkpoint() on a background thread,
+    so that writing does not block the caller.
+
+    At most one write is in flight: write() first waits for the
+    previous one, so checkpoints are written in order, and any error
+    is raised in the caller. close() waits for the last write.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._executor = concurrent.futures.ThreadPoolExecutor(1)
+        self._pending = None
+
+    def write(self, state):
+        self._wait()
+        # snapshot the arrays, in case the caller modifies them in place
+        state = {k: np.array(v) if isinstance(v, np.ndarray) else v
+                 for k, v in state.items()}
+        self._pending = self._executor.submit(
+            save_checkpoint, self.path, state)
+
+    def _wait(self):
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def close(self):
+        try:
+            self._wait()
+        finally:
+            self._executor.shutdown()
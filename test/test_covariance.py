@@ -104,3 +104,26 @@ import scipy
 #    #    raise
 #    # else:
 #    #    os.remove(fname)
+
+
+@pytest.mark.parametrize("cone", [
+    (1, 1, 1, 1), (-1, None, 1, 1), (0, 1, None, -1), (1, -1, 0, 0)])
+def test_project_scores(cone):
+    from momi.confidence_region import _project_scores
+    rng = np.random.RandomState(0)
+    A = rng.normal(size=(4, 4))
+    fisher = np.dot(A, A.T) + .1 * np.eye(4)
+    scores = rng.multivariate_normal(np.zeros(4), fisher, size=200)
+
+    liks, mles = _project_scores(scores, fisher, cone, psd_rtol=1e-8)
+    tnc_liks, tnc_mles = _project_scores(
+        scores, fisher, cone, psd_rtol=1e-8, method="tnc")
+
+    assert np.allclose(liks, tnc_liks, atol=1e-6)
+    # tnc only finds the maximum approximately
+    assert np.all(liks >= tnc_liks - 1e-12)
+    for c, m in zip(cone, mles.T):
+        if c == 0:
+            assert np.all(m == 0)
+        elif c is not None:
+            assert np.all(c * m >= 0)
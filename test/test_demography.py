@@ -1,11 +1,12 @@
 
+import pickle
 import pytest
 
 import numpy as np
 
 import momi
 from momi import expected_sfs_tensor_prod, expected_total_branch_len
-from demo_utils import simple_admixture_demo
+from demo_utils import simple_admixture_demo, simple_admixture_3pop
 from momi.math_functions import hypergeom_quasi_inverse
 
 import autograd
@@ -29,6 +30,122 @@ def test_constructor():
     assert False
 
 
+def test_demo_template():
+    model = momi.DemographicModel(1., .25)
+    model.add_time_param("t_size", 1e4)
+    model.add_time_param("t_join", 2e4)
+    model.add_leaf("a")
+    model.add_leaf("b")
+    model.set_size("b", t="t_size", N=2.)
+    model.move_lineages("a", "b", t="t_join")
+    sampled_n = {"a": 4, "b": 3}
+
+    def check_demo():
+        demo = model._get_demo(sampled_n)
+        params_dict = model.get_params()
+        events = sorted(model.leaf_events + model.size_events +
+                        model.topology_events,
+                        key=lambda e: e.t(params_dict))
+        demo2 = momi.demography.Demography(momi.events._build_demo_graph(
+            events, model._get_sample_sizes(sampled_n), params_dict, 1.0))
+
+        vecs = [np.random.uniform(size=(10, n + 1)) for n in demo.sampled_n]
+        assert np.allclose(expected_sfs_tensor_prod(vecs, demo),
+                           expected_sfs_tensor_prod(vecs, demo2))
+
+    check_demo()
+    model.set_params({"t_size": 5e3, "t_join": 3e4})
+    check_demo()
+    assert len(model._demo_templates) == 1
+
+    # changing the order of events compiles a new template
+    model.set_params({"t_size": 5e4})
+    check_demo()
+    assert len(model._demo_templates) == 2
+
+
+def test_model_spec_pickle():
+    model = momi.DemographicModel(1e4, 25, muts_per_gen=1.25e-8)
+    model.add_size_param("n_a", 5e3)
+    model.add_growth_param("g", 1e-4)
+    model.add_time_param("t_pulse", 1e3, upper=1e4)
+    model.add_time_param("t_join", 2e4, lower_constraints=["t_pulse"])
+    model.add_pulse_param("p", .1)
+    model.add_leaf("a", N="n_a", g="g")
+    model.add_leaf("b")
+    model.move_lineages("a", "b", t="t_pulse", p="p")
+    model.move_lineages("a", "b", t="t_join")
+    sampled_n = {"a": 4, "b": 3}
+
+    spec = pickle.loads(pickle.dumps(model._get_spec()))
+    model2 = spec.build()
+    assert list(model2.get_params().items()) == list(
+        model.get_params().items())
+    assert np.allclose(model2.expected_branchlen(sampled_n),
+                       model.expected_branchlen(sampled_n))
+
+    # the built-in random generators are picklable too
+    model2.set_params(randomize=True)
+    assert model2.get_params()["t_join"] > model2.get_params()["t_pulse"]
+
+    # whole models can be pickled, without their caches
+    model.expected_branchlen(sampled_n)
+    model3 = pickle.loads(pickle.dumps(model))
+    assert not model3._demo_templates
+    assert np.allclose(model3.expected_branchlen(sampled_n),
+                       model.expected_branchlen(sampled_n))
+
+    model.add_parameter("x", 1.0, scale_transform=lambda x, p: x,
+                        unscale_transform=lambda x, p: x)
+    with pytest.raises(ValueError):
+        model._get_spec()
+
+
+def test_topology_shared():
+    model = momi.DemographicModel(1., .25)
+    model.add_pulse_param("p", .1)
+    model.add_leaf("a")
+    model.add_leaf("b")
+    model.move_lineages("a", "b", t=1e4, p="p")
+    model.move_lineages("a", "b", t=2e4)
+    demo0 = model._get_demo({"b": 2, "a": 3})
+    model.set_params({"p": .3})
+    demo1 = model._get_demo({"b": 2, "a": 3})
+
+    # bound from the same template, so the graph structure is not copied
+    assert demo0._get_graph_structure() is demo1._get_graph_structure()
+    assert not np.allclose(expected_total_branch_len(demo0),
+                           expected_total_branch_len(demo1))
+
+    import networkx as nx
+    for v in demo0._G:
+        assert demo0._n_at_node(v) == sum(
+            demo0._G.node[(pop, idx)]['lineages']
+            for pop, idx in nx.dfs_preorder_nodes(demo0._G, v)
+            if idx == 0)
+
+
+@pytest.mark.parametrize("model_fun,sampled_n", [
+    (simple_admixture_demo, {"b": 10, "a": 30}),
+    (simple_admixture_3pop, {"b": 5, "a": 20, "c": 15})])
+def test_banded_admixture(model_fun, sampled_n):
+    model = model_fun()
+    demo0 = model._get_demo(sampled_n)
+    model.set_admixture_tol(1e-8)
+    demo1 = model._get_demo(sampled_n)
+
+    discarded = demo1.admixture_discarded_mass
+    assert discarded and all(0 <= d <= 1e-8 for d in discarded.values())
+    assert all(d == 0 for d in demo0.admixture_discarded_mass.values())
+    assert any(demo1._admixture_band(v) != (0, demo1._n_at_node(v) + 1)
+               for v in discarded)
+
+    vecs = [np.random.uniform(size=(10, n + 1)) for n in demo0.sampled_n]
+    vals0, vals1 = [expected_sfs_tensor_prod(vecs, d)
+                    for d in (demo0, demo1)]
+    assert np.allclose(vals0, vals1, rtol=1e-6)
+
+
 class NoLookdownDemography(momi.demography.Demography):
     def __init__(self, demo):
         super(NoLookdownDemography, self).__init__(demo._G)
@@ -1,6 +1,8 @@
+import json
 import pytest
 import random
 import autograd.numpy as np
+import scipy.stats
 from momi import SfsLikelihoodSurface
 import momi
 
@@ -157,3 +159,213 @@ def test_underflow_robustness(folded):
     print("# Relative Error:", "\n", error)
 
     assert max(abs(error)) < .1
+
+
+def test_optimize_multistart():
+    model = momi.DemographicModel(1, muts_per_gen=1e-4)
+    model.add_time_param("join_time", 1.0, upper=3.0)
+    model.add_size_param("N", 1.0, lower=.1, upper=10.)
+    model.add_leaf(1, N="N")
+    model.add_leaf(2)
+    model.move_lineages(1, 2, t="join_time")
+
+    data = model.simulate_data(1000, 0, 300,
+                               sampled_n_dict={1: 5, 2: 5},
+                               random_seed=1)
+    model.set_data(data.extract_sfs(1))
+
+    np.random.seed(2)
+    serial = model.copy().optimize_multistart(3)
+    np.random.seed(2)
+    fitted = model.copy()
+    parallel = fitted.optimize_multistart(3, n_workers=2)
+
+    assert list(parallel["start"]) == list(serial["start"])
+    assert np.allclose(parallel["kl_divergence"], serial["kl_divergence"])
+    assert list(parallel["kl_divergence"]) == sorted(
+        parallel["kl_divergence"])
+    assert set(parallel["status"]) <= {"converged", "failed"}
+    assert np.isclose(fitted.kl_div(), parallel["kl_divergence"][0])
+    assert np.isclose(fitted.get_params()["join_time"],
+                      parallel["join_time"][0])
+
+    np.random.seed(2)
+    abandoned = model.copy().optimize_multistart(
+        3, abandon_margin=0.0, abandon_after=0)
+    assert len(abandoned) == 3
+    assert abandoned["status"][0] != "abandoned"
+
+
+def test_optimize_multistart_checkpoint(tmpdir):
+    model = momi.DemographicModel(1, muts_per_gen=1e-4)
+    model.add_time_param("join_time", 1.0, upper=3.0)
+    model.add_size_param("N", 1.0, lower=.1, upper=10.)
+    model.add_leaf(1, N="N")
+    model.add_leaf(2)
+    model.move_lineages(1, 2, t="join_time")
+
+    data = model.simulate_data(1000, 0, 300,
+                               sampled_n_dict={1: 5, 2: 5},
+                               random_seed=1)
+    model.set_data(data.extract_sfs(1))
+
+    checkpoint_file = str(tmpdir.join("multistart_checkpoint"))
+    np.random.seed(2)
+    full = model.copy().optimize_multistart(
+        3, checkpoint_file=checkpoint_file)
+
+    # pretend the run was interrupted after the first start
+    state = momi.util.load_checkpoint(checkpoint_file)
+    assert len(state["results"]) == 3
+    state["results"] = state["results"][:1]
+    state["results_x"] = state["results_x"][:1]
+    momi.util.save_checkpoint(checkpoint_file, state)
+
+    np.random.seed(3)
+    fitted = model.copy()
+    resumed = fitted.optimize_multistart(3, checkpoint_file=checkpoint_file)
+    assert resumed.equals(full)
+    assert np.isclose(fitted.kl_div(), full["kl_divergence"][0])
+
+    with pytest.raises(ValueError):
+        model.copy().optimize_multistart(4, checkpoint_file=checkpoint_file)
+
+
+def test_parametric_bootstrap(tmpdir):
+    model = momi.DemographicModel(1, muts_per_gen=1e-4)
+    model.add_time_param("join_time", 1.0, upper=3.0)
+    model.add_leaf(1)
+    model.add_leaf(2)
+    model.move_lineages(1, 2, t="join_time")
+
+    data = model.simulate_data(1000, 0, 100,
+                               sampled_n_dict={1: 4, 2: 4},
+                               random_seed=1)
+    model.set_data(data.extract_sfs(10))
+    model.optimize()
+
+    boot_kwargs = dict(length=1000, recoms_per_gen=0, num_loci=100,
+                       n_blocks=10, random_seed=2)
+    serial = model.parametric_bootstrap(3, **boot_kwargs)
+    assert list(serial["rep"]) == [0, 1, 2]
+    assert set(serial["status"]) <= {"converged", "failed"}
+
+    # the same replicates, in parallel
+    out_file = str(tmpdir.join("bootstrap.jsonl"))
+    parallel = model.parametric_bootstrap(
+        3, out_file=out_file, n_workers=2, **boot_kwargs)
+    assert np.allclose(parallel["join_time"], serial["join_time"])
+
+    # resume an interrupted run
+    out_file = str(tmpdir.join("bootstrap_resume.jsonl"))
+    model.parametric_bootstrap(2, out_file=out_file, **boot_kwargs)
+    resumed = model.parametric_bootstrap(3, out_file=out_file,
+                                         **boot_kwargs)
+    with open(out_file) as f:
+        assert len(f.readlines()) == 3
+    assert np.allclose(resumed["join_time"], serial["join_time"])
+
+    # resume a run interrupted while writing the last line
+    out_file = str(tmpdir.join("bootstrap_truncated.jsonl"))
+    model.parametric_bootstrap(2, out_file=out_file, **boot_kwargs)
+    with open(out_file, "a") as f:
+        f.write('{"rep": 2, "se')
+    resumed = model.parametric_bootstrap(3, out_file=out_file,
+                                         **boot_kwargs)
+    with open(out_file) as f:
+        assert [json.loads(line)["rep"] for line in f] == [0, 1, 2]
+    assert np.allclose(resumed["join_time"], serial["join_time"])
+
+    # the replicates in out_file must come from the same call
+    with pytest.raises(ValueError):
+        model.parametric_bootstrap(3, out_file=out_file, **dict(
+            boot_kwargs, random_seed=3))
+    with pytest.raises(ValueError):
+        model.parametric_bootstrap(3, out_file=out_file, **dict(
+            boot_kwargs, num_loci=50))
+
+
+def test_jackknife_fit():
+    model = momi.DemographicModel(1, muts_per_gen=1e-4)
+    model.add_time_param("join_time", 1.0, upper=3.0)
+    model.add_size_param("N", 1.0, lower=.1, upper=10.)
+    model.add_leaf(1, N="N")
+    model.add_leaf(2)
+    model.move_lineages(1, 2, t="join_time")
+
+    data = model.simulate_data(1000, 0, 100,
+                               sampled_n_dict={1: 4, 2: 4},
+                               random_seed=1)
+    model.set_data(data.extract_sfs(5), mem_chunk_size=10)
+    model.optimize()
+
+    jackknife = model.jackknife_fit()
+    assert list(jackknife["block"]) == list(range(5))
+    assert set(jackknife["status"]) <= {"converged", "failed"}
+
+    # compare to refitting a copy of the leave-one-out data from scratch
+    sfs = model._get_sfs()
+    loo_counts = sfs.freqs_matrix[:, 1:].toarray()
+    keep, = np.nonzero(loo_counts.sum(axis=1))
+    loo_sfs = momi.data.sfs.Sfs.from_matrix(
+        loo_counts[keep, :],
+        momi.data.configurations._ConfigList_Subset(sfs.configs, keep),
+        False, sfs.length * 4 / 5)
+    loo_model = model.copy()
+    loo_model.set_data(loo_sfs, mem_chunk_size=10)
+    loo_model.optimize()
+    assert np.allclose(jackknife["join_time"][0],
+                       loo_model.get_params()["join_time"], rtol=1e-3)
+    assert np.allclose(jackknife["N"][0],
+                       loo_model.get_params()["N"], rtol=1e-3)
+
+    cold = model.jackknife_fit(n_workers=2, warm_start=False)
+    assert np.allclose(cold["join_time"], jackknife["join_time"],
+                       rtol=1e-3)
+
+
+def test_profile_likelihood():
+    model = momi.DemographicModel(1, muts_per_gen=1e-4)
+    model.add_time_param("join_time", 1.0, upper=3.0)
+    model.add_size_param("N", 1.0, lower=.1, upper=10.)
+    model.add_leaf(1, N="N")
+    model.add_leaf(2)
+    model.move_lineages(1, 2, t="join_time")
+
+    data = model.simulate_data(1000, 0, 100,
+                               sampled_n_dict={1: 4, 2: 4},
+                               random_seed=1)
+    model.set_data(data.extract_sfs(5))
+    model.optimize()
+    N_hat = model.get_params()["N"]
+    log_lik_hat = model.log_likelihood()
+
+    grid = N_hat * np.exp(np.linspace(-1.5, 1.5, 9))
+    profile = model.profile_likelihood("N", grid, stop_early=False)
+    assert np.allclose(profile["N"], grid)
+    assert set(profile["status"]) <= {"converged", "failed"}
+    assert np.all(profile["lr_statistic"] >= -1e-6)
+    assert np.all(profile["log_likelihood"] <= log_lik_hat + 1e-6)
+    # the profile is maximized at the MLE
+    assert np.all(np.diff(profile["log_likelihood"][:4]) > 0)
+    assert np.all(np.diff(profile["log_likelihood"][5:]) < 0)
+    # the model is left at the MLE
+    assert np.isclose(model.get_params()["N"], N_hat)
+
+    # compare to a refit with N fixed
+    fixed = model.copy()
+    fixed.set_params({"N": grid[2]})
+    fixed.parameters["N"].x_bounds = [fixed._get_x("N")] * 2
+    fixed.optimize()
+    assert np.isclose(profile["join_time"][2],
+                      fixed.get_params()["join_time"], rtol=1e-3)
+    assert np.isclose(profile["log_likelihood"][2],
+                      fixed.log_likelihood(), rtol=1e-4)
+
+    early = model.profile_likelihood("N", grid, n_workers=2, level=.95)
+    crossed = early["lr_statistic"] > scipy.stats.chi2.ppf(.95, 1)
+    assert np.any(crossed)
+    assert "skipped" in set(early["status"])
+    done = early["status"] != "skipped"
+    assert np.allclose(early["log_likelihood"][done],
+                       profile["log_likelihood"][done], rtol=1e-4)
@@ -1,4 +1,6 @@
 
+import json
+import socket
 import pytest
 import momi
 import momi.likelihood
@@ -71,6 +73,364 @@ def test_batches_grad():
     jac2 = grad(lambda x: momi.likelihood._composite_log_likelihood(sfs, demo_func(*x), mut_rate=1.))(x0)
     assert np.allclose(jac1, jac2)
 
+def test_batches_hessian():
+    model = momi.DemographicModel(1, muts_per_gen=1e-3)
+    model.add_time_param("join_time", 1.0, upper=3.0)
+    model.add_size_param("N", 2.0)
+    model.add_leaf("a", N="N")
+    model.add_leaf("b")
+    model.move_lineages("a", "b", t="join_time")
+
+    sfs = model.simulate_data(1000, 0, 100,
+                              sampled_n_dict={"a": 4, "b": 4},
+                              random_seed=1).extract_sfs(None)
+    model.set_data(sfs)
+    x = model._get_x()
+
+    fisher1 = SfsLikelihoodSurface(sfs, demo_func=model._demo_fun,
+                                   batch_size=5)._fisher(x)
+    fisher2 = SfsLikelihoodSurface(sfs, demo_func=model._demo_fun,
+                                   batch_size=-1)._fisher(x)
+    assert np.allclose(fisher1, fisher2)
+
+def test_memory_budget():
+    model = momi.DemographicModel(1, muts_per_gen=1e-3)
+    model.add_time_param("join_time", 1.0, upper=3.0)
+    model.add_size_param("N", 2.0)
+    model.add_leaf("a", N="N")
+    model.add_leaf("b")
+    model.move_lineages("a", "b", t="join_time")
+
+    sfs = model.simulate_data(1000, 0, 100,
+                              sampled_n_dict={"a": 4, "b": 4},
+                              random_seed=1).extract_sfs(None)
+    model.set_data(sfs)
+    x = model._get_x()
+
+    unbatched = SfsLikelihoodSurface(sfs, demo_func=model._demo_fun,
+                                     batch_size=-1)
+    large = SfsLikelihoodSurface(sfs, demo_func=model._demo_fun,
+                                 memory_budget="1GB")
+    assert large.batch_plan is None
+    assert np.isclose(large.log_lik(x), unbatched.log_lik(x))
+    assert large.batch_plan["n_batches"] == 1
+
+    bytes_per_config = large.batch_plan["bytes_per_config"]
+    small = SfsLikelihoodSurface(sfs, demo_func=model._demo_fun,
+                                 memory_budget=5.5 * bytes_per_config)
+    assert np.isclose(small.log_lik(x), unbatched.log_lik(x))
+    assert np.allclose(grad(small.log_lik)(x), grad(unbatched.log_lik)(x))
+    assert small.batch_plan["batch_size"] == 5
+    assert small.batch_plan["n_batches"] == len(small.sfs_batches) > 1
+    assert small.batch_plan["peak_bytes"] <= small.memory_budget
+
+    log_lik = model.log_likelihood()
+    model.set_data(sfs, memory_budget="1KB")
+    assert model._get_surface().memory_budget == 1024
+    assert np.isclose(model.log_likelihood(), log_lik)
+    assert model.copy()._memory_budget == "1KB"
+
+
+def test_threaded_batches():
+    model = momi.DemographicModel(1, muts_per_gen=1e-3)
+    model.add_time_param("join_time", 1.0, upper=3.0)
+    model.add_size_param("N", 2.0)
+    model.add_leaf("a", N="N")
+    model.add_leaf("b")
+    model.move_lineages("a", "b", t="join_time")
+
+    sfs = model.simulate_data(1000, 0, 100,
+                              sampled_n_dict={"a": 4, "b": 4},
+                              random_seed=1).extract_sfs(None)
+    model.set_data(sfs)
+    x = model._get_x()
+
+    serial = SfsLikelihoodSurface(sfs, demo_func=model._demo_fun,
+                                  batch_size=5)
+    threaded = SfsLikelihoodSurface(sfs, demo_func=model._demo_fun,
+                                    batch_size=5, n_threads=3,
+                                    threads_per_worker=1)
+    assert len(threaded.sfs_batches) > 3
+
+    val, g = autograd.value_and_grad(threaded.log_lik)(x)
+    assert np.isclose(val, serial.log_lik(x))
+    assert np.allclose(g, grad(serial.log_lik)(x))
+    assert np.allclose(hessian(threaded.log_lik)(x),
+                       hessian(serial.log_lik)(x))
+
+    # summed in a fixed order, regardless of thread scheduling
+    for _ in range(3):
+        val2, g2 = autograd.value_and_grad(threaded.log_lik)(x)
+        assert val2 == val and np.array_equal(g2, g)
+
+    # autograd's global trace stack is only replaced during the evaluation
+    assert not isinstance(autograd.tracer.trace_stack,
+                          momi.util._ThreadLocalTraceStack)
+
+
+def test_eval_cache():
+    model = momi.DemographicModel(1, muts_per_gen=1e-3)
+    model.add_time_param("join_time", 1.0, upper=3.0)
+    model.add_size_param("N", 2.0)
+    model.add_leaf("a", N="N")
+    model.add_leaf("b")
+    model.move_lineages("a", "b", t="join_time")
+
+    sfs = model.simulate_data(1000, 0, 100,
+                              sampled_n_dict={"a": 4, "b": 4},
+                              random_seed=1).extract_sfs(None)
+    model.set_data(sfs)
+    x = model._get_x()
+
+    uncached = SfsLikelihoodSurface(sfs, demo_func=model._demo_fun,
+                                    eval_cache_size=0)
+    surface = SfsLikelihoodSurface(sfs, demo_func=model._demo_fun)
+
+    val, g = autograd.value_and_grad(surface.kl_div)(x)
+    assert surface.eval_cache_info().misses == {"grad": 1}
+    assert np.isclose(val, uncached.kl_div(x))
+    assert np.allclose(g, grad(uncached.kl_div)(x))
+
+    # value and gradient are both reused
+    assert surface.log_lik(x) == uncached.log_lik(x)
+    val2, g2 = autograd.value_and_grad(surface.kl_div)(x)
+    assert val2 == val and np.array_equal(g2, g)
+    info = surface.eval_cache_info()
+    assert info.hits == {"log_lik": 1, "grad": 1}
+    assert info.misses == {"grad": 1}
+
+    # higher-order derivatives bypass the cache
+    assert np.allclose(hessian(surface.log_lik)(x),
+                       hessian(uncached.log_lik)(x))
+
+    res = surface.find_mle(x, method="trust-ncg", hessp=True)
+    info = surface.eval_cache_info()
+    assert info.hits.get("hessp", 0) + info.misses["hessp"] > 0
+    assert info.currsize <= info.maxsize
+    assert np.isclose(res.fun, uncached.kl_div(res.x))
+
+    # final log-likelihood in optimize() is not recomputed
+    model.optimize()
+    hits = model._get_surface().eval_cache_info().hits
+    assert hits["log_lik"] >= 1
+
+
+def test_eval_cache_model_changed():
+    model = momi.DemographicModel(1, muts_per_gen=1e-3)
+    model.add_time_param("join_time", 1.0, upper=3.0)
+    model.add_leaf("a")
+    model.add_leaf("b")
+    model.move_lineages("a", "b", t="join_time")
+
+    sfs = model.simulate_data(1000, 0, 100,
+                              sampled_n_dict={"a": 4, "b": 4},
+                              random_seed=1).extract_sfs(None)
+    model.set_data(sfs)
+    before = model.log_likelihood()
+
+    # the parameters are unchanged, but the model is not
+    for change in (lambda m: m.set_size("b", t=0.5, N=10.0),
+                   lambda m: m.set_mut_rate(2e-3),
+                   lambda m: m.move_lineages("a", "b", t=0.1, p=.5),
+                   lambda m: (m.add_size_param("N_a", 3.0),
+                              m.set_size("a", t=0, N="N_a")),
+                   lambda m: setattr(m, "muts_per_gen", 4e-3),
+                   lambda m: setattr(m, "N_e", 2.0)):
+        change(model)
+        assert np.isclose(model.log_likelihood(),
+                          model.copy().log_likelihood())
+        assert not np.isclose(model.log_likelihood(), before)
+        before = model.log_likelihood()
+
+
+@pytest.mark.parametrize("n_threads", [None, 3])
+def test_hessian_from_hvps(n_threads):
+    model = momi.DemographicModel(1, muts_per_gen=1e-3)
+    model.add_time_param("join_time", 1.0, upper=3.0)
+    model.add_size_param("N", 2.0)
+    model.add_size_param("N_b", 1.0)
+    model.add_leaf("a", N="N")
+    model.add_leaf("b", N="N_b")
+    model.move_lineages("a", "b", t="join_time")
+
+    sfs = model.simulate_data(1000, 0, 100,
+                              sampled_n_dict={"a": 4, "b": 4},
+                              random_seed=1).extract_sfs(None)
+    model.set_data(sfs)
+    x = model._get_x()
+
+    batched = SfsLikelihoodSurface(sfs, demo_func=model._demo_fun,
+                                   batch_size=5, n_threads=n_threads,
+                                   threads_per_worker=1)
+    unbatched = SfsLikelihoodSurface(sfs, demo_func=model._demo_fun,
+                                     batch_size=-1)
+    fisher = batched._fisher(x)
+    assert np.allclose(fisher, np.transpose(fisher))
+    assert np.allclose(fisher, -hessian(unbatched.log_lik)(x))
+
+    res = batched.find_mle(x, method="trust-exact", hess=True)
+    assert res.success
+    info = batched.eval_cache_info()
+    assert info.misses["hess"] > 0
+    assert np.allclose(
+        res.x, unbatched.find_mle(x, method="trust-exact", hess=True).x,
+        rtol=1e-4)
+
+
+@pytest.mark.parametrize("use_pairwise_diffs", (True, False))
+def test_score_cov(use_pairwise_diffs):
+    model = momi.DemographicModel(1, muts_per_gen=1e-3)
+    model.add_time_param("join_time", 1.0, upper=3.0)
+    model.add_size_param("N", 2.0)
+    model.add_leaf("a", N="N")
+    model.add_leaf("b")
+    model.move_lineages("a", "b", t="join_time")
+
+    sfs = model.simulate_data(1000, 0, 100,
+                              sampled_n_dict={"a": 4, "b": 4},
+                              random_seed=1).extract_sfs(10)
+    model.set_data(sfs)
+    x = model._get_x()
+
+    surface = SfsLikelihoodSurface(
+        sfs, demo_func=model._demo_fun, mut_rate=1e-3 * 1000,
+        use_pairwise_diffs=use_pairwise_diffs, batch_size=5)
+    assert len(surface.sfs_batches) > 1
+
+    scores = surface._locus_scores(x)
+    assert scores.shape == (sfs.n_loci, len(x))
+    assert np.allclose(scores, jacobian(
+        lambda y: surface.log_lik(y, vector=True))(x))
+
+    def f_vec(y):
+        ret = surface.log_lik(y, vector=True)
+        return ret - np.mean(ret)
+    j = jacobian(f_vec)(x)
+    score_cov = np.einsum("ij,ik", j, j)
+    assert np.allclose(surface._score_cov(x), score_cov)
+
+    assert np.allclose(momi.confidence_region._many_score_cov(
+        x, sfs, model._demo_fun, batch_size=5, mut_rate=1e-3 * 1000,
+        use_pairwise_diffs=use_pairwise_diffs), score_cov)
+    assert np.allclose(momi.confidence_region._many_score_cov(
+        x, sfs, model._demo_fun, batch_size=5, mut_rate=1e-3 * 1000,
+        use_pairwise_diffs=use_pairwise_diffs, n_workers=2), score_cov)
+
+
+@pytest.mark.parametrize("N_b_lower", [.1, 2.])
+def test_trust_krylov(N_b_lower):
+    def make_model(N_b, lower):
+        model = momi.DemographicModel(1, muts_per_gen=1e-3)
+        model.add_time_param("join_time", .25, upper=3.0)
+        model.add_size_param("N", 2.0)
+        model.add_size_param("N_b", N_b, lower=lower)
+        model.add_leaf("a", N="N")
+        model.add_leaf("b", N="N_b")
+        model.move_lineages("a", "b", t="join_time")
+        return model
+
+    sfs = make_model(1.0, .1).simulate_data(
+        1000, 0, 100, sampled_n_dict={"a": 4, "b": 4},
+        random_seed=1).extract_sfs(None)
+
+    # with lower=2, the bound is active at the optimum
+    model = make_model(3.0, N_b_lower)
+    model.set_data(sfs)
+    x0 = model._get_x()
+
+    res = model.optimize(method="trust-krylov")
+    assert res.success
+    assert model.get_params()["N_b"] >= N_b_lower
+    assert len(res.evaluations) == res.nit
+    for k in ("nfev", "nhev"):
+        assert sum(e[k] for e in res.evaluations) == res[k]
+    assert sum(e["njev"] for e in res.evaluations) == res.njev - 1
+
+    model._set_x(x0)
+    res2 = model.optimize(method="L-BFGS-B")
+    assert np.isclose(res.fun, res2.fun, rtol=1e-6)
+    assert np.allclose(res.x, res2.x, rtol=1e-3, atol=1e-3)
+
+
+def test_telemetry(tmpdir):
+    model = momi.DemographicModel(1, muts_per_gen=1e-3)
+    model.add_time_param("join_time", 1.0, upper=3.0)
+    model.add_size_param("N", 2.0)
+    model.add_leaf("a", N="N")
+    model.add_leaf("b")
+    model.move_lineages("a", "b", t="join_time")
+    sfs = model.simulate_data(1000, 0, 100,
+                              sampled_n_dict={"a": 4, "b": 4},
+                              random_seed=1).extract_sfs(None)
+    model.set_data(sfs, memory_budget="1GB")
+    x0 = model._get_x()
+
+    def read_events(path):
+        with open(path) as f:
+            return [json.loads(line) for line in f]
+
+    path = str(tmpdir.join("telemetry.jsonl"))
+    res = model.optimize(method="trust-krylov", telemetry=path)
+    events = read_events(path)
+    assert [e["event"] for e in events] == (
+        ["fit_start", "batch_plan"] + ["iteration"] * res.nit + ["fit_end"])
+    assert len(set(e["run"] for e in events)) == 1
+    iterations = events[2:-1]
+    assert [e["iteration"] for e in iterations] == list(range(res.nit))
+    assert np.allclose(iterations[-1]["x"], res.x)
+    # the trial points are evaluated with their gradients,
+    # without separate evaluations of the log likelihood
+    assert all(e["evaluations"].get("log_lik", 0) == 0 for e in iterations)
+    assert all(e["evaluations"]["hess"] >= 1 for e in iterations)
+    assert all(e["seconds"] >= 0 and e["max_rss_bytes"] > 0
+               for e in iterations)
+    assert events[-1]["success"] and events[-1]["nit"] == res.nit
+    # the gradients of trust-krylov are traced for hessian-vector products
+    assert events[-1]["total_evaluations"]["hess"] == res.njev
+
+    # a sink can be shared between fits, and streamed to a socket
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(str(tmpdir.join("telemetry.sock")))
+    server.listen(1)
+    with momi.TelemetrySink(
+            "unix://" + str(tmpdir.join("telemetry.sock")),
+            run_id="stochastic") as sink:
+        conn, _ = server.accept()
+        for _ in range(2):
+            model._set_x(x0)
+            model.stochastic_optimize(
+                num_iters=5, n_minibatches=3, telemetry=sink,
+                rgen=np.random.RandomState(1))
+    with conn.makefile() as f:
+        events = [json.loads(line) for line in f]
+    conn.close()
+    server.close()
+    assert [e["event"] for e in events] == (
+        ["fit_start"] + ["iteration"] * 5 + ["fit_end"]) * 2
+    assert all(e["run"] == "stochastic" for e in events)
+    assert all(e["evaluations"] == {"minibatch_grad": 1}
+               for e in events if e["event"] == "iteration")
+
+    # a fit that raises still ends with a fit_end event
+    path = str(tmpdir.join("telemetry_error.jsonl"))
+
+    def callback(x):
+        raise RuntimeError("stop")
+    with pytest.raises(RuntimeError):
+        model.optimize(method="L-BFGS-B", telemetry=path, callback=callback)
+    events = read_events(path)
+    assert events[-1]["event"] == "fit_end"
+    assert not events[-1]["success"]
+    assert events[-1]["error"] == "RuntimeError: stop"
+
+
+@pytest.mark.parametrize("size,n_bytes", [
+    (1000, 1000), ("1000", 1000), ("4GB", 4 * 1024**3),
+    ("500 MiB", 500 * 1024**2), ("2k", 2048), ("1.5KB", 1536)])
+def test_parse_memory_size(size, n_bytes):
+    assert momi.util.parse_memory_size(size) == n_bytes
+
+
 # TODO reenable these tests?
 #def test_batches_jac():
 #    x0 = np.random.normal(size=30)
@@ -137,3 +497,89 @@ def test_batches_grad():
 #    #hess2 = hessian(lambda x: momi.likelihood._composite_log_likelihood(
 #    #    sfs, demo_func(*x), mut_rate=mu))(x0)
 #    assert np.allclose(hess1, hess2)
+
+
+@pytest.mark.parametrize("use_pairwise_diffs", (True, False))
+def test_replicate_log_lik(use_pairwise_diffs):
+    model = momi.DemographicModel(1, muts_per_gen=1e-3)
+    model.add_time_param("join_time", 1.0, upper=3.0)
+    model.add_size_param("N", 2.0)
+    model.add_leaf("a", N="N")
+    model.add_leaf("b")
+    model.move_lineages("a", "b", t="join_time")
+
+    data = model.simulate_data(1000, 0, 100,
+                               sampled_n_dict={"a": 4, "b": 4},
+                               random_seed=1)
+    model.set_data(data.extract_sfs(10), mem_chunk_size=5,
+                   use_pairwise_diffs=use_pairwise_diffs)
+    x = model._get_x()
+
+    surface = model._get_surface()
+    sfs = model._get_sfs()
+    assert np.all(surface.sfs.config_array == sfs.config_array)
+
+    # the full data as a single replicate
+    counts = sfs.replicate_counts(np.ones((sfs.n_loci, 1)))
+    assert np.allclose(surface.log_lik_replicates(x, counts),
+                       surface.log_lik(x))
+
+    weights = sfs.bootstrap_weights(4, np.random.RandomState(1))
+    counts = sfs.replicate_counts(weights)
+    log_liks = surface.log_lik_replicates(x, counts)
+    scores = surface._score_replicates(x, counts)
+    assert scores.shape == (4, len(x))
+
+    for j in range(4):
+        rep_counts = counts[:, j].toarray()
+        to_keep, _ = np.nonzero(rep_counts)
+        rep_sfs = momi.data.sfs.Sfs.from_matrix(
+            rep_counts[to_keep, :],
+            momi.data.configurations._ConfigList_Subset(
+                sfs.configs, to_keep),
+            folded=False, length=None)
+        rep_surface = SfsLikelihoodSurface(
+            rep_sfs, demo_func=model._demo_fun, mut_rate=surface.mut_rate,
+            use_pairwise_diffs=use_pairwise_diffs,
+            p_missing=surface.p_missing)
+        assert np.isclose(log_liks[j], rep_surface.log_lik(x))
+        assert np.allclose(scores[j], grad(rep_surface.log_lik)(x))
+
+
+def test_jackknife_replicates():
+    model = momi.DemographicModel(1, muts_per_gen=1e-3)
+    model.add_time_param("join_time", 1.0, upper=3.0)
+    model.add_size_param("N", 2.0)
+    model.add_leaf("a", N="N")
+    model.add_leaf("b")
+    model.move_lineages("a", "b", t="join_time")
+
+    data = model.simulate_data(1000, 0, 100,
+                               sampled_n_dict={"a": 4, "b": 4},
+                               random_seed=1)
+    model.set_data(data.extract_sfs(10), mem_chunk_size=5)
+    x = model._get_x()
+    surface = model._get_surface()
+    sfs = model._get_sfs()
+
+    # the implicit jackknife counts agree with the dense ones
+    counts = sfs.replicate_counts(sfs.jackknife_weights())
+    dense_counts = sfs.replicate_counts(
+        np.ones((sfs.n_loci, sfs.n_loci)) - np.eye(sfs.n_loci))
+    assert np.allclose(surface.log_lik_replicates(x, counts),
+                       surface.log_lik_replicates(x, dense_counts))
+
+    scores = surface._score_replicates(x, counts)
+    for j in range(sfs.n_loci):
+        assert np.allclose(scores[j], grad(
+            lambda x: surface.log_lik_replicates(
+                x, dense_counts[:, [j]])[0])(x))
+
+    # more replicates than entries in the demography's cache
+    counts = sfs.replicate_counts(
+        sfs.bootstrap_weights(40, np.random.RandomState(1)))
+    scores = surface._score_replicates(x, counts)
+    for j in range(40):
+        assert np.allclose(scores[j], grad(
+            lambda x: surface.log_lik_replicates(
+                x, counts[:, [j]])[0])(x))
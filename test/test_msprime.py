@@ -123,3 +123,35 @@ if __name__ == "__main__":
     demo = demo.demo_hist._get_multipop_moran(demo.pops, demo.n)
     treeseq = demo.simulate_trees(mutation_rate=1)
     seg_sites = demo.simulate_data(mutation_rate=1)
+
+
+def test_simulate_data_parallel():
+    demo = simple_admixture_demo()
+    demo.set_mut_rate(muts_per_gen=2.5 / 1e5)
+    kwargs = dict(length=1e5, recoms_per_gen=2.5 / 1e5,
+                  num_replicates=20, sampled_n_dict={"a": 3, "b": 2},
+                  random_seed=123)
+
+    data1 = demo.simulate_data(n_workers=1, **kwargs)
+    data2 = demo.simulate_data(n_workers=2, **kwargs)
+    assert len(data1) > 0
+    assert data1 == data2
+
+    # n_workers=None seeds msprime's replicates directly instead
+    data0 = demo.simulate_data(**kwargs)
+    assert data0 == demo.simulate_data(**kwargs)
+    assert not np.array_equal(data0.positions, data1.positions)
+    assert set(data1.chrom_ids) <= set(range(20))
+
+    # genotypes reduced in bulk give the same configs as per-SNP reduction
+    sampled_n = np.array([3, 2])
+    treeseq = demo._get_demo({"a": 3, "b": 2}).simulate_trees(
+        length=1e5, mutation_rate=1e-4, recombination_rate=1e-4,
+        num_replicates=2, random_seed=5)
+    configs = []
+    for locus in treeseq:
+        for v in locus.variants():
+            derived = np.array([sum(v.genotypes[:3]), sum(v.genotypes[3:])])
+            configs.append(np.array([sampled_n - derived, derived]).T)
+    assert (momi.data.compressed_counts.CompressedAlleleCounts.from_array(configs) ==
+            momi.data.compressed_counts.CompressedAlleleCounts.from_iter(configs, 2))
@@ -5,6 +5,8 @@ import io
 import vcf
 import collections as co
 import subprocess as sp
+import gzip
+import pysam
 
 def test_read_vcf():
     sampled_n_dict = {"a":4,"b":4,"c":6}
@@ -60,3 +62,34 @@ def test_read_vcf_folded():
     assert data._sfs.fold() == data2._sfs.subset_populations(data._sfs.sampled_pops).fold()
 
     # TODO: test that concatenating datasets from multiple vcfs works?
+
+def test_simulate_vcf_multiple_chroms():
+    sampled_n_dict = {"a":4,"b":4,"c":6}
+    demo = demo_utils.simple_admixture_3pop()
+    theta = 100.0
+    rho = 100.0
+    num_bases = 1e5
+    chroms = ["1", "2", "3"]
+
+    for prefix, n_workers in (("test_vcf_chroms1", 1),
+                              ("test_vcf_chroms2", 2)):
+        demo.simulate_vcf(
+            prefix, recoms_per_gen=rho/num_bases,
+            length=num_bases, muts_per_gen=theta/num_bases,
+            sampled_n_dict=sampled_n_dict, random_seed=1234,
+            chrom_name=chroms, ploidy=2, n_workers=n_workers,
+            force=True)
+
+    with gzip.open("test_vcf_chroms1.vcf.gz") as f1, gzip.open("test_vcf_chroms2.vcf.gz") as f2:
+        assert f1.read() == f2.read()
+
+    ind2pop = {f"{pop}_{i}": pop for pop, n in sampled_n_dict.items() for i in range(n // 2)}
+    data = momi.SnpAlleleCounts.read_vcf(
+        "test_vcf_chroms1.vcf.gz", ind2pop=ind2pop,
+        bed_file="test_vcf_chroms1.bed")
+    assert data.length == len(chroms) * num_bases
+    assert set(data.chrom_ids) == set(chroms)
+
+    # each chromosome can be fetched from the index
+    vcf_f = pysam.VariantFile("test_vcf_chroms1.vcf.gz")
+    assert sum(len(list(vcf_f.fetch(chrom))) for chrom in chroms) == len(data)
@@ -0,0 +1,43 @@
+import itertools
+import pytest
+import autograd.numpy as np
+import momi
+
+
+def test_stats_table():
+    model = momi.DemographicModel(1e4, muts_per_gen=1.25e-8)
+    pops = ["A", "B", "C", "D"]
+    for pop in pops:
+        model.add_leaf(pop)
+    model.add_pulse_param("p", .1)
+    model.move_lineages("B", "C", t=100, p="p")
+    model.move_lineages("A", "B", t=1000)
+    model.move_lineages("C", "B", t=2000)
+    model.move_lineages("D", "B", t=5000)
+
+    data = model.simulate_data(100000, 1e-8, 10,
+                               sampled_n_dict={pop: 4 for pop in pops},
+                               random_seed=1)
+    model.set_data(data.extract_sfs(5))
+    fit_stats = momi.SfsModelFitStats(model)
+
+    stats = ([("f2", A, B) for A, B in itertools.combinations(pops, 2)]
+             + [("f3", A, B, O) for A, B, O in itertools.permutations(pops, 3)]
+             + [("f4", "A", "B", "C", "D"), ("f4", "A", "B", "C"),
+                ("pattersons_d", "A", "B", "C", "D"), ("f_st", "A", "C")])
+    table = fit_stats.stats_table(stats)
+    assert list(table["Statistic"]) == [s[0] for s in stats]
+    assert list(table.columns[1:5]) == ["Pop1", "Pop2", "Pop3", "Pop4"]
+
+    for (name, *args), (_, row) in zip(stats, table.iterrows()):
+        stat = getattr(fit_stats, name)(*args)
+        assert list(row[["Pop1", "Pop2", "Pop3", "Pop4"]])[:len(args)] == args
+        assert np.isclose(row["Expected"], stat.expected)
+        assert np.isclose(row["Observed"], stat.observed)
+        assert np.isclose(row["SD"], stat.sd)
+        assert np.isclose(row["Z"], stat.z_score)
+
+    f2 = fit_stats.all_f2(fig=False)
+    assert len(f2) == 6
+    for _, row in f2.iterrows():
+        assert np.isclose(row["Z"], fit_stats.f2(row["Pop1"], row["Pop2"]).z_score)
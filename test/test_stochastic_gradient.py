@@ -4,6 +4,7 @@ import momi
 from momi import expected_sfs
 import momi.likelihood
 from demo_utils import simple_admixture_demo
+import autograd
 import autograd.numpy as np
 import itertools
 import random
@@ -11,6 +12,226 @@ import sys
 from collections import Counter
 import logging
 
+def test_subsfs_list():
+    demo = simple_admixture_demo()
+    sfs = demo.simulate_data(
+        muts_per_gen=1e-3, recoms_per_gen=0, length=1000,
+        num_replicates=100, sampled_n_dict={"a": 4, "b": 5},
+        random_seed=1).extract_sfs(None)
+    n_snps = int(sfs.n_snps())
+
+    rgen = np.random.RandomState(1)
+    minibatches = momi.likelihood._subsfs_list(sfs, 7, rgen)
+    sizes = [m.n_snps() for m in minibatches]
+    assert sum(sizes) == n_snps and max(sizes) - min(sizes) <= 1
+
+    total = Counter()
+    for m in minibatches:
+        for config, count in m.to_dict().items():
+            total[config] += count
+    assert total == Counter(sfs.to_dict())
+
+    surface = momi.SfsLikelihoodSurface(sfs)._stochastic_surfaces(
+        n_minibatches=7, rgen=rgen)
+    old_counts = [m.sfs.to_dict() for m in surface.pieces]
+    surface.repartition()
+    assert surface.n_minibatches == 7
+    assert old_counts != [m.sfs.to_dict() for m in surface.pieces]
+
+
+def test_minibatch_views():
+    demo = simple_admixture_demo()
+    sfs = demo.simulate_data(
+        muts_per_gen=1e-3, recoms_per_gen=0, length=1000,
+        num_replicates=100, sampled_n_dict={"a": 4, "b": 5},
+        random_seed=1).extract_sfs(None).fold()
+    demo = demo._get_demo({"a": 4, "b": 5})
+
+    full_surface = momi.SfsLikelihoodSurface(sfs, folded=True, batch_size=5)
+    stoch_surface = full_surface._stochastic_surfaces(
+        n_minibatches=4, rgen=np.random.RandomState(1))
+
+    full_configs = full_surface.sfs.configs
+    for piece in stoch_surface.pieces:
+        for batch in [piece.sfs] + piece.sfs_batches:
+            assert batch.configs.full_configs is full_configs
+            assert batch.configs.share_vecs
+
+        # shared vecs agree with computing them for the subset
+        configs = piece.sfs.configs
+        unshared = momi.data.configurations._ConfigList_Subset(
+            full_configs, configs.sub_idxs, share_vecs=False)
+        for folded in (True, False):
+            vecs, idxs = configs._vecs_and_idxs(folded)
+            vecs2, idxs2 = unshared._vecs_and_idxs(folded)
+            assert all(np.array_equal(v, v2) for v, v2 in zip(vecs, vecs2))
+            assert idxs.keys() == idxs2.keys()
+            assert all(np.array_equal(idxs[k], idxs2[k]) for k in idxs)
+
+    total = sum(piece._get_multinom_loglik(demo, False)
+                for piece in stoch_surface.pieces)
+    assert np.isclose(total, full_surface._get_multinom_loglik(demo, False))
+
+
+def test_data_parallel_adam(monkeypatch):
+    model = momi.DemographicModel(1, muts_per_gen=1e-3)
+    model.add_time_param("join_time", 1.0, upper=3.0)
+    model.add_size_param("N", 2.0)
+    model.add_leaf("a", N="N")
+    model.add_leaf("b")
+    model.move_lineages("a", "b", t="join_time")
+    sfs = model.simulate_data(1000, 0, 100,
+                              sampled_n_dict={"a": 4, "b": 4},
+                              random_seed=1).extract_sfs(None)
+    model.set_data(sfs)
+    x0 = model._get_x()
+
+    stoch_surface = model._get_surface()._stochastic_surfaces(
+        n_minibatches=5, rgen=np.random.RandomState(1))
+
+    # the full objective is a single call, not one per minibatch
+    calls = []
+
+    def fun_and_jac(x, i):
+        calls.append(i)
+        return autograd.value_and_grad(stoch_surface.avg_neg_log_lik)(x, i)
+    evaluator = momi.optimizers._MinibatchEvaluator(fun_and_jac, 5, 3)
+    f, g = evaluator.full(x0)
+    assert calls == [None]
+    f2, g2 = evaluator(x0, range(5))
+    assert np.isclose(f, f2) and np.allclose(g, g2)
+    evaluator.close()
+
+    # the worker threads are shut down if the optimizer raises
+    closed = []
+    close = momi.optimizers._MinibatchEvaluator.close
+
+    def record_close(self):
+        closed.append(self)
+        close(self)
+
+    def callback(x, f, nit):
+        raise RuntimeError
+
+    monkeypatch.setattr(momi.optimizers._MinibatchEvaluator, "close",
+                        record_close)
+    with pytest.raises(RuntimeError):
+        momi.optimizers.adam(
+            None, x0, fun_and_jac, 5, num_iters=5, n_workers=3,
+            callback=callback)
+    assert len(closed) == 1 and closed[0].executor._shutdown
+
+    results = []
+    for _ in range(2):
+        model._set_x(x0)
+        results.append(model.stochastic_optimize(
+            n_minibatches=5, num_iters=20, svrg_epoch=5, n_workers=3,
+            rgen=np.random.RandomState(2)))
+    assert np.array_equal(results[0].x, results[1].x)
+    assert results[0].fun == results[1].fun
+
+
+def test_resume_checkpoint(tmpdir):
+    model = momi.DemographicModel(1, muts_per_gen=1e-3)
+    model.add_time_param("join_time", 1.0, upper=3.0)
+    model.add_size_param("N", 2.0)
+    model.add_leaf("a", N="N")
+    model.add_leaf("b")
+    model.move_lineages("a", "b", t="join_time")
+    sfs = model.simulate_data(1000, 0, 100,
+                              sampled_n_dict={"a": 4, "b": 4},
+                              random_seed=1).extract_sfs(None)
+    model.set_data(sfs)
+    x0 = model._get_x()
+
+    checkpoint_file = str(tmpdir.join("adam_checkpoint"))
+    kwargs = dict(n_minibatches=5, svrg_epoch=4, repartition=True, xtol=-1)
+    full = model.stochastic_optimize(
+        num_iters=12, rgen=np.random.RandomState(2), **kwargs)
+
+    # interrupted after the checkpoint at iteration 7
+    model._set_x(x0)
+    model.stochastic_optimize(
+        num_iters=8, rgen=np.random.RandomState(2),
+        save_to_checkpoint=checkpoint_file, checkpoint_iter=7, **kwargs)
+    assert momi.util.load_checkpoint(checkpoint_file)["start_iter"] == 8
+
+    # the random state is restored from the checkpoint
+    resumed = model.stochastic_optimize(
+        num_iters=12, rgen=np.random.RandomState(3),
+        start_from_checkpoint=checkpoint_file, **kwargs)
+    assert np.array_equal(resumed.x, full.x)
+    assert resumed.fun == full.fun
+
+    # resuming from a checkpoint saved on the final iteration
+    model._set_x(x0)
+    model.stochastic_optimize(
+        num_iters=12, rgen=np.random.RandomState(2),
+        save_to_checkpoint=checkpoint_file, checkpoint_iter=11, **kwargs)
+    assert momi.util.load_checkpoint(checkpoint_file)["start_iter"] == 12
+    resumed = model.stochastic_optimize(
+        num_iters=12, start_from_checkpoint=checkpoint_file, **kwargs)
+    assert np.array_equal(resumed.x, full.x)
+
+    # same for svrg, which saves a checkpoint after every epoch
+    surface = model._get_surface()
+    svrg_kwargs = dict(method="svrg", stepsize=.5, iter_per_epoch=5,
+                       xtol=-1)
+    full = surface._stochastic_surfaces(
+        n_minibatches=5, rgen=np.random.RandomState(4)).find_mle(
+            x0, max_epochs=4, **svrg_kwargs)
+
+    surface._stochastic_surfaces(
+        n_minibatches=5, rgen=np.random.RandomState(4)).find_mle(
+            x0, max_epochs=2, checkpoint_file=checkpoint_file, **svrg_kwargs)
+    rgen = np.random.RandomState(5)
+    state = momi.likelihood._load_stochastic_checkpoint(checkpoint_file, rgen)
+    resumed = surface._stochastic_surfaces(
+        n_minibatches=5, rgen=rgen).find_mle(max_epochs=4, **dict(
+            svrg_kwargs, **state))
+    assert np.array_equal(resumed.x, full.x)
+    assert np.array_equal(resumed.hess_inv, full.hess_inv)
+    assert np.array_equal(resumed.history["f"], full.history["f"])
+
+
+def test_save_checkpoint(tmpdir):
+    checkpoint_file = str(tmpdir.join("checkpoint"))
+    rgen = np.random.RandomState(1)
+    rgen.normal()
+    state = {"x": np.random.normal(size=3), "n": 3, "w": None,
+             "rng_state": rgen.get_state()}
+    momi.util.save_checkpoint(checkpoint_file, state)
+    # the temporary file was renamed
+    assert tmpdir.listdir() == [tmpdir.join("checkpoint")]
+
+    loaded = momi.util.load_checkpoint(checkpoint_file)
+    assert sorted(loaded) == sorted(state)
+    assert np.array_equal(loaded["x"], state["x"])
+    assert loaded["n"] == 3 and loaded["w"] is None
+    y = rgen.normal(size=5)
+    rgen.set_state(loaded["rng_state"])
+    assert np.array_equal(rgen.normal(size=5), y)
+
+    writer = momi.util._CheckpointWriter(checkpoint_file)
+    for n in range(5):
+        writer.write({"n": n, "x": state["x"]})
+    writer.close()
+    assert momi.util.load_checkpoint(checkpoint_file)["n"] == 4
+
+
+def test_multivariate_hypergeometric():
+    rgen = np.random.RandomState(0)
+    colors = np.array([0, 5, 1, 1000, 30, 0, 7])
+    draws = np.array([momi.likelihood._multivariate_hypergeometric(
+        colors, 100, rgen) for _ in range(2000)])
+    assert np.all(draws.sum(axis=1) == 100)
+    assert np.all((0 <= draws) & (draws <= colors))
+    assert np.allclose(draws.mean(axis=0), 100 * colors / colors.sum(),
+                       atol=.1)
+    assert np.all(momi.likelihood._multivariate_hypergeometric(
+        colors, colors.sum(), rgen) == colors)
+
+
 # test subsampling of SNPs
 
 
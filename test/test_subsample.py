@@ -71,6 +71,41 @@ def test_count_subsets():
                        data.configs.subsample_probs(subconfig))
 
 
+def test_count_subsets_weights_matrix():
+    demo = simple_admixture_demo()
+    data = demo.simulate_data(
+        muts_per_gen=1e-3, recoms_per_gen=0, length=1000,
+        num_replicates=100, sampled_n_dict={"b": 2, "a": 3}).extract_sfs(None)
+    configs = data.configs
+
+    total_counts_dict = {"a": 2, "b": 1}
+    weights = {"a": np.random.normal(size=(3, 4)),
+               "b": np.random.normal(size=(2, 4))}
+    counts = configs.count_subsets(weights, total_counts_dict)
+    assert counts.shape == (len(configs), 4)
+
+    for j in range(4):
+        expected = np.ones(len(configs))
+        for i, p in enumerate(configs.sampled_pops):
+            n = total_counts_dict[p]
+            expected *= sum(
+                w * scipy.special.comb(configs.value[:, i, 0], n - d)
+                * scipy.special.comb(configs.value[:, i, 1], d)
+                for d, w in enumerate(weights[p][:, j]))
+        assert np.allclose(counts[:, j], expected)
+        assert np.allclose(counts[:, j], configs.count_subsets(
+            {p: w[:, j] for p, w in weights.items()}, total_counts_dict))
+
+    # a single weight vector, and populations without weights
+    counts = configs.count_subsets({"a": weights["a"][:, 0]},
+                                   total_counts_dict)
+    assert counts.shape == (len(configs),)
+    i = configs.sampled_pops.index("b")
+    assert np.allclose(
+        counts / scipy.special.comb(configs.value[:, i, :].sum(axis=1), 1),
+        configs.count_subsets({"a": weights["a"][:, 0]}, {"a": 2}))
+
+
 @pytest.mark.parametrize("folded,n_lins",
                          ((f, n) for f in (True, False) for n in ((2, 3), (0, 3))))
 def test_simple_admixture_subsampling(folded, n_lins):